@@ -1,10 +1,13 @@
 import os
+import threading
 import tkinter as tk
 from tkinter import filedialog, messagebox
-from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from cryptography.fernet import Fernet
-import snowflake.connector
+from LabyrinthDurable import atomic_write, set_durability, is_temp_path
+from IceLabyrinthSnowflake import ConnectionPool, BatchUploader, UploadPipeline
+from IceLabyrinthDedup import DedupBackup, SnowflakeStage, ChunkIndex, DEFAULT_CHUNK_INDEX_FILE
+from LabyrinthMetrics import start_metrics_server
 
 # Snowflake connection parameters (replace with your actual Snowflake credentials)
 snowflake_user = 'your_username'
@@ -13,9 +16,36 @@ snowflake_account = 'your_account'
 snowflake_database = 'your_database'
 snowflake_schema = 'your_schema'
 snowflake_warehouse = 'your_warehouse'
+snowflake_stage = '@%YOUR_STAGE_DIRECTORY'
+snowflake_table = 'YOUR_TABLE'
+
+# Upload batching: a batch is flushed once it holds this many files or bytes, or gets this old (seconds)
+snowflake_batch_max_files = 1000
+snowflake_batch_max_bytes = 256 * 1024 * 1024
+snowflake_batch_flush_interval = 5.0
+
+# Upload stage: number of concurrent upload workers and queued files before encrypt_file waits
+snowflake_upload_workers = 4
+snowflake_upload_queue = 10000
+
+# Deduplicated backups, off by default: files are split into content-defined chunks and only chunks the
+# stage doesn't hold yet are uploaded, so a small edit uploads a few chunks instead of the file.
+# Set to True to back up through the chunk store instead of the batched PUT and COPY INTO
+snowflake_dedup = False
+snowflake_chunk_index_file = DEFAULT_CHUNK_INDEX_FILE
+
+# Ciphertext durability: "none", "per-file" or "grouped" (fsyncs batched across files)
+durability = "grouped"
+
+# Local Prometheus scrape endpoint (http://127.0.0.1:<port>/metrics), off by default since it
+# has no authentication; set a port such as 9464 to enable it
+metrics_port = None
 
 # Function to establish Snowflake connection
 def get_snowflake_connection():
+    # The connector takes longer to import than the rest of the tool, so it's
+    # loaded when the pool opens its first connection rather than at startup
+    import snowflake.connector
     return snowflake.connector.connect(
         user=snowflake_user,
         password=snowflake_password,
@@ -25,14 +55,27 @@ def get_snowflake_connection():
         schema=snowflake_schema
     )
 
+# Connection pool shared by all upload calls
+snowflake_pool = ConnectionPool(get_snowflake_connection, min_size=1, max_size=4, idle_timeout=300)
+
+# Batched uploader: one multi-file PUT and a single COPY INTO per batch
+snowflake_uploader = BatchUploader(snowflake_pool, snowflake_stage, snowflake_table,
+                                   max_files=snowflake_batch_max_files,
+                                   max_bytes=snowflake_batch_max_bytes,
+                                   flush_interval=snowflake_batch_flush_interval)
+
+# Upload stage between encryption and the batched uploader, so encrypt_file never waits on the WAN.
+# The uploader reports each file once its batch is loaded, so the pipeline counts real uploads
+snowflake_pipeline = UploadPipeline(snowflake_uploader.add, workers=snowflake_upload_workers, max_queue=snowflake_upload_queue, asynchronous=True)
+
+# Chunk store for deduplicated backups, under the same stage
+snowflake_chunk_stage = SnowflakeStage(snowflake_pool, snowflake_stage)
+snowflake_chunk_index = ChunkIndex(snowflake_chunk_index_file) if snowflake_dedup else None
+
 # Function to upload file to Snowflake stage
 def upload_to_snowflake_stage(file_path):
     try:
-        connection = get_snowflake_connection()
-        cursor = connection.cursor()
-        cursor.execute(f'PUT file://{file_path} @%YOUR_STAGE_DIRECTORY/')
-        cursor.close()
-        connection.close()
+        snowflake_pool.execute(f'PUT file://{file_path} @%YOUR_STAGE_DIRECTORY/')
         print(f"File {file_path} uploaded to Snowflake stage successfully")
     except Exception as e:
         print(f"Error uploading file to Snowflake stage: {e}")
@@ -40,11 +83,7 @@ def upload_to_snowflake_stage(file_path):
 # Function to copy file from Snowflake stage to table
 def copy_to_snowflake_table(file_path):
     try:
-        connection = get_snowflake_connection()
-        cursor = connection.cursor()
-        cursor.execute(f"COPY INTO YOUR_TABLE FROM @%YOUR_STAGE_DIRECTORY/{os.path.basename(file_path)} FILE_FORMAT=(TYPE='CSV')")
-        cursor.close()
-        connection.close()
+        snowflake_pool.execute(f"COPY INTO YOUR_TABLE FROM @%YOUR_STAGE_DIRECTORY/{os.path.basename(file_path)} FILE_FORMAT=(TYPE='CSV')")
         print(f"File {file_path} copied to Snowflake table successfully")
     except Exception as e:
         print(f"Error copying file to Snowflake table: {e}")
@@ -57,26 +96,27 @@ class EncryptionHandler(FileSystemEventHandler):
         self.fernet = Fernet(self.key)
         self.trigger = trigger
         self.mode = mode
+        self.backup = DedupBackup(self.key, snowflake_chunk_stage, snowflake_chunk_index) if snowflake_dedup else None
 
     # Event handler for file creation
     def on_created(self, event):
         if not event.is_directory and self.trigger == "Create":
             file_path = event.src_path
-            if not file_path.endswith(".encrypted"):
+            if not file_path.endswith(".encrypted") and not is_temp_path(file_path):
                 self.handle_file(file_path)
 
     # Event handler for file deletion
     def on_deleted(self, event):
         if not event.is_directory and self.trigger == "Delete":
             file_path = event.src_path
-            if file_path.endswith(".encrypted"):
+            if file_path.endswith(".encrypted") and not is_temp_path(file_path):
                 self.handle_file(file_path)
 
     # Event handler for file modification
     def on_modified(self, event):
         if not event.is_directory and self.trigger == "Modify":
             file_path = event.src_path
-            if not file_path.endswith(".encrypted"):
+            if not file_path.endswith(".encrypted") and not is_temp_path(file_path):
                 self.handle_file(file_path)
 
     # Handle encryption for individual or group files
@@ -95,14 +135,19 @@ class EncryptionHandler(FileSystemEventHandler):
         with open(file_path, "rb") as f:
             data = f.read()
         encrypted_data = self.fernet.encrypt(data)
-        with open(file_path + ".encrypted", "wb") as f:
-            f.write(encrypted_data)
-        os.remove(file_path)
-        # Upload encrypted file to Snowflake stage
-        upload_to_snowflake_stage(file_path + ".encrypted")
+        # Written to a temp file and renamed into place before the plaintext is removed
+        atomic_write(file_path + ".encrypted", encrypted_data, source=file_path)
+        # Hand encrypted file to the upload stage: new chunks only with dedup, otherwise the next batched upload
+        snowflake_pipeline.submit(file_path + ".encrypted", self.backup.backup_file if self.backup else None)
 
 # Main function to run the GUI
 def main():
+    set_durability(durability)
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    # Opens the pool's first connections while the window comes up, so the first upload doesn't wait on a login
+    threading.Thread(target=snowflake_pool.fill, name="SnowflakeConnect", daemon=True).start()
+
     root = tk.Tk()
     root.title("Labyrinth")
 
@@ -118,6 +163,10 @@ def main():
 
     root.mainloop()
 
+    # Drain the upload stage, then upload whatever is left in the current batch
+    snowflake_pipeline.close()
+    snowflake_uploader.close()
+
 # Run the main function
 if __name__ == "__main__":
     main()
\ No newline at end of file
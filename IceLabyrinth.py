@@ -4,6 +4,8 @@ from tkinter import filedialog, messagebox
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from cryptography.fernet import Fernet
+from LabyrinthDurable import atomic_write, is_temp_path
+from IceLabyrinthSnowflake import UploadPipeline
 
 # Snowflake integration (simplified)
 def upload_to_snowflake(file_path):
@@ -14,6 +16,9 @@ def download_from_snowflake(file_path):
     # Placeholder function to download file from Snowflake
     print("Downloading", file_path, "from Snowflake")
 
+# Upload stage so encryption never waits on the Snowflake round trip
+upload_pipeline = UploadPipeline(upload_to_snowflake)
+
 # EncryptionHandler class definition
 class EncryptionHandler(FileSystemEventHandler):
     def __init__(self, key, trigger, mode):
@@ -27,21 +32,21 @@ class EncryptionHandler(FileSystemEventHandler):
     def on_created(self, event):
         if not event.is_directory and self.trigger == "Create":
             file_path = event.src_path
-            if not file_path.endswith(".encrypted"):
+            if not file_path.endswith(".encrypted") and not is_temp_path(file_path):
                 self.handle_file(file_path)
 
     # Event handler for file deletion
     def on_deleted(self, event):
         if not event.is_directory and self.trigger == "Delete":
             file_path = event.src_path
-            if file_path.endswith(".encrypted"):
+            if file_path.endswith(".encrypted") and not is_temp_path(file_path):
                 self.handle_file(file_path)
 
     # Event handler for file modification
     def on_modified(self, event):
         if not event.is_directory and self.trigger == "Modify":
             file_path = event.src_path
-            if not file_path.endswith(".encrypted"):
+            if not file_path.endswith(".encrypted") and not is_temp_path(file_path):
                 self.handle_file(file_path)
 
     # Handle encryption for individual or group files
@@ -60,11 +65,10 @@ class EncryptionHandler(FileSystemEventHandler):
         with open(file_path, "rb") as f:
             data = f.read()
         encrypted_data = self.fernet.encrypt(data)
-        with open(file_path + ".encrypted", "wb") as f:
-            f.write(encrypted_data)
-        os.remove(file_path)
-        # Upload encrypted file to Snowflake
-        upload_to_snowflake(file_path + ".encrypted")
+        # Written to a temp file and renamed into place before the plaintext is removed
+        atomic_write(file_path + ".encrypted", encrypted_data, source=file_path)
+        # Queue encrypted file for upload to Snowflake
+        upload_pipeline.submit(file_path + ".encrypted")
 
     # Placeholder method for encrypting all files in a directory
     def encrypt_all_files(self):
@@ -87,6 +91,9 @@ def main():
 
     root.mainloop()
 
+    # Finish queued uploads before exiting
+    upload_pipeline.close()
+
 # Run the main function
 if __name__ == "__main__":
     main()
\ No newline at end of file
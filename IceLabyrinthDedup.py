@@ -0,0 +1,456 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from LabyrinthCompression import CODECS, NO_COMPRESSION, get_codec, get_compression
+from LabyrinthDurable import atomic_write
+from LabyrinthKeys import KeyRing
+from LabyrinthStream import KEY_ID_SIZE, key_id
+from LabyrinthMetrics import REGISTRY, record_stage
+from LabyrinthStream import read_segments
+from IceLabyrinthSnowflake import quote
+
+# Content-defined chunking: a cut is made where the gear hash of the last 64 bytes falls
+# below a threshold, so an edit only changes the chunks around it and every other chunk
+# keeps its boundaries and ID. Chunks are never shorter than MIN_CHUNK or longer than MAX_CHUNK.
+MIN_CHUNK = 16 * 1024
+AVG_CHUNK = 64 * 1024
+MAX_CHUNK = 256 * 1024
+
+# Fixed gear table, so boundaries are the same in every process and on every machine
+GEAR = [int.from_bytes(hashlib.sha256(b"labyrinth gear" + bytes([i])).digest()[:8], "big") for i in range(256)]
+GEAR_MASK = (1 << 64) - 1
+
+# numpy is optional and only imported once the first cut is placed; without it, or with
+# USE_NUMPY off, chunk boundaries are found by a pure Python loop, to the same cuts
+USE_NUMPY = True
+_numpy = None
+
+# Bytes hashed per numpy pass while looking for a cut
+CUT_BLOCK = 64 * 1024
+
+# Default location of the chunk index, kept with the file index
+DEFAULT_CHUNK_INDEX_FILE = os.path.join(os.path.expanduser("~"), ".labyrinth", "chunks.sqlite")
+
+# New chunks are sent to the stage in batches of about this many bytes
+UPLOAD_BATCH_BYTES = 64 * 1024 * 1024
+
+# Stored object layout: MAGIC | codec (1) | key ID (8) | nonce (12) | AES-GCM(contents) with the object name
+# as associated data. The key ID names the ring key the object's keys were derived from
+OBJECT_MAGIC = b"LBYC"
+OBJECT_HEADER = struct.Struct(f">4sB{KEY_ID_SIZE}s12s")
+
+CHUNKS = "chunks"
+MANIFESTS = "manifests"
+
+DEDUP_BYTES = REGISTRY.counter("labyrinth_dedup_bytes_total", "Plaintext bytes backed up, by whether their chunk was already stored", label="result")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    id TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    stored_size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS manifests (
+    name TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    chunks INTEGER NOT NULL,
+    PRIMARY KEY (name, version)
+);
+"""
+
+
+def _gear_numpy():
+    # (numpy, gear table as a numpy array), or None when numpy is missing or turned off
+    global _numpy
+    if not USE_NUMPY:
+        return None
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            _numpy = False
+        else:
+            _numpy = (numpy, numpy.array(GEAR, dtype=numpy.uint64))
+    return _numpy or None
+
+
+def gear_hashes(data, begin, end):
+    """
+    Returns a numpy array holding, for each byte of data[begin:end], the gear hash of
+    the (up to) 64 bytes ending there, counting from begin. The window is built by
+    doubling: after the pass with shift s every entry covers 2 * s bytes. Needs numpy.
+    """
+    numpy, gear_array = _gear_numpy()
+    hashes = gear_array[numpy.frombuffer(data, numpy.uint8, end - begin, begin)]
+    for shift in (1, 2, 4, 8, 16, 32):
+        hashes[shift:] = hashes[shift:] + (hashes[:-shift] << numpy.uint64(shift))
+    return hashes
+
+
+def find_cut(data, start, end, final, min_size=MIN_CHUNK, avg_size=AVG_CHUNK, max_size=MAX_CHUNK):
+    """
+    Returns the end of the chunk starting at start in data[:end], or None if more data
+    is needed to place it. final means data[:end] is all there is.
+    """
+    if end - start <= min_size:
+        return end if final else None
+    limit = min(end, start + max_size)
+    # A hash below threshold turns up once in about avg_size - min_size positions
+    threshold = (GEAR_MASK + 1) // max(1, avg_size - min_size)
+    # Hash the 64 bytes before the first allowed cut, so that cut sees a full window
+    position = max(start, start + min_size - 64)
+    gear_numpy = _gear_numpy()
+    if gear_numpy is not None:
+        numpy = gear_numpy[0]
+        # Whole blocks are hashed at once; each block starts 63 bytes early so its first window is full
+        block = max(position, start + min_size)
+        while block < limit:
+            block_end = min(limit, block + CUT_BLOCK)
+            lead = max(position, block - 63)
+            hits = numpy.flatnonzero(gear_hashes(data, lead, block_end)[block - lead:] < numpy.uint64(threshold))
+            if hits.size:
+                return block + int(hits[0]) + 1
+            block = block_end
+    else:
+        h = 0
+        gear = GEAR
+        for value in map(gear.__getitem__, data[position:limit]):
+            h = ((h << 1) + value) & GEAR_MASK
+            position += 1
+            if h < threshold and position > start + min_size:
+                return position
+    if limit == start + max_size or final:
+        return limit
+    return None
+
+
+def chunk_stream(segments, min_size=MIN_CHUNK, avg_size=AVG_CHUNK, max_size=MAX_CHUNK):
+    """
+    Yields content-defined chunks of the bytes in an iterator of segments.
+    """
+    buffer = b""
+    offset = 0
+    for segment in segments:
+        buffer = buffer[offset:] + bytes(segment)
+        offset = 0
+        while True:
+            cut = find_cut(buffer, offset, len(buffer), False, min_size, avg_size, max_size)
+            if cut is None:
+                break
+            yield buffer[offset:cut]
+            offset = cut
+    while offset < len(buffer):
+        cut = find_cut(buffer, offset, len(buffer), True, min_size, avg_size, max_size)
+        yield buffer[offset:cut]
+        offset = cut
+
+
+class LocalStage(object):
+    """
+    Stand-in for a Snowflake stage that keeps objects under a local directory.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def put_many(self, prefix, objects):
+        """
+        Stores each name -> data in objects under prefix.
+        """
+        directory = os.path.join(self.root, prefix)
+        os.makedirs(directory, exist_ok=True)
+        for name, data in objects.items():
+            atomic_write(os.path.join(directory, name), data)
+
+    def get(self, prefix, name):
+        with open(os.path.join(self.root, prefix, name), "rb") as f:
+            return f.read()
+
+    def list(self, prefix):
+        directory = os.path.join(self.root, prefix)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(name for name in os.listdir(directory) if not name.startswith("."))
+
+
+class SnowflakeStage(object):
+    """
+    Objects in a Snowflake stage, moved with one multi-file PUT per batch over a ConnectionPool.
+    """
+
+    def __init__(self, pool, stage, staging_root=None):
+        self.pool = pool
+        self.stage = stage.rstrip("/")
+        self.staging_root = staging_root
+
+    def put_many(self, prefix, objects):
+        staging_dir = tempfile.mkdtemp(prefix="labyrinth-chunks-", dir=self.staging_root)
+        try:
+            for name, data in objects.items():
+                with open(os.path.join(staging_dir, name), "wb") as f:
+                    f.write(data)
+            # Objects are already encrypted and compressed; chunks are content-addressed, so existing ones are kept
+            self.pool.execute(f"PUT {quote('file://' + staging_dir + '/*')} {self.stage}/{prefix}/ AUTO_COMPRESS=FALSE OVERWRITE=FALSE")
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def get(self, prefix, name):
+        staging_dir = tempfile.mkdtemp(prefix="labyrinth-chunks-", dir=self.staging_root)
+        try:
+            self.pool.execute(f"GET {self.stage}/{prefix}/{name} {quote('file://' + staging_dir + '/')}")
+            with open(os.path.join(staging_dir, name), "rb") as f:
+                return f.read()
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def list(self, prefix):
+        rows = self.pool.execute(f"LIST {self.stage}/{prefix}/") or []
+        return sorted(row[0].rsplit("/", 1)[-1] for row in rows)
+
+
+class ChunkIndex(object):
+    """
+    Local record of the chunks already in the stage and the file versions backed up.
+    It only saves work: a chunk missing from it is uploaded again.
+    """
+
+    def __init__(self, index_file=DEFAULT_CHUNK_INDEX_FILE):
+        directory = os.path.dirname(index_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        # Imported here so loading the module for the batched upload path skips sqlite3
+        import sqlite3
+        self.db = sqlite3.connect(index_file, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def stored(self, chunk_ids):
+        """
+        Returns the subset of chunk_ids already in the stage.
+        """
+        chunk_ids = list(chunk_ids)
+        found = set()
+        with self.lock:
+            for i in range(0, len(chunk_ids), 500):
+                batch = chunk_ids[i:i + 500]
+                marks = ", ".join("?" for _ in batch)
+                found.update(row[0] for row in self.db.execute(f"SELECT id FROM chunks WHERE id IN ({marks})", batch))
+        return found
+
+    def add_chunks(self, entries):
+        """
+        Records (chunk ID, size, stored size) entries as uploaded.
+        """
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR IGNORE INTO chunks VALUES (?, ?, ?)", entries)
+
+    def add_manifest(self, name, version, size, chunks):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO manifests VALUES (?, ?, ?, ?)", (name, version, size, chunks))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def _derive(key, info):
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=info)
+    return hkdf.derive(key)
+
+
+class DedupBackup(object):
+    """
+    Backs up files to a stage as encrypted, deduplicated chunks. Each version of a file
+    is an encrypted manifest listing its chunk IDs; only chunks the stage doesn't hold
+    yet are uploaded. Chunk IDs are keyed hashes, so the stage can't be probed for
+    known plaintext. New backups use keys derived from the ring's primary key; after a
+    rotation, versions made under older keys are still found and restored with them.
+    """
+
+    def __init__(self, key, stage, index, min_size=MIN_CHUNK, avg_size=AVG_CHUNK, max_size=MAX_CHUNK):
+        self.ring = key if isinstance(key, KeyRing) else KeyRing([key])
+        self.derived = {}
+        self.stage = stage
+        self.index = index
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+
+    def _keys(self, kid=None):
+        """
+        Returns (key ID, chunk ID key, AEAD) for the ring key with ID kid, by default
+        the primary key. Derived keys are cached per ring key.
+        """
+        if kid is None:
+            self.ring.refresh()
+            kid = key_id(self.ring.primary)
+        keys = self.derived.get(kid)
+        if keys is None:
+            raw = self.ring.ids.get(kid)
+            if raw is None and self.ring.refresh():
+                raw = self.ring.ids.get(kid)
+            if raw is None:
+                raise KeyError(f"No key with ID {kid.hex()} in the key ring")
+            keys = self.derived[kid] = (kid, _derive(raw, b"labyrinth chunk id"), AESGCM(_derive(raw, b"labyrinth chunk v1")))
+        return keys
+
+    def chunk_id(self, chunk, kid=None):
+        return hashlib.blake2b(chunk, key=self._keys(kid)[1], digest_size=32).hexdigest()
+
+    def name_id(self, name, kid=None):
+        return hashlib.blake2b(name.encode("utf-8", "surrogateescape"), key=self._keys(kid)[1], digest_size=16).hexdigest()
+
+    def _manifests(self, name, kid):
+        # Manifests sit under the ID of the key they were made with, so each ring key is looked up on its own
+        return f"{MANIFESTS}/{kid.hex()}/{self.name_id(name, kid)}"
+
+    def _seal(self, name, data, kid=None):
+        codec = NO_COMPRESSION
+        compression, level = get_compression()
+        if compression is not None:
+            compressor = CODECS[compression]
+            packed = b"".join(compressor.compress([data], compressor.default_level if level is None else level))
+            if len(packed) < len(data):
+                codec, data = compressor.codec_id, packed
+        kid, _, aead = self._keys(kid)
+        nonce = os.urandom(12)
+        header = OBJECT_HEADER.pack(OBJECT_MAGIC, codec, kid, nonce)
+        return header + aead.encrypt(nonce, data, header + name.encode())
+
+    def _open(self, name, blob):
+        header = blob[:OBJECT_HEADER.size]
+        magic, codec, kid, nonce = OBJECT_HEADER.unpack(header)
+        if magic != OBJECT_MAGIC:
+            raise ValueError(f"Stage object {name} is not a Labyrinth chunk")
+        data = self._keys(kid)[2].decrypt(nonce, blob[OBJECT_HEADER.size:], header + name.encode())
+        if codec != NO_COMPRESSION:
+            data = b"".join(get_codec(codec).decompress([data]))
+        return data
+
+    def _plaintext(self, file_path):
+        # Yields the plaintext of file_path; .encrypted files are decrypted in memory
+        if file_path.endswith(".encrypted"):
+            cipher = self.ring.source_cipher(file_path)
+            with open(file_path, "rb") as src:
+                yield from cipher.plaintext_segments(src)
+        else:
+            with open(file_path, "rb") as src:
+                yield from read_segments(src, self.max_size)
+
+    def _flush(self, pending):
+        if pending:
+            self.stage.put_many(CHUNKS, {chunk_id: blob for chunk_id, _, blob in pending})
+            self.index.add_chunks([(chunk_id, size, len(blob)) for chunk_id, size, blob in pending])
+
+    def backup_file(self, file_path, name=None):
+        """
+        Backs up the current contents of file_path, a plaintext or .encrypted file, as a
+        new version of name (by default the plaintext path). Returns the new version.
+        """
+        started = time.perf_counter()
+        # One key for the whole version, even if the ring is rotated while it is read
+        kid = self._keys()[0]
+        if name is None:
+            name = os.path.abspath(file_path[:-len(".encrypted")] if file_path.endswith(".encrypted") else file_path)
+        chunks = []
+        pending = []
+        pending_bytes = size = new_bytes = uploaded = 0
+        seen = set()
+        batch = []
+
+        def upload(batch):
+            nonlocal pending_bytes, new_bytes, uploaded
+            stored = self.index.stored(chunk_id for chunk_id, _ in batch)
+            for chunk_id, chunk in batch:
+                if chunk_id in stored or chunk_id in seen:
+                    DEDUP_BYTES.inc("duplicate", len(chunk))
+                    continue
+                seen.add(chunk_id)
+                blob = self._seal(chunk_id, chunk, kid)
+                pending.append((chunk_id, len(chunk), blob))
+                pending_bytes += len(blob)
+                new_bytes += len(chunk)
+                uploaded += len(blob)
+                DEDUP_BYTES.inc("new", len(chunk))
+            if pending_bytes >= UPLOAD_BATCH_BYTES:
+                self._flush(pending)
+                pending.clear()
+                pending_bytes = 0
+
+        for chunk in chunk_stream(self._plaintext(file_path), self.min_size, self.avg_size, self.max_size):
+            chunk_id = self.chunk_id(chunk, kid)
+            chunks.append([chunk_id, len(chunk)])
+            size += len(chunk)
+            batch.append((chunk_id, chunk))
+            if len(batch) >= 256:
+                upload(batch)
+                batch = []
+        upload(batch)
+        self._flush(pending)
+
+        # The manifest goes up last, so a version is only listed once all its chunks are stored
+        version = time.time_ns()
+        manifest = json.dumps({"name": name, "version": version, "size": size, "chunks": chunks}).encode()
+        manifest_name = f"{version}.manifest"
+        blob = self._seal(manifest_name, manifest, kid)
+        self.stage.put_many(self._manifests(name, kid), {manifest_name: blob})
+        self.index.add_manifest(name, version, size, len(chunks))
+        uploaded += len(blob)
+        record_stage("uploaded", time.perf_counter() - started, uploaded)
+        logging.info(f"Backed up {name}: {len(chunks)} chunks, {new_bytes} of {size} bytes new, {uploaded} bytes uploaded")
+        return version
+
+    def _versions(self, name):
+        # (version, key ID) for every manifest of name, under every key in the ring, oldest first
+        self.ring.refresh()
+        found = []
+        for kid in self.ring.ids:
+            for manifest_name in self.stage.list(self._manifests(name, kid)):
+                found.append((int(manifest_name.split(".")[0]), kid))
+        return sorted(found)
+
+    def versions(self, name):
+        """
+        Returns the versions of name held in the stage, oldest first.
+        """
+        return [version for version, _ in self._versions(name)]
+
+    def restore(self, name, file_path, version=None):
+        """
+        Rebuilds version (by default the newest) of name into file_path from the stage.
+        """
+        versions = self._versions(name)
+        if version is not None:
+            versions = [found for found in versions if found[0] == version]
+        if not versions:
+            raise FileNotFoundError(f"No backup of {name}" + (f" at version {version}" if version is not None else ""))
+        version, kid = versions[-1]
+        manifest_name = f"{version}.manifest"
+        manifest = json.loads(self._open(manifest_name, self.stage.get(self._manifests(name, kid), manifest_name)))
+        staged = f"{file_path}.restore"
+        try:
+            with open(staged, "wb") as dst:
+                for chunk_id, size in manifest["chunks"]:
+                    chunk = self._open(chunk_id, self.stage.get(CHUNKS, chunk_id))
+                    if len(chunk) != size or self.chunk_id(chunk, kid) != chunk_id:
+                        raise ValueError(f"Chunk {chunk_id} of {name} is corrupt")
+                    dst.write(chunk)
+            os.replace(staged, file_path)
+        except Exception:
+            if os.path.exists(staged):
+                os.remove(staged)
+            raise
+        return version
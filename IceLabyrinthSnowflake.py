@@ -0,0 +1,479 @@
+import hashlib
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from functools import partial
+from LabyrinthMetrics import REGISTRY, record_stage, record_error
+
+# DB-API exception classes raised when the connection, rather than the statement, failed.
+# Matched by name so any connector works, snowflake.connector included
+CONNECTION_ERRORS = ("OperationalError", "InterfaceError")
+
+
+def is_connection_error(error):
+    """
+    Returns True if error means the connection is unusable: a network or timeout error,
+    or a connector's OperationalError or InterfaceError. SQL, permission and data errors
+    are not, so retrying them on another connection would only fail again.
+    """
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    return any(cls.__name__ in CONNECTION_ERRORS for cls in type(error).__mro__)
+
+
+def quote(value):
+    """
+    Returns value as a single-quoted Snowflake string literal, so names taken from
+    the watched tree can't end the literal early.
+    """
+    return "'" + value.replace("\\", "\\\\").replace("'", "''") + "'"
+
+
+def staged_name(file_path):
+    """
+    Returns the name file_path is staged under: its basename behind a digest of its
+    directory, so same-named files from different directories don't overwrite each
+    other in the stage, while the same file always gets the same name.
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    digest = hashlib.sha1(os.fsencode(directory)).hexdigest()[:16]
+    return f"{digest}-{os.path.basename(file_path)}"
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of Snowflake connections shared by every upload call.
+    connect is any zero-argument callable returning a DB-API style connection,
+    so a local stand-in connector can be dropped in place of snowflake.connector.
+    fill() opens min_size connections up front; idle ones above min_size are closed.
+    """
+
+    def __init__(self, connect, min_size=1, max_size=4, idle_timeout=300, health_check_interval=30, health_check_sql="SELECT 1"):
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError(f"Invalid pool size min={min_size} max={max_size}")
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.health_check_sql = health_check_sql
+        self.idle = []
+        self.size = 0
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except Exception as e:
+            logging.warning(f"Error closing Snowflake connection: {str(e)}")
+
+    def _healthy(self, connection):
+        try:
+            if getattr(connection, "is_closed", None) and connection.is_closed():
+                return False
+            cursor = connection.cursor()
+            try:
+                cursor.execute(self.health_check_sql)
+            finally:
+                cursor.close()
+            return True
+        except Exception as e:
+            logging.warning(f"Snowflake connection failed health check: {str(e)}")
+            return False
+
+    def fill(self):
+        """
+        Opens connections until min_size are pooled, so the first statements don't wait
+        on a login. Returns the number opened. A failure is logged and left for acquire
+        to retry on demand.
+        """
+        opened = 0
+        while True:
+            with self.condition:
+                if self.closed or self.size >= self.min_size:
+                    return opened
+                self.size += 1
+            try:
+                connection = self.connect()
+            except Exception as e:
+                with self.condition:
+                    self.size -= 1
+                    self.condition.notify()
+                logging.warning(f"Error opening Snowflake connection: {str(e)}")
+                return opened
+            self.release(connection)
+            opened += 1
+
+    def _evict_idle(self):
+        # Called with the condition held; closes connections idle past the timeout down to min_size
+        now = time.monotonic()
+        keep = []
+        for connection, last_used in self.idle:
+            if self.size > self.min_size and now - last_used > self.idle_timeout:
+                self.size -= 1
+                self._discard(connection)
+            else:
+                keep.append((connection, last_used))
+        self.idle = keep
+
+    def acquire(self, timeout=None):
+        """
+        Returns a healthy connection, opening a new one if the pool isn't at max_size,
+        otherwise waiting up to timeout seconds for one to be released.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.condition:
+                if self.closed:
+                    raise RuntimeError("Connection pool is closed")
+                self._evict_idle()
+                if self.idle:
+                    connection, last_used = self.idle.pop()
+                elif self.size < self.max_size:
+                    self.size += 1
+                    connection, last_used = None, None
+                else:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError("Timed out waiting for a Snowflake connection")
+                    self.condition.wait(remaining)
+                    continue
+            if connection is None:
+                try:
+                    return self.connect()
+                except Exception:
+                    with self.condition:
+                        self.size -= 1
+                        self.condition.notify()
+                    raise
+            if time.monotonic() - last_used < self.health_check_interval or self._healthy(connection):
+                return connection
+            self._drop(connection)
+
+    def _drop(self, connection):
+        self._discard(connection)
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+
+    def release(self, connection, broken=False):
+        """
+        Returns a connection to the pool, or closes it if it is broken.
+        """
+        if broken or self.closed:
+            self._drop(connection)
+            return
+        with self.condition:
+            self.idle.append((connection, time.monotonic()))
+            self.condition.notify()
+
+    def execute(self, sql, retries=1):
+        """
+        Runs sql on a pooled connection. If the connection fails, it is thrown away
+        and the statement retried on a fresh one up to retries times. Any other error
+        is raised at once and the connection goes back to the pool.
+        """
+        for attempt in range(retries + 1):
+            connection = self.acquire()
+            try:
+                cursor = connection.cursor()
+                try:
+                    cursor.execute(sql)
+                    result = cursor.fetchall() if cursor.description else None
+                finally:
+                    cursor.close()
+            except Exception as e:
+                if not is_connection_error(e):
+                    self.release(connection)
+                    raise
+                self.release(connection, broken=True)
+                if attempt == retries:
+                    raise
+                logging.warning(f"Snowflake statement failed, reconnecting: {str(e)}")
+                continue
+            self.release(connection)
+            return result
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            idle = self.idle
+            self.idle = []
+            self.size -= len(idle)
+            self.condition.notify_all()
+        for connection, _ in idle:
+            self._discard(connection)
+
+
+class BatchUploader(object):
+    """
+    Gathers encrypted files into batches bounded by file count, total size and age,
+    then uploads each batch with one multi-file PUT followed by a single COPY INTO.
+    A failed batch is retried with backoff; PUT skips files already in the stage and
+    COPY INTO skips files already loaded, so a retry doesn't load anything twice.
+    """
+
+    def __init__(self, pool, stage, table, file_format="(TYPE='CSV')", max_files=1000, max_bytes=256 * 1024 * 1024, flush_interval=5.0, staging_root=None,
+                 retries=3, retry_delay=2.0):
+        # COPY INTO accepts at most 1000 names in its FILES list
+        if not 1 <= max_files <= 1000:
+            raise ValueError(f"max_files must be between 1 and 1000, got {max_files}")
+        self.pool = pool
+        self.stage = stage.rstrip("/")
+        self.table = table
+        self.file_format = file_format
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.staging_root = staging_root
+        self.retries = retries
+        self.retry_delay = retry_delay
+        # name -> (file_path, done); done(error) is called once the file's batch is uploaded or given up on
+        self.batch = {}
+        self.batch_bytes = 0
+        self.batch_started = None
+        self.condition = threading.Condition()
+        self.running = True
+        self.batches_uploaded = 0
+        self.files_uploaded = 0
+        self.batches_failed = 0
+        self.files_failed = 0
+        self.thread = threading.Thread(target=self._run, name="BatchUploader", daemon=True)
+        self.thread.start()
+
+    def add(self, file_path, done=None):
+        """
+        Adds an encrypted file to the current batch, flushing first if the batch is full
+        or already holds the same file. done(error), if given, is called
+        with None once the batch is loaded, or with the last error if it never was.
+        """
+        name = staged_name(file_path)
+        size = os.path.getsize(file_path)
+        with self.condition:
+            if name in self.batch or len(self.batch) >= self.max_files or (self.batch and self.batch_bytes + size > self.max_bytes):
+                ready = self._take()
+            else:
+                ready = None
+            self.batch[name] = (file_path, done)
+            self.batch_bytes += size
+            if self.batch_started is None:
+                self.batch_started = time.monotonic()
+                self.condition.notify()
+        if ready:
+            self._upload(ready)
+
+    def _take(self):
+        # Called with the condition held; hands back the current batch and starts a new one
+        ready = self.batch
+        self.batch = {}
+        self.batch_bytes = 0
+        self.batch_started = None
+        return ready
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running and (self.batch_started is None or time.monotonic() - self.batch_started < self.flush_interval):
+                    self.condition.wait(None if self.batch_started is None else self.flush_interval - (time.monotonic() - self.batch_started))
+                if not self.running:
+                    return
+                ready = self._take()
+            self._upload(ready)
+
+    def _upload(self, batch):
+        # Batches are independent, so several may upload at once on pooled connections
+        staging_dir = tempfile.mkdtemp(prefix="labyrinth-batch-", dir=self.staging_root)
+        started = time.perf_counter()
+        size = 0
+        error = None
+        try:
+            for name, (file_path, _) in batch.items():
+                size += os.path.getsize(file_path)
+                try:
+                    os.link(file_path, os.path.join(staging_dir, name))
+                except OSError:
+                    shutil.copy2(file_path, os.path.join(staging_dir, name))
+            names = ", ".join(quote(name) for name in batch)
+            for attempt in range(self.retries + 1):
+                try:
+                    # Ciphertext doesn't compress, and keeping the names unchanged lets COPY INTO list them
+                    self.pool.execute(f"PUT {quote('file://' + staging_dir + '/*')} {self.stage}/ AUTO_COMPRESS=FALSE")
+                    self.pool.execute(f"COPY INTO {self.table} FROM {self.stage}/ FILES=({names}) FILE_FORMAT={self.file_format}")
+                    error = None
+                    break
+                except Exception as e:
+                    error = e
+                    if attempt < self.retries:
+                        delay = self.retry_delay * 2 ** attempt
+                        logging.warning(f"Error uploading batch of {len(batch)} files to Snowflake, retrying in {delay:.0f}s: {str(e)}")
+                        time.sleep(delay)
+        except Exception as e:
+            # Staging failed, e.g. a file was removed before its batch went out
+            error = e
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        with self.condition:
+            if error is None:
+                self.batches_uploaded += 1
+                self.files_uploaded += len(batch)
+            else:
+                self.batches_failed += 1
+                self.files_failed += len(batch)
+        if error is None:
+            record_stage("uploaded", time.perf_counter() - started, size, len(batch))
+            logging.info(f"Uploaded batch of {len(batch)} files to {self.stage}")
+        else:
+            record_error("uploaded", len(batch))
+            logging.error(f"Error uploading batch of {len(batch)} files to Snowflake, giving up: {str(error)}; "
+                          f"files left on disk: {', '.join(file_path for file_path, _ in batch.values())}")
+        for file_path, done in batch.values():
+            if done:
+                try:
+                    done(error)
+                except Exception as e:
+                    logging.error(f"Error reporting upload of {file_path}: {str(e)}")
+
+    def flush(self):
+        with self.condition:
+            ready = self._take()
+        if ready:
+            self._upload(ready)
+
+    def close(self):
+        """
+        Stops the flush timer and uploads whatever is left in the current batch.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        self.flush()
+
+
+class UploadPipeline(object):
+    """
+    Upload stage with its own bounded queue and worker threads, so encrypt_file can
+    return as soon as the ciphertext is on disk instead of waiting on the WAN.
+    With asynchronous, upload is called as upload(file_path, done) and only hands the
+    file on, as BatchUploader.add does; the file counts as in flight until done(error)
+    reports the outcome, so the counts, lag and backpressure follow real uploads.
+    """
+
+    def __init__(self, upload, workers=4, max_queue=10000, high_water=0.8, asynchronous=False):
+        self.upload = upload
+        self.asynchronous = asynchronous
+        self.queue = queue.Queue()
+        self.max_queue = max_queue
+        self.high_water = int(max_queue * high_water)
+        self.lock = threading.Condition()
+        # Files queued or being uploaded; submit waits while max_queue are outstanding
+        self.outstanding = 0
+        self.in_flight = 0
+        self.uploaded = 0
+        self.failed = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.threads = []
+        REGISTRY.gauge("labyrinth_upload_queue_depth", "Encrypted files waiting for the upload stage", self.queue.qsize)
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name=f"UploadPipeline-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    @property
+    def backpressure(self):
+        """
+        True once the files not yet uploaded are past the high-water mark; callers may slow down.
+        """
+        return self.outstanding >= self.high_water
+
+    def submit(self, file_path, upload=None):
+        """
+        Queues file_path for upload, by upload if given instead of the pipeline's
+        upload function, which is then called as upload(file_path). Only blocks when
+        max_queue files are waiting or still uploading.
+        """
+        with self.lock:
+            while self.outstanding >= self.max_queue:
+                self.lock.wait()
+            self.outstanding += 1
+        self.queue.put((file_path, time.monotonic(), upload))
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                file_path, queued_at, upload = item
+                record_stage("upload_queued", time.monotonic() - queued_at)
+                with self.lock:
+                    self.in_flight += 1
+                if upload is None and self.asynchronous:
+                    try:
+                        self.upload(file_path, partial(self._done, file_path, queued_at))
+                    except Exception as e:
+                        # Not handed on, so done will never be called for it
+                        record_error("uploaded")
+                        logging.error(f"Error uploading {file_path} to Snowflake: {str(e)}")
+                        self._done(file_path, queued_at, e)
+                    continue
+                try:
+                    (upload or self.upload)(file_path)
+                    error = None
+                except Exception as e:
+                    error = e
+                    record_error("uploaded")
+                    logging.error(f"Error uploading {file_path} to Snowflake: {str(e)}")
+                self._done(file_path, queued_at, error)
+            finally:
+                self.queue.task_done()
+
+    def _done(self, file_path, queued_at, error):
+        lag = time.monotonic() - queued_at
+        with self.lock:
+            self.in_flight -= 1
+            self.outstanding -= 1
+            if error is not None:
+                self.failed += 1
+            else:
+                self.uploaded += 1
+                self.last_lag = lag
+                self.max_lag = max(self.max_lag, lag)
+                self.total_lag += lag
+            self.lock.notify_all()
+
+    def metrics(self):
+        """
+        Returns queue depth, upload counts and the lag from queueing to upload completion.
+        """
+        with self.lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "in_flight": self.in_flight,
+                "uploaded": self.uploaded,
+                "failed": self.failed,
+                "last_lag": self.last_lag,
+                "max_lag": self.max_lag,
+                "avg_lag": self.total_lag / self.uploaded if self.uploaded else 0.0,
+                "backpressure": self.outstanding >= self.high_water,
+            }
+
+    def close(self, timeout=None):
+        """
+        Waits for queued uploads to finish, then stops the workers. Asynchronous
+        uploads are waited for up to timeout seconds after the last file is handed on.
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        with self.lock:
+            self.lock.wait_for(lambda: self.outstanding == 0, timeout)
+        logging.info(f"Upload pipeline stopped: {self.metrics()}")
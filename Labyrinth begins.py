@@ -1,4 +1,10 @@
 from cryptography.fernet import Fernet
+from LabyrinthBulk import BulkEngine
+from LabyrinthDurable import set_durability
+from LabyrinthCompression import set_compression
+from LabyrinthKeys import load_key_ring
+from LabyrinthIndex import FileIndex, DECRYPTED, PENDING
+import argparse
 import os
 
 def generate_key():
@@ -16,30 +22,30 @@ def save_key(key, key_file):
 
 def load_key(key_file):
     """
-    Loads the encryption key from a file.
+    Loads the key ring from a key file (one key per line, newest last).
     """
-    with open(key_file, "rb") as f:
-        return f.read()
-
-def encrypt_file(key, file_path):
-    """
-    Encrypts a file using the given encryption key.
-    """
-    fernet = Fernet(key)
-    with open(file_path, "rb") as f:
-        data = f.read()
-    encrypted_data = fernet.encrypt(data)
-    with open(file_path + ".encrypted", "wb") as f:
-        f.write(encrypted_data)
-    os.remove(file_path)
+    return load_key_ring(key_file)
 
 def main():
+    parser = argparse.ArgumentParser(description="Encrypt the files in a directory that are new or still pending")
+    parser.add_argument("--workers", type=int, help="worker processes (default: every CPU core)")
+    args = parser.parse_args()
+
     # Define the directory containing files to encrypt
     directory = "/path/to/your/directory"
 
     # Define the file containing the encryption key
     key_file = "/path/to/your/keyfile.key"
 
+    # Define the file-state index (keep it outside the directory being encrypted)
+    index_file = "/path/to/your/labyrinth-index.sqlite"
+
+    # Define when ciphertext is fsynced: "none", "per-file" or "grouped" (batched across files)
+    durability = "grouped"
+
+    # Define the compression applied before encryption, off by default: None, "zlib", "zstd" or "lz4"
+    compression = None
+
     # Generate or load the encryption key
     if not os.path.exists(key_file):
         key = generate_key()
@@ -47,11 +53,14 @@ def main():
     else:
         key = load_key(key_file)
 
-    # Encrypt all files in the directory
-    for filename in os.listdir(directory):
-        file_path = os.path.join(directory, filename)
-        if os.path.isfile(file_path):
-            encrypt_file(key, file_path)
+    # Encrypt the files in the directory that are new since the last run or still pending
+    set_durability(durability)
+    set_compression(compression)
+    index = FileIndex(index_file)
+    paths = index.scan(directory, lambda file_path: not file_path.endswith(".encrypted"), (DECRYPTED, PENDING), recursive=False)
+    stats = BulkEngine(key, args.workers, index=index).encrypt_files(paths)
+    index.close()
+    print(f"Encrypted {stats}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,41 +1,36 @@
-from cryptography.fernet import Fernet
-import os
+from LabyrinthBulk import BulkEngine
+from LabyrinthCrawl import crawl
+from LabyrinthKeys import load_key_ring
+import argparse
 
 def load_key(key_file):
     """
-    Loads the encryption key from a file.
+    Loads the key ring from a key file (one key per line, newest last).
     """
-    with open(key_file, "rb") as f:
-        return f.read()
-
-def decrypt_file(key, encrypted_file):
-    """
-    Decrypts an encrypted file using the given encryption key.
-    """
-    fernet = Fernet(key)
-    with open(encrypted_file, "rb") as f:
-        encrypted_data = f.read()
-    decrypted_data = fernet.decrypt(encrypted_data)
-    original_file = encrypted_file[:-len(".encrypted")]
-    with open(original_file, "wb") as f:
-        f.write(decrypted_data)
-    os.remove(encrypted_file)
+    return load_key_ring(key_file)
 
 def main():
+    parser = argparse.ArgumentParser(description="Decrypt the encrypted files anywhere under a directory")
+    parser.add_argument("--workers", type=int, help="worker processes (default: every CPU core)")
+    args = parser.parse_args()
+
     # Define the directory containing encrypted files
     directory = "/path/to/your/directory"
 
     # Define the file containing the encryption key
     key_file = "/path/to/your/keyfile.key"
 
+    # Define paths or globs under the directory to leave alone, e.g. ["*/.git", "archive"]
+    ignore = []
+
     # Load the encryption key
     key = load_key(key_file)
 
-    # Decrypt all encrypted files in the directory
-    for filename in os.listdir(directory):
-        file_path = os.path.join(directory, filename)
-        if os.path.isfile(file_path) and filename.endswith(".encrypted"):
-            decrypt_file(key, file_path)
+    # Decrypt the encrypted files anywhere under the directory, starting on the first
+    # files while the rest of the tree is still being crawled
+    paths = crawl(directory, lambda file_path: file_path.endswith(".encrypted"), ignore)
+    stats = BulkEngine(key, args.workers).decrypt_files(paths)
+    print(f"Decrypted {stats}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,39 +1,50 @@
-import os
 import tkinter as tk
 from tkinter import filedialog, messagebox
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
-from cryptography.fernet import Fernet
+from LabyrinthBulk import encrypt_path, decrypt_path
+from LabyrinthDurable import is_temp_path
+from LabyrinthKeys import load_key_ring
+from LabyrinthEvents import EventCoalescer, QUIET_WINDOW
+from LabyrinthWorkers import WorkerPool, MAX_QUEUE
+from LabyrinthIndex import FileIndex, DEFAULT_INDEX_FILE, start_catch_up
 
 # EncryptionHandler class definition
 class EncryptionHandler(FileSystemEventHandler):
-    def __init__(self, key, trigger, mode):
+    def __init__(self, key, trigger, mode, quiet_window=QUIET_WINDOW, workers=None, pool_kind="thread", max_queue=MAX_QUEUE):
         super().__init__()
         self.key = key
-        self.fernet = Fernet(self.key)
         self.trigger = trigger
         self.mode = mode
+        self.pool = WorkerPool(self.handle_file, workers, max_queue, pool_kind)
+        self.coalescer = EventCoalescer(self.pool.submit, quiet_window) if trigger == "Modify" else None
 
     # Event handler for file creation
     def on_created(self, event):
         if not event.is_directory and self.trigger == "Create":
             file_path = event.src_path
-            if not file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
+            if not file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.pool.submit(file_path)
 
     # Event handler for file deletion
     def on_deleted(self, event):
         if not event.is_directory and self.trigger == "Delete":
             file_path = event.src_path
-            if file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
+            if file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.pool.submit(file_path)
 
     # Event handler for file modification
     def on_modified(self, event):
         if not event.is_directory and self.trigger == "Modify":
             file_path = event.src_path
-            if not file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
+            if not file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.coalescer.submit(file_path)
+
+    # Flush events still waiting in the coalescer
+    def close(self):
+        if self.coalescer:
+            self.coalescer.close()
+        self.pool.close()
 
     # Handle encryption for individual or group files
     def handle_file(self, file_path):
@@ -48,12 +59,7 @@ class EncryptionHandler(FileSystemEventHandler):
 
     # Encrypt a single file
     def encrypt_file(self, file_path):
-        with open(file_path, "rb") as f:
-            data = f.read()
-        encrypted_data = self.fernet.encrypt(data)
-        with open(file_path + ".encrypted", "wb") as f:
-            f.write(encrypted_data)
-        os.remove(file_path)
+        self.pool.run(encrypt_path, self.key, file_path)
 
     # Placeholder method for encrypting all files in a directory
     def encrypt_all_files(self):
@@ -61,33 +67,40 @@ class EncryptionHandler(FileSystemEventHandler):
 
 # DecryptionHandler class definition
 class DecryptionHandler(FileSystemEventHandler):
-    def __init__(self, key, trigger, mode):
+    def __init__(self, key, trigger, mode, quiet_window=QUIET_WINDOW, workers=None, pool_kind="thread", max_queue=MAX_QUEUE):
         super().__init__()
         self.key = key
-        self.fernet = Fernet(self.key)
         self.trigger = trigger
         self.mode = mode
+        self.pool = WorkerPool(self.handle_file, workers, max_queue, pool_kind)
+        self.coalescer = EventCoalescer(self.pool.submit, quiet_window) if trigger == "Modify" else None
 
     # Event handler for file creation
     def on_created(self, event):
         if not event.is_directory and self.trigger == "Create":
             file_path = event.src_path
-            if file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
+            if file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.pool.submit(file_path)
 
     # Event handler for file deletion
     def on_deleted(self, event):
         if not event.is_directory and self.trigger == "Delete":
             file_path = event.src_path
-            if not file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
+            if not file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.pool.submit(file_path)
 
     # Event handler for file modification
     def on_modified(self, event):
         if not event.is_directory and self.trigger == "Modify":
             file_path = event.src_path
-            if file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
+            if file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.coalescer.submit(file_path)
+
+    # Flush events still waiting in the coalescer
+    def close(self):
+        if self.coalescer:
+            self.coalescer.close()
+        self.pool.close()
 
     # Handle decryption for individual or group files
     def handle_file(self, file_path):
@@ -102,12 +115,7 @@ class DecryptionHandler(FileSystemEventHandler):
 
     # Decrypt a single file
     def decrypt_file(self, file_path):
-        with open(file_path, "rb") as f:
-            data = f.read()
-        decrypted_data = self.fernet.decrypt(data)
-        with open(file_path[:-len(".encrypted")], "wb") as f:
-            f.write(decrypted_data)
-        os.remove(file_path)
+        self.pool.run(decrypt_path, self.key, file_path)
 
     # Placeholder method for decrypting all files in a directory
     def decrypt_all_files(self):
@@ -167,6 +175,12 @@ class EncryptionApp:
         self.key_file = filedialog.askopenfilename()
         self.key_button.config(text="Selected Key File: " + self.key_file)
 
+    # Method to open the file-state index used for catch-up scans
+    def get_index(self):
+        if not hasattr(self, 'index'):
+            self.index = FileIndex(DEFAULT_INDEX_FILE)
+        return self.index
+
     # Method to start monitoring
     def start_monitoring(self):
         if hasattr(self, 'directory') and hasattr(self, 'key_file'):
@@ -175,6 +189,7 @@ class EncryptionApp:
             self.encrypt_observer = Observer()
             self.encrypt_observer.schedule(self.handler, self.directory, recursive=True)
             self.encrypt_observer.start()
+            start_catch_up(self.get_index(), self.directory, self.handler, "encrypt")
 
             self.encrypt_label.config(text="Handler Status: Running")
             self.start_button.config(state=tk.DISABLED)
@@ -187,6 +202,7 @@ class EncryptionApp:
         if hasattr(self, 'encrypt_observer'):
             self.encrypt_observer.stop()
             self.encrypt_observer.join()
+            self.handler.close()
 
             self.encrypt_label.config(text="Handler Status: Stopped")
             self.start_button.config(state=tk.NORMAL)
@@ -194,8 +210,7 @@ class EncryptionApp:
 
     # Method to load encryption key
     def load_key(self):
-        with open(self.key_file, "rb") as f:
-            return f.read()
+        return load_key_ring(self.key_file)
 
 # DecryptionApp class definition
 class DecryptionApp:
@@ -251,6 +266,12 @@ class DecryptionApp:
         self.key_file = filedialog.askopenfilename()
         self.key_button.config(text="Selected Key File: " + self.key_file)
 
+    # Method to open the file-state index used for catch-up scans
+    def get_index(self):
+        if not hasattr(self, 'index'):
+            self.index = FileIndex(DEFAULT_INDEX_FILE)
+        return self.index
+
     # Method to start monitoring
     def start_monitoring(self):
         if hasattr(self, 'directory') and hasattr(self, 'key_file'):
@@ -259,6 +280,7 @@ class DecryptionApp:
             self.decrypt_observer = Observer()
             self.decrypt_observer.schedule(self.handler, self.directory, recursive=True)
             self.decrypt_observer.start()
+            start_catch_up(self.get_index(), self.directory, self.handler, "decrypt")
 
             self.decrypt_label.config(text="Handler Status: Running")
             self.start_button.config(state=tk.DISABLED)
@@ -271,6 +293,7 @@ class DecryptionApp:
         if hasattr(self, 'decrypt_observer'):
             self.decrypt_observer.stop()
             self.decrypt_observer.join()
+            self.handler.close()
 
             self.decrypt_label.config(text="Handler Status: Stopped")
             self.start_button.config(state=tk.NORMAL)
@@ -278,8 +301,7 @@ class DecryptionApp:
 
     # Method to load decryption key
     def load_key(self):
-        with open(self.key_file, "rb") as f:
-            return f.read()
+        return load_key_ring(self.key_file)
 
 # Main function to run the GUI
 def main():
@@ -1,8 +1,8 @@
 import os
 import time
-from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from cryptography.fernet import Fernet
+from LabyrinthEvents import SharedObserver
 
 class EncryptionHandler(FileSystemEventHandler):
     def __init__(self, key):
@@ -67,17 +67,17 @@ def main():
     encryption_handler = EncryptionHandler(key)
     decryption_handler = DecryptionHandler(key)
 
-    observer = Observer()
-    observer.schedule(encryption_handler, directory, recursive=True)
-    observer.schedule(decryption_handler, directory, recursive=True)
-    observer.start()
+    # One watch on the directory; each event is routed by suffix to exactly one handler
+    observer = SharedObserver()
+    observer.add(directory, "encrypt", "Create", encryption_handler.encrypt_file)
+    observer.add(directory, "decrypt", "Create", decryption_handler.decrypt_file)
 
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
-        observer.stop()
-    observer.join()
+        pass
+    observer.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,9 +1,9 @@
 import os
 import tkinter as tk
 from tkinter import filedialog, messagebox
-from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from cryptography.fernet import Fernet
+from LabyrinthEvents import SharedObserver
 
 class EncryptionHandler(FileSystemEventHandler):
     def __init__(self, key):
@@ -88,13 +88,10 @@ class EncryptionApp:
             self.encrypt_handler = EncryptionHandler(self.load_key())
             self.decrypt_handler = DecryptionHandler(self.load_key())
 
-            self.encrypt_observer = Observer()
-            self.encrypt_observer.schedule(self.encrypt_handler, self.directory, recursive=True)
-            self.encrypt_observer.start()
-
-            self.decrypt_observer = Observer()
-            self.decrypt_observer.schedule(self.decrypt_handler, self.directory, recursive=True)
-            self.decrypt_observer.start()
+            # One watch on the directory; new plaintext goes to encryption, new .encrypted files to decryption
+            self.observer = SharedObserver()
+            self.observer.add(self.directory, "encrypt", "Create", self.encrypt_handler.encrypt_file)
+            self.observer.add(self.directory, "decrypt", "Create", self.decrypt_handler.decrypt_file)
 
             self.encrypt_label.config(text="Encryption Handler Status: Running")
             self.decrypt_label.config(text="Decryption Handler Status: Running")
@@ -104,12 +101,8 @@ class EncryptionApp:
             messagebox.showerror("Error", "Please select a directory and a key file.")
 
     def stop_monitoring(self):
-        if hasattr(self, 'encrypt_observer') and hasattr(self, 'decrypt_observer'):
-            self.encrypt_observer.stop()
-            self.decrypt_observer.stop()
-
-            self.encrypt_observer.join()
-            self.decrypt_observer.join()
+        if hasattr(self, 'observer'):
+            self.observer.stop()
 
             self.encrypt_label.config(text="Encryption Handler Status: Stopped")
             self.decrypt_label.config(text="Decryption Handler Status: Stopped")
@@ -0,0 +1,390 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from cryptography.fernet import Fernet
+from LabyrinthBulk import BulkEngine, encrypt_path, decrypt_path
+from LabyrinthDurable import POLICIES, get_durability, set_durability
+from LabyrinthCompression import CODECS, get_compression, set_compression
+from LabyrinthCrawl import crawl
+from LabyrinthEvents import SharedObserver
+from LabyrinthPolling import TreeSnapshot, RACY_WINDOW_NS
+from LabyrinthStartup import measure_startup
+from LabyrinthStream import StreamCipher
+from LabyrinthWorkers import WorkerPool
+
+# resource is Unix only; peak RSS is reported as null elsewhere
+try:
+    import resource
+except ImportError:
+    resource = None
+
+KB = 1024
+MB = 1024 * KB
+GB = 1024 * MB
+
+# Scenario sizes for each preset; "full" covers multi-GB files, million-entry trees and large storms
+PRESETS = {
+    "quick": {
+        "file_sizes": [(KB, 200), (64 * KB, 100), (MB, 20), (16 * MB, 3)],
+        "trees": [("flat", 2000, 1), ("deep", 2000, 6)],
+        "storms": [1000],
+        "read_paths": [(16 * MB, 4), (256 * MB, 1)],
+        "startup_runs": 5,
+        "polling": [(20000, 4)],
+    },
+    "full": {
+        "file_sizes": [(KB, 10000), (64 * KB, 2000), (MB, 500), (64 * MB, 10), (GB, 2), (4 * GB, 1)],
+        "trees": [("flat", 100000, 1), ("deep", 1000000, 8)],
+        "storms": [10000, 100000],
+        "read_paths": [(64 * MB, 8), (GB, 2), (4 * GB, 1)],
+        "startup_runs": 20,
+        "polling": [(100000, 4), (1000000, 8)],
+    },
+}
+
+# Throughput metrics regress when they drop, latency and memory when they grow
+HIGHER_IS_BETTER = ("files_per_second", "mb_per_second")
+LOWER_IS_BETTER = ("p50_ms", "p99_ms", "peak_rss_mb", "import_ms")
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of this process and its worker processes in MB.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else KB
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(peak * scale / MB, 1)
+
+
+def write_file(file_path, size):
+    # Random data in 1 MB blocks, so multi-GB files don't need multi-GB of memory
+    block = os.urandom(min(size, MB))
+    with open(file_path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+
+
+def summarize(files, size, elapsed, latencies=None):
+    result = {
+        "files": files,
+        "bytes": size,
+        "elapsed": round(elapsed, 4),
+        "files_per_second": round(files / elapsed, 2) if elapsed else 0.0,
+        "mb_per_second": round(size / MB / elapsed, 2) if elapsed else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    if latencies is not None:
+        result["p50_ms"] = round(percentile(latencies, 0.50) * 1000, 3) if latencies else None
+        result["p99_ms"] = round(percentile(latencies, 0.99) * 1000, 3) if latencies else None
+    return result
+
+
+def bench_file_size(key, work_dir, size, count):
+    """
+    Encrypts then decrypts count files of size bytes one at a time, timing each call.
+    """
+    paths = []
+    for i in range(count):
+        file_path = os.path.join(work_dir, f"file-{i}.bin")
+        write_file(file_path, size)
+        paths.append(file_path)
+    results = {}
+    for name, function in (("encrypt", encrypt_path), ("decrypt", decrypt_path)):
+        latencies = []
+        next_paths = []
+        started = time.perf_counter()
+        for file_path in paths:
+            call_started = time.perf_counter()
+            destination, _ = function(key, file_path)
+            latencies.append(time.perf_counter() - call_started)
+            next_paths.append(destination)
+        results[name] = summarize(count, size * count, time.perf_counter() - started, latencies)
+        paths = next_paths
+    return results
+
+
+def bench_read_path(key, work_dir, size, count):
+    """
+    Encrypts and decrypts the same files through buffered reads and through mmap,
+    so the cost of copying each segment out of the page cache shows up as the difference.
+    """
+    paths = []
+    for i in range(count):
+        file_path = os.path.join(work_dir, f"read-{i}.bin")
+        write_file(file_path, size)
+        paths.append(file_path)
+    results = {}
+    for name, threshold in (("buffered", None), ("mmap", 0)):
+        cipher = StreamCipher(key, mmap_threshold=threshold)
+        for direction in ("encrypt", "decrypt"):
+            latencies = []
+            started = time.perf_counter()
+            for file_path in paths:
+                call_started = time.perf_counter()
+                if direction == "encrypt":
+                    cipher.encrypt_file(file_path, file_path + ".encrypted")
+                else:
+                    cipher.decrypt_file(file_path + ".encrypted", file_path + ".decrypted")
+                latencies.append(time.perf_counter() - call_started)
+            results[f"{direction}-{name}"] = summarize(count, size * count, time.perf_counter() - started, latencies)
+            for file_path in paths:
+                for suffix in (".encrypted", ".decrypted") if direction == "decrypt" else ():
+                    os.remove(file_path + suffix)
+    return results
+
+
+def make_tree(root, entries, depth, fanout=10):
+    """
+    Creates entries small files spread over a tree depth directories deep, with
+    fanout subdirectories per level. depth 1 puts every file in root.
+    """
+    directories = [root]
+    for _ in range(depth - 1):
+        directories = [os.path.join(parent, f"d{i}") for parent in directories for i in range(fanout)]
+        if len(directories) >= entries:
+            break
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+    data = os.urandom(KB)
+    for i in range(entries):
+        with open(os.path.join(directories[i % len(directories)], f"f{i}.txt"), "wb") as f:
+            f.write(data)
+    return len(directories)
+
+
+def bench_tree(key, work_dir, shape, entries, depth, workers):
+    """
+    Times crawling a whole tree serially with os.walk and in parallel with crawl, then
+    the bulk encryption fed by a streaming crawl, as encrypt_all_files does.
+    """
+    root = os.path.join(work_dir, shape)
+    directories = make_tree(root, entries, depth)
+    started = time.perf_counter()
+    walked = sum(len(files) for _, _, files in os.walk(root))
+    walk_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    crawled = sum(1 for _ in crawl(root))
+    crawl_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    stats = BulkEngine(key, workers).encrypt_files(crawl(root))
+    result = summarize(stats.files, stats.bytes, time.perf_counter() - started)
+    result.update({"directories": directories, "walk_seconds": round(walk_seconds, 4), "crawl_seconds": round(crawl_seconds, 4),
+                   "errors": stats.errors, "missed": walked - crawled})
+    return result
+
+
+def bench_polling(work_dir, entries, depth, runs=5):
+    """
+    Times rescans of an unchanged tree by watchdog's PollingObserver snapshot and by
+    TreeSnapshot, with and without the per-file stats that catch in-place edits.
+    """
+    from watchdog.utils.dirsnapshot import DirectorySnapshot, DirectorySnapshotDiff
+    root = os.path.join(work_dir, f"polling-{entries}")
+    directories = make_tree(root, entries, depth)
+    # Directories changed within the racy window are listed on every scan; let the new tree age past it
+    time.sleep(RACY_WINDOW_NS / 10 ** 9)
+    results = {}
+    previous = DirectorySnapshot(root)
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(runs):
+        call_started = time.perf_counter()
+        snapshot = DirectorySnapshot(root)
+        DirectorySnapshotDiff(previous, snapshot)
+        previous = snapshot
+        latencies.append(time.perf_counter() - call_started)
+    results["watchdog"] = summarize(entries * runs, 0, time.perf_counter() - started, latencies)
+    for name, modifications in (("scandir", True), ("scandir-directories", False)):
+        snapshot = TreeSnapshot(root, modifications=modifications)
+        first = time.perf_counter()
+        snapshot.scan()
+        first = time.perf_counter() - first
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(runs):
+            call_started = time.perf_counter()
+            snapshot.scan()
+            latencies.append(time.perf_counter() - call_started)
+        results[name] = summarize(entries * runs, 0, time.perf_counter() - started, latencies)
+        results[name]["first_scan_seconds"] = round(first, 4)
+        snapshot.close()
+    for result in results.values():
+        result["directories"] = directories
+    return results
+
+
+def bench_event_storm(key, work_dir, count, workers, timeout):
+    """
+    Creates count files as fast as possible under a watched directory and measures
+    the time from each file being written to its ciphertext being on disk.
+    """
+    root = os.path.join(work_dir, f"storm-{count}")
+    staging = os.path.join(work_dir, f"storm-{count}-staging")
+    os.makedirs(root)
+    os.makedirs(staging)
+    written = {}
+    finished = {}
+    done = threading.Condition()
+
+    def handle(file_path):
+        encrypt_path(key, file_path)
+        with done:
+            finished[file_path] = time.perf_counter()
+            done.notify()
+
+    pool = WorkerPool(handle, workers)
+    observer = SharedObserver()
+    observer.add(root, "encrypt", "Create", pool.submit)
+    data = os.urandom(KB)
+    started = time.perf_counter()
+    for i in range(count):
+        # Written outside the watch and renamed in, so the handler never sees a partial file
+        staged_path = os.path.join(staging, f"event-{i}.txt")
+        file_path = os.path.join(root, f"event-{i}.txt")
+        with open(staged_path, "wb") as f:
+            f.write(data)
+        written[file_path] = time.perf_counter()
+        os.rename(staged_path, file_path)
+    with done:
+        done.wait_for(lambda: len(finished) >= count, timeout)
+    elapsed = time.perf_counter() - started
+    observer.stop()
+    pool.close()
+    latencies = [finished[file_path] - written[file_path] for file_path in finished if file_path in written]
+    result = summarize(len(latencies), len(latencies) * KB, elapsed, latencies)
+    result["missed"] = count - len(latencies)
+    return result
+
+
+def run(preset, work_dir=None, workers=None, timeout=300):
+    key = Fernet.generate_key()
+    config = PRESETS[preset]
+    results = {}
+    for size, count in config["file_sizes"]:
+        scratch = tempfile.mkdtemp(prefix="labyrinth-bench-", dir=work_dir)
+        try:
+            for name, result in bench_file_size(key, scratch, size, count).items():
+                results[f"{name}/{size // KB}KB"] = result
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+    for size, count in config["read_paths"]:
+        scratch = tempfile.mkdtemp(prefix="labyrinth-bench-", dir=work_dir)
+        try:
+            for name, result in bench_read_path(key, scratch, size, count).items():
+                results[f"read/{name}/{size // KB}KB"] = result
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+    for shape, entries, depth in config["trees"]:
+        scratch = tempfile.mkdtemp(prefix="labyrinth-bench-", dir=work_dir)
+        try:
+            results[f"tree/{shape}-{entries}"] = bench_tree(key, scratch, shape, entries, depth, workers)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+    for entries, depth in config["polling"]:
+        scratch = tempfile.mkdtemp(prefix="labyrinth-bench-", dir=work_dir)
+        try:
+            for name, result in bench_polling(scratch, entries, depth).items():
+                results[f"polling/{name}-{entries}"] = result
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+    for count in config["storms"]:
+        scratch = tempfile.mkdtemp(prefix="labyrinth-bench-", dir=work_dir)
+        try:
+            results[f"events/storm-{count}"] = bench_event_storm(key, scratch, count, workers, timeout)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+    # Fresh-interpreter startup of each entry point; only the timings are compared
+    for name, result in measure_startup(runs=config["startup_runs"]).items():
+        results[f"startup/{name}"] = {metric: result[metric] for metric in ("runs", "p50_ms", "p99_ms", "import_ms")}
+    return {
+        "meta": {
+            "preset": preset,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "durability": get_durability()[0],
+            "compression": get_compression()[0],
+        },
+        "results": results,
+    }
+
+
+def compare(baseline, report, tolerance):
+    """
+    Returns a list of (scenario, metric, baseline value, new value) for every metric that
+    is more than tolerance (a fraction) worse than the baseline.
+    """
+    regressions = []
+    for scenario, result in report["results"].items():
+        before = baseline["results"].get(scenario)
+        if not before:
+            continue
+        for metric, value in result.items():
+            old = before.get(metric)
+            if value is None or not old:
+                continue
+            if (metric in HIGHER_IS_BETTER and value < old * (1 - tolerance)) or (metric in LOWER_IS_BETTER and value > old * (1 + tolerance)):
+                regressions.append((scenario, metric, old, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Labyrinth encryption, bulk sweeps and event handling")
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="quick")
+    parser.add_argument("--output", default="labyrinth-bench.json", help="file the JSON results are written to")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed slowdown before a metric counts as a regression")
+    parser.add_argument("--work-dir", help="directory scratch files are created in")
+    parser.add_argument("--workers", type=int, help="worker count for bulk and event scenarios")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for an event storm to drain")
+    parser.add_argument("--durability", choices=POLICIES, help="output durability policy to benchmark under")
+    parser.add_argument("--compression", choices=sorted(CODECS), help="compress files before encrypting them")
+    args = parser.parse_args()
+    if args.durability:
+        set_durability(args.durability)
+    if args.compression:
+        set_compression(args.compression)
+
+    report = run(args.preset, args.work_dir, args.workers, args.timeout)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    for scenario, result in report["results"].items():
+        latency = f", p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms" if result.get("p99_ms") is not None else ""
+        if "files_per_second" not in result:
+            print(f"{scenario}: {latency[2:]}, imports {result['import_ms']} ms")
+            continue
+        print(f"{scenario}: {result['files_per_second']} files/s, {result['mb_per_second']} MB/s{latency}")
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.tolerance)
+        for scenario, metric, old, new in regressions:
+            print(f"REGRESSION {scenario} {metric}: {old} -> {new}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import logging
+import os
+import time
+from LabyrinthKeys import KeyRing
+from LabyrinthIndex import ENCRYPTED, DECRYPTED, new_digest
+from LabyrinthDurable import commit, temp_path, get_durability, set_durability
+from LabyrinthCompression import get_compression, set_compression
+
+# Number of files handed to a worker process in one go
+SHARD_SIZE = 64
+
+# Per-process key rings, so each worker builds one StreamCipher per key and reuses it
+_ciphers = {}
+
+
+def get_cipher(key):
+    """
+    Returns this process's cached KeyRing for key, a KeyRing or a single raw key.
+    """
+    cipher = _ciphers.get(key)
+    if cipher is None:
+        cipher = _ciphers[key] = key if isinstance(key, KeyRing) else KeyRing([key])
+    return cipher
+
+
+def _init_worker(key, durability, window, compression, level):
+    get_cipher(key)
+    set_durability(durability, window)
+    set_compression(compression, level)
+
+
+def encrypt_path(key, file_path, pending=None):
+    """
+    Encrypts file_path to file_path + ".encrypted" and removes the plaintext once the
+    ciphertext is committed. Returns the encrypted path and the plaintext content hash.
+    With pending (a list), the commit is queued on it instead of waited for.
+    """
+    digest = new_digest()
+    encrypted_path = file_path + ".encrypted"
+    staged = temp_path(encrypted_path)
+    get_cipher(key).encrypt_file(file_path, staged, digest)
+    commit(staged, encrypted_path, file_path, pending)
+    return encrypted_path, digest.hexdigest()
+
+
+def decrypt_path(key, file_path, pending=None):
+    """
+    Decrypts a ".encrypted" file back to its original name and removes the ciphertext
+    once the plaintext is committed. Returns the decrypted path and the plaintext content hash.
+    """
+    digest = new_digest()
+    decrypted_path = file_path[:-len(".encrypted")]
+    staged = temp_path(decrypted_path)
+    get_cipher(key).decrypt_file(file_path, staged, digest)
+    commit(staged, decrypted_path, file_path, pending)
+    return decrypted_path, digest.hexdigest()
+
+
+def _run_shard(function, key, paths):
+    files = size = errors = 0
+    done = []
+    # Commits are queued while the rest of the shard is encrypted, then waited for together
+    staged = []
+    pending = []
+    for file_path in paths:
+        try:
+            file_size = os.path.getsize(file_path)
+            destination, content_hash = function(key, file_path, pending)
+            staged.append((file_path, destination, content_hash, file_size, pending[-1]))
+        except Exception as e:
+            errors += 1
+            logging.error(f"Error processing file {file_path}: {str(e)}")
+    for file_path, destination, content_hash, file_size, handle in staged:
+        try:
+            handle.wait()
+            files += 1
+            size += file_size
+            done.append((file_path, destination, content_hash))
+        except Exception as e:
+            errors += 1
+            logging.error(f"Error committing file {destination}: {str(e)}")
+    return files, size, errors, done
+
+
+def _encrypt_shard(key, paths):
+    return _run_shard(encrypt_path, key, paths)
+
+
+def _decrypt_shard(key, paths):
+    return _run_shard(decrypt_path, key, paths)
+
+
+def shard(paths, shard_size=SHARD_SIZE):
+    """
+    Splits an iterable of paths into lists of at most shard_size paths.
+    """
+    batch = []
+    for path in paths:
+        batch.append(path)
+        if len(batch) >= shard_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class BulkStats(object):
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def add(self, files, size, errors):
+        self.files += files
+        self.bytes += size
+        self.errors += errors
+
+    @property
+    def files_per_second(self):
+        return self.files / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def mb_per_second(self):
+        return self.bytes / (1024 * 1024) / self.elapsed if self.elapsed else 0.0
+
+    def eta(self, total):
+        """
+        Seconds left until total files are done at the rate so far, or None while unknown.
+        """
+        if total is None or not self.files_per_second:
+            return None
+        return max(0, total - self.files - self.errors) / self.files_per_second
+
+    def __str__(self):
+        return (f"{self.files} files, {self.bytes / (1024 * 1024):.1f} MB in {self.elapsed:.2f}s "
+                f"({self.files_per_second:.1f} files/s, {self.mb_per_second:.1f} MB/s, {self.errors} errors)")
+
+
+class BulkEngine(object):
+    def __init__(self, key, workers=None, shard_size=SHARD_SIZE, index=None, progress=None):
+        self.key = key
+        self.workers = workers or os.cpu_count() or 1
+        self.shard_size = shard_size
+        self.index = index
+        # Called as progress(stats, total) from the sweeping thread when it starts and after
+        # every shard; total is the number of paths, or None when they come from an iterator
+        self.progress = progress
+
+    def _run(self, shard_function, paths, state):
+        # multiprocessing is only loaded by callers that actually run a bulk sweep
+        from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+        stats = BulkStats()
+        total = len(paths) if hasattr(paths, "__len__") else None
+        start = time.monotonic()
+        if self.progress:
+            self.progress(stats, total)
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(self.key, *get_durability(), *get_compression())) as executor:
+            # paths may be a crawl still in progress, so shards are submitted as they fill
+            # and only a few are kept in flight, with results collected in between
+            running = set()
+            for batch in shard(paths, self.shard_size):
+                if self.index:
+                    self.index.mark_pending(batch)
+                running.add(executor.submit(shard_function, self.key, batch))
+                if len(running) >= self.workers * 2:
+                    finished, running = wait(running, return_when=FIRST_COMPLETED)
+                    self._collect(finished, stats, state, start, total)
+            while running:
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                self._collect(finished, stats, state, start, total)
+        stats.elapsed = time.monotonic() - start
+        return stats
+
+    def _collect(self, futures, stats, state, start, total):
+        for future in futures:
+            files, size, errors, done = future.result()
+            stats.add(files, size, errors)
+            if self.index:
+                self.index.moved(done, state)
+            if self.progress:
+                stats.elapsed = time.monotonic() - start
+                self.progress(stats, total)
+
+    def encrypt_files(self, paths):
+        """
+        Encrypts every path across the worker pool and returns the aggregate BulkStats.
+        Files that fail stay pending in the index, if there is one, for the next sweep.
+        """
+        stats = self._run(_encrypt_shard, paths, ENCRYPTED)
+        logging.info(f"Bulk encryption with {self.workers} workers: {stats}")
+        return stats
+
+    def decrypt_files(self, paths):
+        """
+        Decrypts every path across the worker pool and returns the aggregate BulkStats.
+        """
+        stats = self._run(_decrypt_shard, paths, DECRYPTED)
+        logging.info(f"Bulk decryption with {self.workers} workers: {stats}")
+        return stats
@@ -0,0 +1,225 @@
+import time
+import zlib
+from LabyrinthMetrics import REGISTRY, record_stage
+
+# zstd and lz4 are optional; without their packages only zlib is available
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Codec IDs recorded in the container header; 0 means the segments hold plain data
+NO_COMPRESSION = 0
+
+# Codec used for new files (None disables compression) and its level (None uses the codec default)
+COMPRESSION = None
+COMPRESSION_LEVEL = None
+
+# Files smaller than this aren't worth the probe or the codec framing
+MIN_COMPRESS_SIZE = 1024
+
+# The probe compresses PROBE_SAMPLES blocks of PROBE_SAMPLE_SIZE bytes spread through the file
+# with fast zlib and skips compression unless they shrink to at most PROBE_RATIO of their size
+PROBE_SAMPLES = 4
+PROBE_SAMPLE_SIZE = 64 * 1024
+PROBE_RATIO = 0.9
+
+# Largest chunk a decompressor yields at a time, where the codec lets it be bounded
+DECOMPRESS_CHUNK = 4 * 1024 * 1024
+
+COMPRESSION_FILES = REGISTRY.counter("labyrinth_compression_files_total", "Files by compression probe result", label="result")
+
+
+class ZlibCodec(object):
+    name = "zlib"
+    codec_id = 1
+    default_level = 1
+    available = True
+
+    def compress(self, chunks, level):
+        compressor = zlib.compressobj(level)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def decompress(self, chunks):
+        decompressor = zlib.decompressobj()
+        for chunk in chunks:
+            while chunk:
+                data = decompressor.decompress(chunk, DECOMPRESS_CHUNK)
+                if data:
+                    yield data
+                chunk = decompressor.unconsumed_tail
+        data = decompressor.flush()
+        if data:
+            yield data
+
+
+class ZstdCodec(object):
+    name = "zstd"
+    codec_id = 2
+    default_level = 3
+    available = zstandard is not None
+
+    def compress(self, chunks, level):
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def decompress(self, chunks):
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        for chunk in chunks:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+
+
+class Lz4Codec(object):
+    name = "lz4"
+    codec_id = 3
+    default_level = 0
+    available = lz4 is not None
+
+    def compress(self, chunks, level):
+        compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        yield compressor.begin()
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def decompress(self, chunks):
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        for chunk in chunks:
+            data = decompressor.decompress(chunk, DECOMPRESS_CHUNK)
+            if data:
+                yield data
+            while not decompressor.needs_input and not decompressor.eof:
+                data = decompressor.decompress(b"", DECOMPRESS_CHUNK)
+                if data:
+                    yield data
+
+
+CODECS = {codec.name: codec for codec in (ZlibCodec(), ZstdCodec(), Lz4Codec())}
+CODEC_IDS = {codec.codec_id: codec for codec in CODECS.values()}
+
+
+def set_compression(name, level=None):
+    """
+    Sets the codec new files are compressed with in this process, or None to stop compressing.
+    """
+    global COMPRESSION, COMPRESSION_LEVEL
+    if name is not None:
+        codec = CODECS.get(name)
+        if codec is None:
+            raise ValueError(f"Unknown compression codec {name}")
+        if not codec.available:
+            raise ValueError(f"Compression codec {name} needs the {'zstandard' if name == 'zstd' else name} package")
+    COMPRESSION = name
+    COMPRESSION_LEVEL = level
+
+
+def get_compression():
+    return COMPRESSION, COMPRESSION_LEVEL
+
+
+def get_codec(codec_id):
+    """
+    Returns the codec for a codec ID read from a container header.
+    """
+    codec = CODEC_IDS.get(codec_id)
+    if codec is None:
+        raise ValueError(f"Unknown compression codec ID {codec_id}")
+    if not codec.available:
+        raise ValueError(f"Container is compressed with {codec.name}, which isn't installed")
+    return codec
+
+
+def probe_ratio(src, size):
+    """
+    Estimates how far the open file src compresses, as compressed / original size,
+    from a few samples spread through it. Leaves src at the start of the file.
+    """
+    if size <= PROBE_SAMPLES * PROBE_SAMPLE_SIZE:
+        offsets, length = [0], size
+    else:
+        step = (size - PROBE_SAMPLE_SIZE) // (PROBE_SAMPLES - 1)
+        offsets, length = [i * step for i in range(PROBE_SAMPLES)], PROBE_SAMPLE_SIZE
+    original = compressed = 0
+    for offset in offsets:
+        src.seek(offset)
+        sample = src.read(length)
+        original += len(sample)
+        compressed += len(zlib.compress(sample, 1))
+    src.seek(0)
+    return compressed / original if original else 1.0
+
+
+def choose_codec(src, size):
+    """
+    Returns the codec ID to compress the open file src with: the configured codec if
+    the file is large enough and the probe says it compresses, otherwise NO_COMPRESSION.
+    Media, archives and other already compressed files fail the probe.
+    """
+    if COMPRESSION is None or size < MIN_COMPRESS_SIZE:
+        return NO_COMPRESSION
+    if probe_ratio(src, size) > PROBE_RATIO:
+        COMPRESSION_FILES.inc("skipped")
+        return NO_COMPRESSION
+    COMPRESSION_FILES.inc("compressed")
+    return CODECS[COMPRESSION].codec_id
+
+
+def compress_chunks(chunks, codec_id, level=None, digest=None):
+    """
+    Compresses an iterator of plaintext chunks with the given codec, updating digest
+    with the plaintext on the way through.
+    """
+    codec = get_codec(codec_id)
+    chunks = iter(chunks)
+    if level is None:
+        level = COMPRESSION_LEVEL if COMPRESSION == codec.name and COMPRESSION_LEVEL is not None else codec.default_level
+    compressed = 0
+    # Time spent pulling plaintext from upstream is taken out of the compression time
+    elapsed = upstream = 0.0
+
+    def plaintext():
+        nonlocal upstream
+        while True:
+            started = time.perf_counter()
+            chunk = next(chunks, None)
+            upstream += time.perf_counter() - started
+            if chunk is None:
+                return
+            if digest is not None:
+                digest.update(chunk)
+            yield chunk
+
+    output = codec.compress(plaintext(), level)
+    while True:
+        started = time.perf_counter()
+        data = next(output, None)
+        elapsed += time.perf_counter() - started
+        if data is None:
+            break
+        compressed += len(data)
+        yield data
+    record_stage("compressed", elapsed - upstream, compressed)
+
+
+def decompress_chunks(chunks, codec_id):
+    """
+    Decompresses an iterator of compressed chunks with the given codec.
+    """
+    return get_codec(codec_id).decompress(chunks)
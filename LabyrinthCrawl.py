@@ -0,0 +1,116 @@
+import logging
+import os
+import queue
+import threading
+from LabyrinthDurable import is_temp_path
+from LabyrinthGroups import GroupMatcher
+
+# Threads listing directories. scandir spends its time in syscalls that release the GIL,
+# so a handful of threads keeps an SSD busy; network mounts benefit from more
+CRAWL_WORKERS = 8
+
+# Found files are handed over in batches of up to CRAWL_BATCH paths, at most CRAWL_BUFFER
+# batches ahead of the consumer, so a crawl that outruns the crypto doesn't hold a whole
+# tree's paths in memory
+CRAWL_BATCH = 1000
+CRAWL_BUFFER = 100
+
+_DONE = object()
+
+
+def crawl(root, select=None, ignore=None, workers=CRAWL_WORKERS, follow_symlinks=False):
+    """
+    Yields the files under root, in no particular order, as a pool of threads finds
+    them, so callers can start on the first files while the rest of the tree is listed.
+    select(file_path) filters files. ignore is a list of paths and globs, relative to
+    root, taken the way GroupMatcher takes group paths; ignored directories aren't
+    descended into. Symlinks are only followed with follow_symlinks, and then each
+    directory is listed once, so symlink loops end. Staged temp files are skipped.
+    """
+    root = os.path.abspath(root)
+    matcher = GroupMatcher(ignore, root) if ignore else None
+    directories = queue.Queue()
+    found = queue.Queue(CRAWL_BUFFER)
+    stop = threading.Event()
+    lock = threading.Lock()
+    # Directories queued or being listed; the worker that takes it to zero ends the crawl
+    pending = [1]
+    visited = set()
+
+    def put(item):
+        # The consumer may stop reading at any point, so never block on it for good
+        while not stop.is_set():
+            try:
+                found.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def first_visit(path):
+        st = os.stat(path)
+        with lock:
+            if (st.st_dev, st.st_ino) in visited:
+                return False
+            visited.add((st.st_dev, st.st_ino))
+            return True
+
+    def list_directory(path):
+        batch = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if stop.is_set():
+                    return
+                try:
+                    if entry.is_dir(follow_symlinks=follow_symlinks):
+                        if matcher and matcher.match(entry.path):
+                            continue
+                        if follow_symlinks and not first_visit(entry.path):
+                            continue
+                        with lock:
+                            pending[0] += 1
+                        directories.put(entry.path)
+                    elif entry.is_file(follow_symlinks=follow_symlinks):
+                        file_path = entry.path
+                        if is_temp_path(file_path) or (matcher and matcher.match(file_path)) or (select and not select(file_path)):
+                            continue
+                        batch.append(file_path)
+                        if len(batch) >= CRAWL_BATCH:
+                            put(batch)
+                            batch = []
+                except OSError as e:
+                    logging.warning(f"Error reading {entry.path}: {str(e)}")
+        if batch:
+            put(batch)
+
+    def work():
+        while True:
+            path = directories.get()
+            if path is _DONE:
+                return
+            try:
+                if not stop.is_set():
+                    list_directory(path)
+            except OSError as e:
+                logging.warning(f"Error listing directory {path}: {str(e)}")
+            with lock:
+                pending[0] -= 1
+                finished = pending[0] == 0
+            if finished:
+                put(_DONE)
+
+    if follow_symlinks:
+        first_visit(root)
+    threads = [threading.Thread(target=work, name=f"LabyrinthCrawl-{i}", daemon=True) for i in range(max(1, workers))]
+    for thread in threads:
+        thread.start()
+    directories.put(root)
+    try:
+        while True:
+            batch = found.get()
+            if batch is _DONE:
+                return
+            yield from batch
+    finally:
+        stop.set()
+        for _ in threads:
+            directories.put(_DONE)
@@ -0,0 +1,352 @@
+import argparse
+import configparser
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+from functools import partial
+from LabyrinthCompression import CODECS, set_compression
+from LabyrinthDurable import POLICIES, set_durability
+from LabyrinthEvents import SharedObserver, routes_encrypted
+from LabyrinthHandlers import EncryptionHandler, DecryptionHandler, TRIGGER_CHOICES, MODE_CHOICES
+from LabyrinthIndex import FileIndex, DEFAULT_INDEX_FILE, start_catch_up
+from LabyrinthKeys import load_key_ring
+from LabyrinthMetrics import start_metrics_server
+from LabyrinthPolling import ScandirPollingObserver, SCAN_INTERVAL, SCAN_WORKERS
+from LabyrinthWorkers import MAX_QUEUE, POOL_KINDS
+
+# Written by --example-config. Each [watch:<name>] section is one handler on one directory,
+# with the same triggers and modes as the GUI.
+EXAMPLE_CONFIG = """\
+[labyrinth]
+key_file = /etc/labyrinth/ring.key
+index_file = ~/.labyrinth/index.sqlite
+# none, per-file or grouped
+durability = grouped
+# none, zlib, zstd or lz4; files that don't compress are stored as they are
+compression = none
+# Prometheus scrape port, e.g. 9464; leave empty to disable. The endpoint has no authentication
+metrics_port =
+# native (inotify and the like) or polling (scandir snapshots: NFS/SMB mounts, or trees too big for inotify watches)
+observer = native
+# Seconds between scans and directory-reading threads, for polling
+scan_interval = 5
+scan_workers = 8
+# Log file; leave empty to log to stderr (the journal under systemd)
+log_file =
+log_level = INFO
+
+[watch:documents]
+directory = /srv/documents
+# encrypt or decrypt
+direction = encrypt
+# Create, Delete or Modify
+trigger = Create
+# Individual, Group or All
+mode = Individual
+# Comma-separated globs or paths relative to directory, for Group mode
+groups =
+workers = 4
+pool = thread
+
+# Example systemd unit:
+#   [Service]
+#   Type=notify
+#   ExecStart=/usr/bin/python3 /opt/labyrinth/LabyrinthDaemon.py --config /etc/labyrinth/labyrinth.ini
+#   ExecReload=/bin/kill -HUP $MAINPID
+#   TimeoutStopSec=300
+"""
+
+HANDLERS = {"encrypt": EncryptionHandler, "decrypt": DecryptionHandler}
+
+OBSERVER_CHOICES = ("native", "polling")
+
+
+def sd_notify(state):
+    """
+    Sends state to systemd when run as a Type=notify service; does nothing otherwise.
+    """
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address or not hasattr(socket, "AF_UNIX"):
+        return
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(state.encode(), address)
+    except OSError as e:
+        logging.warning(f"Error notifying systemd: {str(e)}")
+
+
+def _setting(value):
+    value = value.strip()
+    return None if value.lower() in ("", "none") else value
+
+
+def load_config(config_file):
+    """
+    Reads and validates the daemon config file. Returns the [labyrinth] settings and
+    the list of watches.
+    """
+    parser = configparser.ConfigParser(interpolation=None)
+    if not parser.read(config_file):
+        raise ValueError(f"Cannot read config file {config_file}")
+    if not parser.has_section("labyrinth"):
+        raise ValueError(f"{config_file} has no [labyrinth] section")
+    section = parser["labyrinth"]
+    settings = {
+        "key_file": os.path.expanduser(section.get("key_file", "")),
+        "index_file": os.path.expanduser(_setting(section.get("index_file", "")) or DEFAULT_INDEX_FILE),
+        "durability": section.get("durability", "grouped"),
+        "compression": _setting(section.get("compression", "")),
+        "metrics_port": int(section["metrics_port"]) if _setting(section.get("metrics_port", "")) else None,
+        "observer": section.get("observer", "native"),
+        "scan_interval": section.getfloat("scan_interval", fallback=SCAN_INTERVAL),
+        "scan_workers": section.getint("scan_workers", fallback=SCAN_WORKERS),
+        "log_file": _setting(section.get("log_file", "")),
+        "log_level": section.get("log_level", "INFO").upper(),
+    }
+    if not settings["key_file"]:
+        raise ValueError("key_file is required")
+    if settings["durability"] not in POLICIES:
+        raise ValueError(f"durability must be one of {', '.join(POLICIES)}")
+    if settings["compression"] is not None and settings["compression"] not in CODECS:
+        raise ValueError(f"compression must be none or one of {', '.join(CODECS)}")
+    if settings["observer"] not in OBSERVER_CHOICES:
+        raise ValueError(f"observer must be one of {', '.join(OBSERVER_CHOICES)}")
+    if settings["scan_interval"] <= 0 or settings["scan_workers"] < 1:
+        raise ValueError("scan_interval and scan_workers must be positive")
+    watches = []
+    routes = {}
+    for name in parser.sections():
+        if not name.startswith("watch:"):
+            continue
+        watch = parser[name]
+        config = {
+            "name": name[len("watch:"):],
+            "directory": os.path.abspath(os.path.expanduser(watch.get("directory", ""))),
+            "direction": watch.get("direction", "encrypt"),
+            "trigger": watch.get("trigger", "Create"),
+            "mode": watch.get("mode", "Individual"),
+            "groups": [group.strip() for group in watch.get("groups", "").split(",") if group.strip()],
+            "workers": watch.getint("workers", fallback=None),
+            "pool": watch.get("pool", "thread"),
+            "max_queue": watch.getint("max_queue", fallback=MAX_QUEUE),
+        }
+        if not os.path.isdir(config["directory"]):
+            raise ValueError(f"[{name}] directory {config['directory']} does not exist")
+        if config["direction"] not in HANDLERS:
+            raise ValueError(f"[{name}] direction must be encrypt or decrypt")
+        if config["trigger"] not in TRIGGER_CHOICES:
+            raise ValueError(f"[{name}] trigger must be one of {', '.join(TRIGGER_CHOICES)}")
+        if config["mode"] not in MODE_CHOICES:
+            raise ValueError(f"[{name}] mode must be one of {', '.join(MODE_CHOICES)}")
+        if config["mode"] == "Group" and not config["groups"]:
+            raise ValueError(f"[{name}] Group mode needs groups")
+        if config["pool"] not in POOL_KINDS:
+            raise ValueError(f"[{name}] pool must be one of {', '.join(POOL_KINDS)}")
+        if (config["workers"] is not None and config["workers"] < 1) or config["max_queue"] < 1:
+            raise ValueError(f"[{name}] workers and max_queue must be positive")
+        # The observer routes each trigger and file kind under a directory to a single handler
+        route = (config["directory"], config["trigger"], routes_encrypted(config["direction"], config["trigger"]))
+        if route in routes:
+            raise ValueError(f"[{name}] routes the same events as [watch:{routes[route]}]")
+        routes[route] = config["name"]
+        watches.append(config)
+    if not watches:
+        raise ValueError(f"{config_file} has no [watch:<name>] sections")
+    return settings, watches
+
+
+class Daemon(object):
+    """
+    Runs the encryption and decryption handlers from a config file without a GUI.
+    SIGTERM and SIGINT stop it, SIGHUP reloads the config. Either way the handlers
+    stop taking events first and then drain every queued job before closing.
+    """
+
+    def __init__(self, config_file):
+        self.config_file = config_file
+        self.observer = None
+        self.observer_settings = None
+        self.handlers = []
+        self.index = None
+        # Catch-up scans write to the index, so drain() stops and joins them before closing it
+        self.catch_ups = []
+        self.catch_up_stop = threading.Event()
+        self.metrics_server = None
+        self.metrics_port = None
+        self.wake = threading.Event()
+        self.stopping = False
+        self.reloading = False
+        # Last config that started cleanly, to fall back on when a reload fails
+        self.config = None
+
+    def start(self, settings, watches):
+        # Everything that can fail on a bad key or index file happens before the settings change
+        key = load_key_ring(settings["key_file"])
+        self.index = FileIndex(settings["index_file"])
+        set_durability(settings["durability"])
+        set_compression(settings["compression"])
+        self.start_metrics(settings["metrics_port"])
+        self.start_observer(settings, watches)
+        for watch in watches:
+            handler = HANDLERS[watch["direction"]](key, watch["trigger"], watch["mode"], watch["directory"], watch["groups"],
+                                                   workers=watch["workers"], pool_kind=watch["pool"], max_queue=watch["max_queue"],
+                                                   index=self.index)
+            # Listed before it is routed, so drain() closes its workers if routing fails
+            self.handlers.append(handler)
+            self.observer.add(watch["directory"], watch["direction"], handler.trigger, handler.submit)
+            self.catch_ups.append(start_catch_up(self.index, watch["directory"], handler, watch["direction"], self.catch_up_stop))
+            logging.info(f"Watch {watch['name']}: {watch['direction']} {watch['directory']} on {watch['trigger']} ({watch['mode']})")
+        self.config = (settings, watches)
+
+    def reload(self):
+        """
+        Restarts the watches from the config file. If they fail to start, the watches from
+        the previous config are restarted instead; returns False when even those fail.
+        """
+        try:
+            settings, watches = load_config(self.config_file)
+        except Exception as e:
+            logging.error(f"Not reloading, config is invalid: {str(e)}")
+            return True
+        previous = self.config
+        self.drain()
+        try:
+            self.start(settings, watches)
+            return True
+        except Exception as e:
+            logging.error(f"Error starting watches from {self.config_file}, restoring the previous config: {str(e)}")
+        # Closes whatever the failed start had already opened
+        self.drain()
+        try:
+            self.start(*previous)
+            return True
+        except Exception as e:
+            logging.error(f"Error restoring the previous config: {str(e)}")
+            self.drain()
+            return False
+
+    def start_metrics(self, port):
+        # A changed port opens the new endpoint before closing the old one, so a port that
+        # can't be bound fails the reload and leaves the old endpoint serving
+        if port == self.metrics_port:
+            return
+        server = start_metrics_server(port) if port else None
+        self.stop_metrics()
+        self.metrics_server = server
+        self.metrics_port = port
+
+    def stop_metrics(self):
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        self.metrics_server = None
+        self.metrics_port = None
+
+    def start_observer(self, settings, watches):
+        # Polling only stats every file when some watch needs in-place edits
+        modifications = any(watch["trigger"] == "Modify" for watch in watches)
+        observer_settings = (settings["observer"], settings["scan_interval"], settings["scan_workers"], modifications)
+        if self.observer is not None and observer_settings == self.observer_settings:
+            return
+        if self.observer is not None:
+            # Every watch was drained before a reload, so the old observer has nothing left to route
+            self.observer.stop()
+        if settings["observer"] == "polling":
+            self.observer = SharedObserver(partial(ScandirPollingObserver, interval=settings["scan_interval"],
+                                                   workers=settings["scan_workers"], modifications=modifications))
+        else:
+            self.observer = SharedObserver()
+        self.observer_settings = observer_settings
+
+    def drain(self):
+        """
+        Stops routing events to the handlers and ends the catch-up scans, then lets each
+        handler finish its queued jobs.
+        """
+        for handler in self.handlers:
+            self.observer.remove(handler.directory, handler.submit)
+        self.catch_up_stop.set()
+        for thread in self.catch_ups:
+            thread.join()
+        self.catch_ups = []
+        self.catch_up_stop = threading.Event()
+        for handler in self.handlers:
+            handler.close()
+        self.handlers = []
+        if self.index:
+            self.index.close()
+            self.index = None
+
+    def _signal(self, signum, frame):
+        # Only sets flags; the main thread does the work outside the signal handler
+        if signum == getattr(signal, "SIGHUP", None):
+            self.reloading = True
+        else:
+            self.stopping = True
+        self.wake.set()
+
+    def run(self):
+        failed = False
+        for name in ("SIGTERM", "SIGINT", "SIGHUP"):
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), self._signal)
+        self.start(*load_config(self.config_file))
+        sd_notify("READY=1")
+        logging.info(f"Labyrinth daemon running with {len(self.handlers)} watches")
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            if self.stopping:
+                break
+            if self.reloading:
+                self.reloading = False
+                sd_notify("RELOADING=1")
+                logging.info(f"Reloading {self.config_file}")
+                if not self.reload():
+                    # No watches left; exit non-zero so the service manager restarts the daemon
+                    failed = True
+                    break
+                sd_notify("READY=1")
+        sd_notify("STOPPING=1")
+        logging.info("Stopping: draining queued jobs")
+        self.drain()
+        if self.observer:
+            self.observer.stop()
+        self.stop_metrics()
+        logging.info("Labyrinth daemon stopped")
+        if failed:
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Labyrinth encryption and decryption watches without a GUI")
+    parser.add_argument("--config", help="config file with a [labyrinth] section and [watch:<name>] sections")
+    parser.add_argument("--check", action="store_true", help="validate the config file and exit")
+    parser.add_argument("--example-config", action="store_true", help="print an example config file and exit")
+    args = parser.parse_args()
+    if args.example_config:
+        sys.stdout.write(EXAMPLE_CONFIG)
+        return
+    if not args.config:
+        parser.error("--config is required")
+
+    try:
+        settings, watches = load_config(args.config)
+    except ValueError as e:
+        print(f"Invalid config: {e}", file=sys.stderr)
+        sys.exit(2)
+    if args.check:
+        print(f"{args.config}: {len(watches)} watches")
+        return
+    logging.basicConfig(filename=settings["log_file"], level=getattr(logging, settings["log_level"], logging.INFO),
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+    Daemon(args.config).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from LabyrinthMetrics import record_stage, record_error
+
+# Durability policies for finished output:
+#   none     - written to a temp file and renamed into place; no fsync
+#   per-file - the temp file is fsynced before the rename and its directory after it
+#   grouped  - as per-file, but the fsyncs of every file staged while the previous batch
+#              was committing (plus an optional GROUP_WINDOW seconds) are issued together,
+#              so the filesystem folds them into a few journal commits and one directory
+#              fsync covers every file renamed into it
+NONE = "none"
+PER_FILE = "per-file"
+GROUPED = "grouped"
+POLICIES = (NONE, PER_FILE, GROUPED)
+
+DURABILITY = GROUPED
+GROUP_WINDOW = 0.0
+GROUP_MAX_BATCH = 512
+GROUP_SYNC_THREADS = 16
+
+# Suffix of in-progress output; watchers and the index ignore these files
+TEMP_SUFFIX = ".labyrinth-tmp"
+
+
+def set_durability(policy, window=None):
+    """
+    Sets the durability policy for this process, and optionally the grouped commit window.
+    """
+    global DURABILITY, GROUP_WINDOW
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown durability policy {policy}")
+    DURABILITY = policy
+    if window is not None:
+        GROUP_WINDOW = window
+        if _committer is not None:
+            _committer.window = window
+
+
+def get_durability():
+    return DURABILITY, GROUP_WINDOW
+
+
+def is_temp_path(file_path):
+    return file_path.endswith(TEMP_SUFFIX)
+
+
+def temp_path(final_path):
+    """
+    Returns a unique hidden temp path next to final_path, on the same filesystem so
+    the rename into place is atomic.
+    """
+    directory, name = os.path.split(final_path)
+    return os.path.join(directory, f".{name}.{uuid.uuid4().hex[:12]}{TEMP_SUFFIX}")
+
+
+def fsync_file(file_path):
+    fd = os.open(file_path, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_directory(directory):
+    # Directories can't be opened for fsync on Windows; NTFS journals the rename itself
+    if os.name == "nt":
+        return
+    fd = os.open(directory or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def remove_source(file_path):
+    started = time.perf_counter()
+    try:
+        os.remove(file_path)
+    except Exception:
+        record_error("removed")
+        raise
+    record_stage("removed", time.perf_counter() - started)
+
+
+def _discard(staged):
+    try:
+        os.remove(staged)
+    except FileNotFoundError:
+        pass
+
+
+class PendingCommit(object):
+    """
+    Handle for a queued commit; wait() blocks until the output is durable and raises
+    if the commit failed.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+
+    def finish(self, error=None):
+        self.error = error
+        self.event.set()
+
+    def wait(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise TimeoutError("Timed out waiting for commit")
+        if self.error is not None:
+            raise self.error
+
+
+class GroupCommitter(object):
+    """
+    Background thread that commits staged files in batches: every file in a batch is
+    fsynced, renamed into place, then each distinct parent directory is fsynced once,
+    and only then are the source files removed. The fsyncs of a batch run concurrently;
+    issued one at a time each would wait for its own journal commit.
+    """
+
+    def __init__(self, window=None, max_batch=GROUP_MAX_BATCH, sync_threads=GROUP_SYNC_THREADS):
+        self.window = GROUP_WINDOW if window is None else window
+        self.max_batch = max_batch
+        self.syncer = ThreadPoolExecutor(max_workers=sync_threads, thread_name_prefix="GroupCommitSync")
+        self.batch = []
+        self.condition = threading.Condition()
+        self.batches = 0
+        self.files = 0
+        self.thread = threading.Thread(target=self._run, name="GroupCommitter", daemon=True)
+        self.thread.start()
+
+    def submit(self, staged, final, source=None):
+        pending = PendingCommit()
+        with self.condition:
+            self.batch.append((staged, final, source, pending))
+            self.condition.notify()
+        return pending
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.batch:
+                    self.condition.wait()
+                # Files staged while the last batch committed are already waiting; the window lets more join
+                deadline = time.monotonic() + self.window
+                while len(self.batch) < self.max_batch and time.monotonic() < deadline:
+                    self.condition.wait(deadline - time.monotonic())
+                batch = self.batch[:self.max_batch]
+                self.batch = self.batch[self.max_batch:]
+            self._commit(batch)
+
+    def _sync(self, function, path):
+        try:
+            function(path)
+        except Exception as e:
+            return e
+        return None
+
+    def _commit(self, batch):
+        started = time.perf_counter()
+        renamed = []
+        errors = self.syncer.map(self._sync, [fsync_file] * len(batch), [staged for staged, _, _, _ in batch])
+        for (staged, final, source, pending), error in zip(batch, errors):
+            try:
+                if error is not None:
+                    raise error
+                os.replace(staged, final)
+                renamed.append((final, source, pending))
+            except Exception as e:
+                _discard(staged)
+                pending.finish(e)
+        directories = list({os.path.dirname(final) for final, _, _ in renamed})
+        failed_directories = {}
+        for directory, error in zip(directories, self.syncer.map(self._sync, [fsync_directory] * len(directories), directories)):
+            if error is not None:
+                failed_directories[directory] = error
+        for final, source, pending in renamed:
+            error = failed_directories.get(os.path.dirname(final))
+            if error is None and source:
+                try:
+                    remove_source(source)
+                except Exception as e:
+                    error = e
+            pending.finish(error)
+        with self.condition:
+            self.batches += 1
+            self.files += len(batch)
+        record_stage("committed", time.perf_counter() - started, files=len(batch))
+
+
+_committer = None
+_committer_pid = None
+_committer_lock = threading.Lock()
+
+
+def get_committer():
+    """
+    Returns this process's group committer. Forked worker processes start their own,
+    since the parent's thread doesn't survive the fork.
+    """
+    global _committer, _committer_pid
+    with _committer_lock:
+        if _committer is None or _committer_pid != os.getpid():
+            _committer = GroupCommitter()
+            _committer_pid = os.getpid()
+        return _committer
+
+
+def commit(staged, final, source=None, pending=None, policy=None):
+    """
+    Moves the finished output staged into place at final under the durability policy,
+    then removes source. Blocks until done unless pending (a list) is given, in which
+    case a PendingCommit is appended to it for the caller to wait on later.
+    """
+    policy = policy or DURABILITY
+    if policy == GROUPED:
+        handle = get_committer().submit(staged, final, source)
+    else:
+        handle = PendingCommit()
+        try:
+            if policy == PER_FILE:
+                fsync_file(staged)
+            os.replace(staged, final)
+            if policy == PER_FILE:
+                fsync_directory(os.path.dirname(final))
+        except Exception:
+            _discard(staged)
+            raise
+        if source:
+            remove_source(source)
+        handle.finish()
+    if pending is None:
+        handle.wait()
+    else:
+        pending.append(handle)
+    return handle
+
+
+def atomic_write(final, data, source=None, policy=None):
+    """
+    Writes data to final through a temp file and commit(), so readers and crashes
+    never see a partially written final.
+    """
+    staged = temp_path(final)
+    try:
+        with open(staged, "wb") as f:
+            f.write(data)
+    except Exception:
+        _discard(staged)
+        raise
+    commit(staged, final, source, policy=policy)
@@ -0,0 +1,294 @@
+import heapq
+import logging
+import os
+import threading
+import time
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+from LabyrinthMetrics import record_stage, record_error
+from LabyrinthDurable import is_temp_path
+
+# Default quiet window in seconds a path must go without events before it is handled
+QUIET_WINDOW = 0.5
+
+# Handler trigger names, keyed by watchdog event type
+TRIGGERS = {"created": "Create", "deleted": "Delete", "modified": "Modify"}
+
+
+class EventCoalescer(object):
+    def __init__(self, callback, quiet_window=QUIET_WINDOW):
+        self.callback = callback
+        self.quiet_window = quiet_window
+        self.pending = {}
+        self.deadlines = []
+        self.condition = threading.Condition()
+        self.running = True
+        self.events_received = 0
+        self.events_coalesced = 0
+        self.jobs_emitted = 0
+        self.thread = threading.Thread(target=self._run, name="EventCoalescer", daemon=True)
+        self.thread.start()
+
+    def submit(self, file_path):
+        """
+        Records an event for file_path, pushing its deadline back by the quiet window.
+        """
+        deadline = time.monotonic() + self.quiet_window
+        with self.condition:
+            self.events_received += 1
+            if file_path in self.pending:
+                self.events_coalesced += 1
+            self.pending[file_path] = deadline
+            heapq.heappush(self.deadlines, (deadline, file_path))
+            self.condition.notify()
+
+    def _next_due(self):
+        # Drops heap entries superseded by a later event on the same path
+        while self.deadlines:
+            deadline, file_path = self.deadlines[0]
+            if self.pending.get(file_path) == deadline:
+                return deadline, file_path
+            heapq.heappop(self.deadlines)
+        return None, None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                deadline, file_path = self._next_due()
+                while self.running and (deadline is None or deadline > time.monotonic()):
+                    self.condition.wait(None if deadline is None else deadline - time.monotonic())
+                    deadline, file_path = self._next_due()
+                if not self.running:
+                    return
+                heapq.heappop(self.deadlines)
+                del self.pending[file_path]
+                self.jobs_emitted += 1
+            self._emit(file_path)
+
+    def _emit(self, file_path):
+        try:
+            self.callback(file_path)
+        except Exception as e:
+            logging.error(f"Error handling coalesced event for {file_path}: {str(e)}")
+
+    def stats(self):
+        with self.condition:
+            return {
+                "events_received": self.events_received,
+                "events_coalesced": self.events_coalesced,
+                "jobs_emitted": self.jobs_emitted,
+                "pending": len(self.pending),
+            }
+
+    def close(self, flush=True):
+        """
+        Stops the coalescer thread. With flush, paths still waiting out their
+        quiet window are handled immediately instead of being dropped.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+            remaining = list(self.pending)
+            self.pending.clear()
+            self.deadlines = []
+        self.thread.join()
+        if flush:
+            with self.condition:
+                self.jobs_emitted += len(remaining)
+            for file_path in remaining:
+                self._emit(file_path)
+        logging.info(f"Event coalescer stopped: {self.stats()}")
+
+
+class SweepScheduler(object):
+    """
+    Runs sweep, a full pass over a handler's tree, on its own thread. Requests made
+    while a sweep is running or waiting merge into a single pending sweep, so a burst
+    of events costs at most one extra pass instead of one pass per event.
+    """
+
+    def __init__(self, sweep, name="Sweep"):
+        self.sweep = sweep
+        self.condition = threading.Condition()
+        self.requested = False
+        self.sweeping = False
+        self.running = True
+        self.requests = 0
+        self.requests_merged = 0
+        self.sweeps_run = 0
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def request(self):
+        """
+        Asks for a sweep, merging into the pending one if there is one.
+        """
+        with self.condition:
+            self._request()
+
+    def _request(self):
+        # Called with the condition held
+        self.requests += 1
+        if self.requested:
+            self.requests_merged += 1
+        self.requested = True
+        self.condition.notify()
+
+    def follow_up(self):
+        """
+        Requests another sweep only while one is running or pending, and returns whether
+        it did. A file changed during a sweep may or may not have been seen by it; the
+        follow-up sweep picks it up either way.
+        """
+        with self.condition:
+            if not (self.sweeping or self.requested):
+                return False
+            self._request()
+            return True
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.requested:
+                    self.condition.wait()
+                if not self.requested:
+                    return
+                self.requested = False
+                self.sweeping = True
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.error(f"Error during sweep: {str(e)}")
+            with self.condition:
+                self.sweeping = False
+                self.sweeps_run += 1
+                self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "requests": self.requests,
+                "requests_merged": self.requests_merged,
+                "sweeps_run": self.sweeps_run,
+                "pending": self.requested,
+            }
+
+    def close(self):
+        """
+        Stops the scheduler thread once the running sweep and any pending one have finished.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        logging.info(f"Sweep scheduler stopped: {self.stats()}")
+
+
+def routes_encrypted(direction, trigger):
+    """
+    Returns True if a handler working in direction ("encrypt" or "decrypt") acts on
+    .encrypted paths for trigger. Encryption picks up created or modified plaintext
+    and deleted ciphertext; decryption the reverse.
+    """
+    return (direction == "encrypt") == (trigger == "Delete")
+
+
+class EventRouter(FileSystemEventHandler):
+    """
+    The one watchdog handler scheduled on a watched root. Each file event is looked up
+    once by trigger and .encrypted suffix and passed to the single callback routed there.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.routes = {}
+        self.lock = threading.Lock()
+        self.events_routed = 0
+        self.events_ignored = 0
+
+    def add(self, direction, trigger, callback):
+        route = (trigger, routes_encrypted(direction, trigger))
+        with self.lock:
+            if route in self.routes:
+                raise ValueError(f"A handler is already routed for {direction} on {trigger}")
+            self.routes[route] = callback
+
+    def remove(self, callback):
+        with self.lock:
+            self.routes = {route: routed for route, routed in self.routes.items() if routed != callback}
+
+    def __len__(self):
+        return len(self.routes)
+
+    def dispatch(self, event):
+        if event.is_directory:
+            return
+        if event.event_type == "moved":
+            # Output is renamed into place from a temp file, so a rename counts as the destination being created
+            trigger, file_path = "Create", event.dest_path
+        else:
+            trigger, file_path = TRIGGERS.get(event.event_type), event.src_path
+        if trigger is None or is_temp_path(file_path):
+            return
+        callback = self.routes.get((trigger, file_path.endswith(".encrypted")))
+        if callback is None:
+            self.events_ignored += 1
+            return
+        self.events_routed += 1
+        record_stage("received")
+        try:
+            callback(file_path)
+        except Exception as e:
+            record_error("received")
+            logging.error(f"Error routing {event.event_type} event for {file_path}: {str(e)}")
+
+
+class SharedObserver(object):
+    """
+    One watchdog observer for every handler in the process. Each watched root gets a
+    single recursive watch and EventRouter however many handlers share it, so encrypt
+    and decrypt handlers on the same tree cost one set of watch descriptors.
+    """
+
+    def __init__(self, observer_class=Observer):
+        self.observer = observer_class()
+        self.routers = {}
+        self.lock = threading.Lock()
+        self.started = False
+
+    def add(self, directory, direction, trigger, callback):
+        """
+        Routes trigger events for direction under directory to callback,
+        scheduling the root's watch and starting the observer on first use.
+        """
+        root = os.path.abspath(directory)
+        with self.lock:
+            if root not in self.routers:
+                router = EventRouter()
+                self.routers[root] = (router, self.observer.schedule(router, root, recursive=True))
+            self.routers[root][0].add(direction, trigger, callback)
+            if not self.started:
+                self.observer.start()
+                self.started = True
+
+    def remove(self, directory, callback):
+        """
+        Stops routing to callback, unscheduling the root's watch once nothing is routed there.
+        """
+        root = os.path.abspath(directory)
+        with self.lock:
+            if root not in self.routers:
+                return
+            router, watch = self.routers[root]
+            router.remove(callback)
+            if not router:
+                self.observer.unschedule(watch)
+                del self.routers[root]
+                logging.info(f"Stopped watching {root}: {router.events_routed} events routed, {router.events_ignored} ignored")
+
+    def stop(self):
+        with self.lock:
+            if self.started:
+                self.observer.stop()
+                self.observer.join()
+            self.routers = {}
@@ -0,0 +1,61 @@
+import fnmatch
+import os
+import re
+
+# Marks a trie node where a group path ends
+_END = None
+
+
+class GroupMatcher(object):
+    """
+    Group membership test compiled once from the configured group paths.
+    Plain entries are directories or files: a path is in the group if it is the entry
+    itself or lies below it, checked with a trie of path components in O(depth).
+    Entries containing *, ? or [ are globs, combined into a single regular expression.
+    Relative entries are taken relative to the monitored directory.
+    """
+
+    def __init__(self, groups, directory=None):
+        self.root = os.path.abspath(directory) if directory else None
+        self.trie = {}
+        patterns = []
+        for group in groups or []:
+            group = group.strip()
+            if not group:
+                continue
+            path = self._normalize(group)
+            if any(c in group for c in "*?["):
+                patterns.append(fnmatch.translate(path))
+            else:
+                node = self.trie
+                for part in self._parts(path):
+                    node = node.setdefault(part, {})
+                node[_END] = True
+        self.glob = re.compile("|".join(patterns)) if patterns else None
+
+    def _normalize(self, path):
+        if self.root and not os.path.isabs(path):
+            path = os.path.join(self.root, path)
+        return os.path.normcase(os.path.normpath(path))
+
+    def _parts(self, path):
+        return [part for part in path.split(os.sep) if part]
+
+    def __bool__(self):
+        return bool(self.trie) or self.glob is not None
+
+    def match(self, file_path):
+        """
+        Returns True if file_path is a configured group path, lies below one, or matches a group glob.
+        """
+        path = self._normalize(file_path)
+        node = self.trie
+        if _END in node:
+            return True
+        for part in self._parts(path):
+            node = node.get(part)
+            if node is None:
+                break
+            if _END in node:
+                return True
+        return bool(self.glob and self.glob.match(path))
@@ -0,0 +1,175 @@
+import logging
+from watchdog.events import FileSystemEventHandler
+from LabyrinthEvents import EventCoalescer, SweepScheduler, QUIET_WINDOW
+from LabyrinthWorkers import WorkerPool, MAX_QUEUE
+from LabyrinthGroups import GroupMatcher
+from LabyrinthBulk import BulkEngine, encrypt_path, decrypt_path
+from LabyrinthDurable import is_temp_path
+from LabyrinthCrawl import crawl
+from LabyrinthIndex import ENCRYPTED, DECRYPTED, PENDING
+
+# Triggers and modes the handlers accept
+TRIGGER_CHOICES = ("Create", "Delete", "Modify")
+MODE_CHOICES = ("Individual", "Group", "All")
+
+# EncryptionHandler class definition
+class EncryptionHandler(FileSystemEventHandler):
+    def __init__(self, key, trigger, mode, directory, groups, workers=None, quiet_window=QUIET_WINDOW, pool_kind="thread", max_queue=MAX_QUEUE, index=None, progress=None):
+        super().__init__()
+        self.key = key
+        self.trigger = trigger
+        self.mode = mode
+        self.pool = WorkerPool(self.handle_file, workers, max_queue, pool_kind)
+        self.coalescer = EventCoalescer(self.pool.submit, quiet_window) if trigger == "Modify" else None
+        self.directory = directory
+        self.groups = groups
+        self.group_matcher = GroupMatcher(groups, directory)
+        self.workers = workers
+        self.index = index
+        # Passed to BulkEngine so "All" sweeps can report their progress
+        self.progress = progress
+        # "All" mode sweeps the whole tree once, then handles events one file at a time
+        self.sweeps = SweepScheduler(self.encrypt_all_files, "EncryptSweep") if mode == "All" else None
+        if self.sweeps:
+            self.sweeps.request()
+
+    def on_created(self, event):
+        if not event.is_directory and self.trigger == "Create":
+            file_path = event.src_path
+            if not file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.pool.submit(file_path)
+
+    def on_deleted(self, event):
+        if not event.is_directory and self.trigger == "Delete":
+            file_path = event.src_path
+            if file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.pool.submit(file_path)
+
+    def on_modified(self, event):
+        if not event.is_directory and self.trigger == "Modify":
+            file_path = event.src_path
+            if not file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.coalescer.submit(file_path)
+
+    def submit(self, file_path):
+        # Called by the event router; Modify events wait out the quiet window first
+        (self.coalescer or self.pool).submit(file_path)
+
+    def close(self):
+        if self.coalescer:
+            self.coalescer.close()
+        self.pool.close()
+        if self.sweeps:
+            self.sweeps.close()
+
+    def handle_file(self, file_path):
+        try:
+            if self.mode == "Individual" or (self.mode == "Group" and self.is_group(file_path)):
+                self.encrypt_file(file_path)
+            elif self.mode == "All":
+                if self.trigger == "Delete":
+                    # A deletion leaves no file to handle, so it asks for another sweep
+                    self.sweeps.request()
+                elif not self.sweeps.follow_up():
+                    self.encrypt_file(file_path)
+        except Exception as e:
+            logging.error(f"Error encrypting file {file_path}: {str(e)}")
+
+    def is_group(self, file_path):
+        return self.group_matcher.match(file_path)
+
+    def encrypt_file(self, file_path):
+        if self.index:
+            self.index.mark_pending([file_path])
+        encrypted_path, content_hash = self.pool.run(encrypt_path, self.key, file_path)
+        if self.index:
+            self.index.moved([(file_path, encrypted_path, content_hash)], ENCRYPTED)
+
+    def encrypt_all_files(self):
+        if self.index:
+            paths = self.index.scan(self.directory, lambda file_path: not file_path.endswith(".encrypted"), (DECRYPTED, PENDING))
+        else:
+            # Streamed to the worker processes as the crawl finds them
+            paths = crawl(self.directory, lambda file_path: not file_path.endswith(".encrypted"))
+        BulkEngine(self.key, self.workers, index=self.index, progress=self.progress).encrypt_files(paths)
+
+# DecryptionHandler class definition
+class DecryptionHandler(FileSystemEventHandler):
+    def __init__(self, key, trigger, mode, directory, groups, workers=None, quiet_window=QUIET_WINDOW, pool_kind="thread", max_queue=MAX_QUEUE, index=None, progress=None):
+        super().__init__()
+        self.key = key
+        self.trigger = trigger
+        self.mode = mode
+        self.pool = WorkerPool(self.handle_file, workers, max_queue, pool_kind)
+        self.coalescer = EventCoalescer(self.pool.submit, quiet_window) if trigger == "Modify" else None
+        self.directory = directory
+        self.groups = groups
+        self.group_matcher = GroupMatcher(groups, directory)
+        self.workers = workers
+        self.index = index
+        # Passed to BulkEngine so "All" sweeps can report their progress
+        self.progress = progress
+        # "All" mode sweeps the whole tree once, then handles events one file at a time
+        self.sweeps = SweepScheduler(self.decrypt_all_files, "DecryptSweep") if mode == "All" else None
+        if self.sweeps:
+            self.sweeps.request()
+
+    def on_created(self, event):
+        if not event.is_directory and self.trigger == "Create":
+            file_path = event.src_path
+            if file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.pool.submit(file_path)
+
+    def on_deleted(self, event):
+        if not event.is_directory and self.trigger == "Delete":
+            file_path = event.src_path
+            if not file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.pool.submit(file_path)
+
+    def on_modified(self, event):
+        if not event.is_directory and self.trigger == "Modify":
+            file_path = event.src_path
+            if file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.coalescer.submit(file_path)
+
+    def submit(self, file_path):
+        # Called by the event router; Modify events wait out the quiet window first
+        (self.coalescer or self.pool).submit(file_path)
+
+    def close(self):
+        if self.coalescer:
+            self.coalescer.close()
+        self.pool.close()
+        if self.sweeps:
+            self.sweeps.close()
+
+    def handle_file(self, file_path):
+        try:
+            if self.mode == "Individual" or (self.mode == "Group" and self.is_group(file_path)):
+                self.decrypt_file(file_path)
+            elif self.mode == "All":
+                if self.trigger == "Delete":
+                    # A deletion leaves no file to handle, so it asks for another sweep
+                    self.sweeps.request()
+                elif not self.sweeps.follow_up():
+                    self.decrypt_file(file_path)
+        except Exception as e:
+            logging.error(f"Error decrypting file {file_path}: {str(e)}")
+
+    def is_group(self, file_path):
+        return self.group_matcher.match(file_path)
+
+    def decrypt_file(self, file_path):
+        if self.index:
+            self.index.mark_pending([file_path])
+        decrypted_path, content_hash = self.pool.run(decrypt_path, self.key, file_path)
+        if self.index:
+            self.index.moved([(file_path, decrypted_path, content_hash)], DECRYPTED)
+
+    def decrypt_all_files(self):
+        if self.index:
+            paths = self.index.scan(self.directory, lambda file_path: file_path.endswith(".encrypted"), (ENCRYPTED, PENDING))
+        else:
+            # Streamed to the worker processes as the crawl finds them
+            paths = crawl(self.directory, lambda file_path: file_path.endswith(".encrypted"))
+        BulkEngine(self.key, self.workers, index=self.index, progress=self.progress).decrypt_files(paths)
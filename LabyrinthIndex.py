@@ -0,0 +1,330 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from LabyrinthDurable import is_temp_path
+
+# Default location of the index, kept outside any monitored directory
+DEFAULT_INDEX_FILE = os.path.join(os.path.expanduser("~"), ".labyrinth", "index.sqlite")
+
+# File states: ciphertext on disk, plaintext on disk, or taken by a job that hasn't finished.
+# A job that fails or is cut short leaves its file pending for the next sweep or catch-up
+ENCRYPTED = "encrypted"
+DECRYPTED = "decrypted"
+PENDING = "pending"
+
+# A directory listed this soon after its mtime may gain entries within the same mtime tick
+# (up to 2s on SMB, FAT and some NFS servers), so the next refresh lists it again
+RACY_WINDOW_NS = 2 * 10 ** 9
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    parent TEXT NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    inode INTEGER,
+    hash TEXT,
+    state TEXT NOT NULL,
+    ctime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_parent ON files (parent);
+CREATE INDEX IF NOT EXISTS files_state ON files (state);
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER NOT NULL,
+    listed_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    name TEXT PRIMARY KEY,
+    ctime_ns INTEGER NOT NULL
+);
+"""
+
+INSERT_FILE = "INSERT OR REPLACE INTO files (path, parent, size, mtime_ns, inode, hash, state, ctime_ns) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+
+
+def new_digest():
+    """
+    Returns the hash object used for content hashes in the index.
+    """
+    return hashlib.blake2b(digest_size=32)
+
+
+class FileIndex(object):
+    """
+    On-disk index of path -> size, mtime, inode, content hash and state, plus the
+    mtime of every directory seen. A directory whose mtime hasn't moved has had no
+    entries added, removed or renamed, so rescans skip listing it and take its
+    files from the index instead.
+    """
+
+    def __init__(self, index_file=DEFAULT_INDEX_FILE):
+        directory = os.path.dirname(index_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.index_file = index_file
+        self.lock = threading.RLock()
+        # Imported here so one-shot tools that only need the digest helpers skip sqlite3
+        import sqlite3
+        self.db = sqlite3.connect(index_file, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        # Indexes written before ctime_ns was tracked get the column added in place
+        if "ctime_ns" not in [row[1] for row in self.db.execute("PRAGMA table_info(files)")]:
+            self.db.execute("ALTER TABLE files ADD COLUMN ctime_ns INTEGER")
+        # Directories indexed before listing times were tracked are listed again once
+        if "listed_ns" not in [row[1] for row in self.db.execute("PRAGMA table_info(dirs)")]:
+            self.db.execute("ALTER TABLE dirs ADD COLUMN listed_ns INTEGER")
+
+    def get(self, file_path):
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, inode, hash, state FROM files WHERE path = ?", (file_path,)).fetchone()
+        if row:
+            return dict(zip(("size", "mtime_ns", "inode", "hash", "state"), row))
+        return None
+
+    def changed(self, file_path, st=None):
+        """
+        Returns True if file_path isn't indexed or its size, mtime or inode differ from the index.
+        """
+        entry = self.get(file_path)
+        if entry is None:
+            return True
+        st = st or os.stat(file_path)
+        return (entry["size"], entry["mtime_ns"], entry["inode"]) != (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def _row(self, file_path, state, content_hash, st):
+        if st is None:
+            try:
+                st = os.stat(file_path)
+            except FileNotFoundError:
+                st = None
+        if st is None:
+            return (file_path, os.path.dirname(file_path), None, None, None, content_hash, state, None)
+        return (file_path, os.path.dirname(file_path), st.st_size, st.st_mtime_ns, st.st_ino, content_hash, state, st.st_ctime_ns)
+
+    def record(self, file_path, state, content_hash=None, st=None):
+        self.record_many([(file_path, state, content_hash, st)])
+
+    def record_many(self, entries):
+        """
+        Records (path, state, content_hash, stat or None) entries in one transaction.
+        """
+        rows = [self._row(*entry) for entry in entries]
+        with self.lock, self.db:
+            self.db.executemany(INSERT_FILE, rows)
+
+    def forget(self, file_path):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM files WHERE path = ?", (file_path,))
+
+    def moved(self, results, state):
+        """
+        Records finished jobs: each (source, destination, content_hash) drops the
+        source entry and records the destination in the given state.
+        """
+        with self.lock, self.db:
+            self.db.executemany("DELETE FROM files WHERE path = ?", [(source,) for source, _, _ in results])
+            self.db.executemany(INSERT_FILE, [self._row(destination, state, content_hash, None) for _, destination, content_hash in results])
+
+    def mark_pending(self, paths):
+        """
+        Records paths as taken by a job. moved() clears them when the job finishes;
+        paths whose job failed stay pending.
+        """
+        with self.lock, self.db:
+            for file_path in paths:
+                if not self.db.execute("UPDATE files SET state = ? WHERE path = ?", (PENDING, file_path)).rowcount:
+                    self.db.execute(INSERT_FILE, self._row(file_path, PENDING, None, None))
+
+    def pending(self, directory=None):
+        """
+        Returns the pending paths, under directory if given.
+        """
+        with self.lock:
+            if directory is None:
+                rows = self.db.execute("SELECT path FROM files WHERE state = ?", (PENDING,)).fetchall()
+            else:
+                root = os.path.abspath(directory)
+                low, high = root + os.sep, root + chr(ord(os.sep) + 1)
+                rows = self.db.execute("SELECT path FROM files WHERE state = ? AND (parent = ? OR (parent > ? AND parent < ?))",
+                                       (PENDING, root, low, high)).fetchall()
+        return [path for (path,) in rows]
+
+    def get_checkpoint(self, name):
+        with self.lock:
+            row = self.db.execute("SELECT ctime_ns FROM checkpoints WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_checkpoint(self, name, ctime_ns):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?)", (name, ctime_ns))
+
+    def changed_since(self, directory, states, ctime_ns):
+        """
+        Returns the indexed files under directory in one of states whose inode change
+        time is at or after ctime_ns.
+        """
+        root = os.path.abspath(directory)
+        low, high = root + os.sep, root + chr(ord(os.sep) + 1)
+        marks = ", ".join("?" for _ in states)
+        with self.lock:
+            rows = self.db.execute(f"SELECT path FROM files WHERE state IN ({marks}) AND ctime_ns >= ? AND (parent = ? OR (parent > ? AND parent < ?))",
+                                   (*states, ctime_ns, root, low, high)).fetchall()
+        return [path for (path,) in rows]
+
+    def refresh(self, directory, recursive=True, full=False, stop=None):
+        """
+        Brings the index up to date with directory. Only directories whose mtime moved
+        since the last refresh are listed; unchanged ones cost a single stat. With full,
+        every directory is listed so in-place content changes are picked up too. A
+        directory last listed within RACY_WINDOW_NS of its mtime is listed again, since
+        entries added later in the same mtime tick wouldn't have moved it. Setting the
+        stop event ends the walk after the current directory.
+        """
+        stack = [os.path.abspath(directory)]
+        while stack:
+            if stop is not None and stop.is_set():
+                return
+            current = stack.pop()
+            try:
+                mtime_ns = os.stat(current).st_mtime_ns
+            except FileNotFoundError:
+                self._forget_directory(current)
+                continue
+            with self.lock:
+                row = self.db.execute("SELECT mtime_ns, listed_ns FROM dirs WHERE path = ?", (current,)).fetchone()
+                if row and row[0] == mtime_ns and row[1] is not None and row[1] - mtime_ns >= RACY_WINDOW_NS and not full:
+                    subdirs = [r[0] for r in self.db.execute("SELECT path FROM dirs WHERE parent = ?", (current,))]
+                else:
+                    subdirs = self._list_directory(current, mtime_ns)
+            if recursive:
+                stack.extend(subdirs)
+
+    def scan(self, directory, select, states, recursive=True):
+        """
+        Refreshes directory, then returns the indexed files under it in one of states
+        that select() accepts. Cost is one stat per directory plus the matching rows,
+        rather than a listing and stat of every file in the tree.
+        """
+        root = os.path.abspath(directory)
+        self.refresh(root, recursive)
+        low, high = root + os.sep, root + chr(ord(os.sep) + 1)
+        marks = ", ".join("?" for _ in states)
+        with self.lock:
+            if recursive:
+                rows = self.db.execute(f"SELECT path FROM files WHERE state IN ({marks}) AND (parent = ? OR (parent > ? AND parent < ?))",
+                                       (*states, root, low, high)).fetchall()
+            else:
+                rows = self.db.execute(f"SELECT path FROM files WHERE state IN ({marks}) AND parent = ?", (*states, root)).fetchall()
+        return [path for (path,) in rows if select(path)]
+
+    def _list_directory(self, current, mtime_ns):
+        # Lists a changed directory, refreshes its rows and returns its subdirectories.
+        # Called with the lock held.
+        listed = {}
+        subdirs = []
+        listed_ns = time.time_ns()
+        with os.scandir(current) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) and not is_temp_path(entry.path):
+                    listed[entry.path] = entry.stat(follow_symlinks=False)
+        with self.db:
+            known = {}
+            for path, size, mtime, inode in self.db.execute("SELECT path, size, mtime_ns, inode FROM files WHERE parent = ?", (current,)):
+                known[path] = (size, mtime, inode)
+            self.db.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in known if path not in listed])
+            for (path,) in self.db.execute("SELECT path FROM dirs WHERE parent = ?", (current,)).fetchall():
+                if path not in subdirs:
+                    self._delete_directory(path)
+            rows = []
+            for path, st in listed.items():
+                if known.get(path) != (st.st_size, st.st_mtime_ns, st.st_ino):
+                    rows.append(self._row(path, ENCRYPTED if path.endswith(".encrypted") else DECRYPTED, None, st))
+            self.db.executemany(INSERT_FILE, rows)
+            self.db.execute("INSERT OR REPLACE INTO dirs (path, parent, mtime_ns, listed_ns) VALUES (?, ?, ?, ?)",
+                            (current, os.path.dirname(current), mtime_ns, listed_ns))
+        return subdirs
+
+    def _delete_directory(self, directory):
+        # Deletes a directory and everything indexed below it; the caller holds the transaction
+        low, high = directory + os.sep, directory + chr(ord(os.sep) + 1)
+        self.db.execute("DELETE FROM files WHERE parent = ? OR (parent > ? AND parent < ?)", (directory, low, high))
+        self.db.execute("DELETE FROM dirs WHERE path = ? OR (path > ? AND path < ?)", (directory, low, high))
+
+    def _forget_directory(self, directory):
+        with self.lock, self.db:
+            self._delete_directory(directory)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def catch_up(index, directory, handler, direction, stop=None):
+    """
+    Startup reconciliation for a handler. Refreshes the index for directory and
+    queues on handler.pool the files that changed since this handler last started
+    and are still waiting for it ("encrypt": plaintext, "decrypt": .encrypted files),
+    along with files whose job was interrupted and are still pending. Setting the stop
+    event ends the scan early, without moving the checkpoint.
+    The first run only records a baseline: files already in the tree before a handler
+    ever started are left alone, as they would be without the index, and only later
+    changes are replayed. "All" mode handlers queue nothing since their first sweep
+    covers it. Returns the number of files queued.
+    """
+    if handler.trigger == "Delete":
+        # Deletions leave nothing on disk to replay
+        return 0
+    if direction == "encrypt":
+        select, states = (lambda file_path: not file_path.endswith(".encrypted")), (DECRYPTED, PENDING)
+    else:
+        select, states = (lambda file_path: file_path.endswith(".encrypted")), (ENCRYPTED, PENDING)
+    name = f"{direction}:{os.path.abspath(directory)}"
+    started_ns = time.time_ns()
+    checkpoint = index.get_checkpoint(name)
+    # Modify events don't touch directory mtimes, so in-place changes need every directory listed
+    index.refresh(directory, full=handler.trigger == "Modify", stop=stop)
+    if stop is not None and stop.is_set():
+        return 0
+    if checkpoint is None:
+        index.set_checkpoint(name, started_ns)
+        logging.info(f"Catch-up for {name}: recorded baseline snapshot; files already present are not queued")
+        return 0
+    if handler.mode == "All":
+        # The handler's first sweep already covers every waiting file
+        index.set_checkpoint(name, started_ns)
+        return 0
+    queued = 0
+    for file_path in set(index.changed_since(directory, states, checkpoint)) | set(index.pending(directory)):
+        if stop is not None and stop.is_set():
+            # The checkpoint stays put, so the next start queues the rest
+            logging.info(f"Catch-up for {name}: stopped after queueing {queued} files")
+            return queued
+        if select(file_path) and os.path.exists(file_path) and handler.pool.submit(file_path):
+            queued += 1
+    index.set_checkpoint(name, started_ns)
+    logging.info(f"Catch-up for {name}: queued {queued} files changed while monitoring was stopped")
+    return queued
+
+
+def start_catch_up(index, directory, handler, direction, stop=None):
+    """
+    Runs catch_up on a background thread so it overlaps with live events. Returns the
+    thread; set stop and join it before closing index.
+    """
+    def run():
+        try:
+            catch_up(index, directory, handler, direction, stop)
+        except Exception as e:
+            logging.error(f"Error during catch-up scan of {directory}: {str(e)}")
+    thread = threading.Thread(target=run, name="CatchUp", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,200 @@
+import logging
+import os
+import threading
+from cryptography.fernet import InvalidToken
+from cryptography.exceptions import InvalidTag
+from LabyrinthStream import StreamCipher, MAGIC, key_id, read_header, read_key_id, rechunk
+from LabyrinthCompression import NO_COMPRESSION
+
+# Key ring files hold one Fernet key per line. Keys are appended on rotation, so the
+# last key is the primary one new files are encrypted with; the rest decrypt older files.
+
+
+class KeyRing(object):
+    """
+    Every key a process may need, indexed by key ID so a container is matched to its
+    key with one dict lookup. Ciphers are built on first use and cached. Rings with the
+    same keys compare equal, so a ring pickled to a worker process finds that worker's
+    cached copy. A ring loaded from a key file picks up keys added to the file later.
+    """
+
+    def __init__(self, keys, key_file=None):
+        self.ciphers = {}
+        self.lock = threading.Lock()
+        self.key_file = key_file
+        self.mtime_ns = None
+        self._set_keys(keys)
+
+    def _set_keys(self, keys):
+        keys = [key.strip() if isinstance(key, bytes) else key.strip().encode() for key in keys]
+        keys = [key for key in keys if key]
+        if not keys:
+            raise ValueError("Key ring is empty")
+        self.keys = tuple(keys)
+        self.ids = {key_id(key): key for key in self.keys}
+        self.primary = self.keys[-1]
+
+    def refresh(self):
+        """
+        Reloads the key file if it changed since it was read, so a key rotated in by
+        another process becomes primary here too. Returns True if the keys changed.
+        """
+        if self.key_file is None:
+            return False
+        try:
+            mtime_ns = os.stat(self.key_file).st_mtime_ns
+        except OSError:
+            return False
+        if mtime_ns == self.mtime_ns:
+            return False
+        with self.lock:
+            if mtime_ns == self.mtime_ns:
+                return False
+            with open(self.key_file, "rb") as f:
+                keys = f.read().splitlines()
+            changed = tuple(key.strip() for key in keys if key.strip()) != self.keys
+            if changed:
+                self._set_keys(keys)
+                logging.info(f"Reloaded key ring {self.key_file} with {len(self.keys)} keys")
+            self.mtime_ns = mtime_ns
+        return changed
+
+    def __getstate__(self):
+        return {"keys": self.keys}
+
+    def __setstate__(self, state):
+        self.__init__(state["keys"])
+
+    def __eq__(self, other):
+        return isinstance(other, KeyRing) and self.keys == other.keys
+
+    def __hash__(self):
+        return hash(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def cipher(self, key=None):
+        """
+        Returns the StreamCipher for key, the primary key by default.
+        """
+        key = key or self.primary
+        cipher = self.ciphers.get(key)
+        if cipher is None:
+            with self.lock:
+                cipher = self.ciphers.get(key)
+                if cipher is None:
+                    cipher = self.ciphers[key] = StreamCipher(key)
+        return cipher
+
+    def cipher_for_id(self, kid):
+        key = self.ids.get(kid)
+        if key is None and self.refresh():
+            key = self.ids.get(kid)
+        if key is None:
+            raise KeyError(f"No key with ID {kid.hex()} in the key ring")
+        return self.cipher(key)
+
+    def source_cipher(self, encrypted_path):
+        """
+        Returns the cipher whose key encrypted encrypted_path. Files without a key ID
+        are matched by checking their first segment, or Fernet signature, against each
+        key, newest first.
+        """
+        kid = read_key_id(encrypted_path)
+        if kid is not None:
+            return self.cipher_for_id(kid)
+        with open(encrypted_path, "rb") as f:
+            stream = f.read(len(MAGIC)) == MAGIC
+        for key in reversed(self.keys):
+            cipher = self.cipher(key)
+            try:
+                with open(encrypted_path, "rb") as f:
+                    if stream:
+                        segments = cipher.plaintext_segments(f)
+                        next(segments)
+                        segments.close()
+                    else:
+                        cipher.fernet.extract_timestamp(f.read())
+                return cipher
+            except (InvalidTag, InvalidToken):
+                continue
+        raise InvalidToken(f"No key in the key ring decrypts {encrypted_path}")
+
+    def encrypt_file(self, file_path, encrypted_path, digest=None):
+        self.refresh()
+        self.cipher().encrypt_file(file_path, encrypted_path, digest)
+
+    def reencrypt_file(self, encrypted_path, rotated_path, digest=None):
+        """
+        Re-encrypts encrypted_path under the primary key into rotated_path. Plaintext
+        is passed between the two ciphers segment by segment in memory and never
+        written to disk. A compressed file stays compressed with the same codec. If
+        digest is given it is updated with the plaintext.
+        """
+        source = self.source_cipher(encrypted_path)
+        target = self.cipher()
+        header = read_header(encrypted_path)
+        codec = header[1] if header else NO_COMPRESSION
+        try:
+            with open(encrypted_path, "rb") as src, open(rotated_path, "wb") as dst:
+                target.encrypt_segments(rechunk(source.plaintext_segments(src), target.segment_size), dst, digest, codec)
+        except Exception:
+            if os.path.exists(rotated_path):
+                os.remove(rotated_path)
+            raise
+
+    def decrypt_file(self, encrypted_path, file_path, digest=None):
+        """
+        Decrypts with the key named in the container header. Files written before key
+        IDs were recorded are tried against each key, newest first.
+        """
+        kid = read_key_id(encrypted_path)
+        if kid is not None:
+            self.cipher_for_id(kid).decrypt_file(encrypted_path, file_path, digest)
+            return
+        # A wrong key fails authentication on the first segment, before digest is updated
+        for key in reversed(self.keys):
+            try:
+                self.cipher(key).decrypt_file(encrypted_path, file_path, digest)
+                return
+            except (InvalidTag, InvalidToken):
+                continue
+        raise InvalidToken(f"No key in the key ring decrypts {encrypted_path}")
+
+
+_rings = {}
+_rings_lock = threading.Lock()
+
+
+def load_key_ring(key_file):
+    """
+    Loads the key ring in key_file once per process; later calls return the same ring.
+    A single-key file written by generate_key/save_key is a ring of one key.
+    """
+    path = os.path.abspath(key_file)
+    with _rings_lock:
+        ring = _rings.get(path)
+        if ring is None:
+            mtime_ns = os.stat(path).st_mtime_ns
+            with open(path, "rb") as f:
+                ring = _rings[path] = KeyRing(f.read().splitlines(), path)
+            ring.mtime_ns = mtime_ns
+            logging.info(f"Loaded key ring {path} with {len(ring)} keys")
+    ring.refresh()
+    return ring
+
+
+def add_key(key_file, key):
+    """
+    Appends key to the ring in key_file, making it the primary key. Rings already
+    loaded from the file pick it up on their next refresh.
+    """
+    existing = b""
+    if os.path.exists(key_file):
+        with open(key_file, "rb") as f:
+            existing = f.read()
+    with open(key_file, "ab") as f:
+        if existing and not existing.endswith(b"\n"):
+            f.write(b"\n")
+        f.write(key.strip() + b"\n")
@@ -0,0 +1,191 @@
+import logging
+import threading
+
+# Default histogram bucket upper bounds in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Pipeline stages, in the order a file passes through them
+STAGES = ("received", "queued", "read", "compressed", "encrypted", "decrypted", "written", "committed", "removed", "upload_queued", "uploaded")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _labels(label, value):
+    return f'{{{label}="{value}"}}' if label else ""
+
+
+class Counter(object):
+    """
+    Monotonic counter with one value per label value.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help, label="stage"):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_value="", amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def get(self, label_value=""):
+        with self.lock:
+            return self.values.get(label_value, 0)
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return [f"{self.name}{_labels(self.label, value)} {count}" for value, count in values]
+
+
+class Histogram(object):
+    """
+    Histogram of observations with one set of buckets per label value.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, label="stage", buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, amount):
+        with self.lock:
+            series = self.values.get(label_value)
+            if series is None:
+                # Per-bucket counts, then the overflow count, the sum and the total
+                series = self.values[label_value] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-2] += amount
+            series[-1] += 1
+
+    def render(self):
+        with self.lock:
+            values = sorted((value, list(series)) for value, series in self.values.items())
+        lines = []
+        for value, series in values:
+            prefix = f'{self.label}="{value}",' if self.label else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{_labels(self.label, value)} {series[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.label, value)} {series[-1]}")
+        return lines
+
+
+class Gauge(object):
+    """
+    Value read from a callback at scrape time, such as a queue depth.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def render(self):
+        try:
+            return [f"{self.name} {self.function()}"]
+        except Exception as e:
+            logging.warning(f"Error reading gauge {self.name}: {str(e)}")
+            return []
+
+
+class Registry(object):
+    """
+    Process-wide set of metrics, rendered in the Prometheus text exposition format.
+    Worker processes keep their own registry, so stages run in a process pool are
+    only counted in this process when recorded from the calling thread.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _add(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, label="stage"):
+        return self._add(Counter(name, help, label))
+
+    def histogram(self, name, help, label="stage", buckets=BUCKETS):
+        return self._add(Histogram(name, help, label, buckets))
+
+    def gauge(self, name, help, function):
+        """
+        Registers function as the source of gauge name, replacing any earlier one.
+        """
+        gauge = Gauge(name, help, function)
+        with self.lock:
+            self.metrics[name] = gauge
+        return gauge
+
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+STAGE_EVENTS = REGISTRY.counter("labyrinth_stage_events_total", "Files that completed each pipeline stage")
+STAGE_BYTES = REGISTRY.counter("labyrinth_stage_bytes_total", "Bytes handled by each pipeline stage")
+STAGE_ERRORS = REGISTRY.counter("labyrinth_stage_errors_total", "Files that failed in each pipeline stage")
+STAGE_SECONDS = REGISTRY.histogram("labyrinth_stage_seconds", "Time spent per file in each pipeline stage")
+
+
+def record_stage(stage, seconds=None, size=0, files=1):
+    """
+    Records files passing through stage, with the time it took and the bytes it handled.
+    """
+    STAGE_EVENTS.inc(stage, files)
+    if size:
+        STAGE_BYTES.inc(stage, size)
+    if seconds is not None:
+        STAGE_SECONDS.observe(stage, seconds)
+
+
+def record_error(stage, files=1):
+    STAGE_ERRORS.inc(stage, files)
+
+
+def start_metrics_server(port=None, host="127.0.0.1", socket_path=None, registry=REGISTRY):
+    """
+    Serves registry at /metrics on host:port, or on the Unix socket socket_path,
+    from a daemon thread. Returns the server; call shutdown() on it to stop.
+    """
+    # http.server is only loaded once an endpoint is actually started
+    if socket_path:
+        from LabyrinthMetricsServer import UnixMetricsServer
+        server = UnixMetricsServer(socket_path, registry)
+        where = socket_path
+    else:
+        from LabyrinthMetricsServer import MetricsServer
+        server = MetricsServer((host, port or 0), registry)
+        where = f"http://{host}:{server.server_address[1]}/metrics"
+    thread = threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True)
+    thread.start()
+    logging.info(f"Serving metrics on {where}")
+    return server
@@ -0,0 +1,48 @@
+import os
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from LabyrinthMetrics import REGISTRY, CONTENT_TYPE
+
+# Kept out of LabyrinthMetrics so that recording metrics doesn't import http.server;
+# start_metrics_server imports this module when an endpoint is started
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes arrive every few seconds; keep them out of the log
+        pass
+
+
+class MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, registry=REGISTRY):
+        self.registry = registry
+        super().__init__(address, MetricsRequestHandler)
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+    class UnixMetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def __init__(self, socket_path, registry=REGISTRY):
+            self.registry = registry
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            super().__init__(socket_path, MetricsRequestHandler)
+
+        def get_request(self):
+            # Unix sockets have no peer address; BaseHTTPRequestHandler expects a tuple
+            request, _ = super().get_request()
+            return request, ("local", 0)
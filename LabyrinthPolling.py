@@ -0,0 +1,226 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+from watchdog.events import DirCreatedEvent, DirDeletedEvent, FileCreatedEvent, FileDeletedEvent, FileModifiedEvent, FileMovedEvent
+from watchdog.observers.api import BaseObserver, EventEmitter
+from LabyrinthIndex import RACY_WINDOW_NS
+
+# Seconds between scans of each watched tree
+SCAN_INTERVAL = 5.0
+
+# Threads statting and listing directories. Reads on network mounts are latency bound,
+# so this is worth setting above the core count there
+SCAN_WORKERS = 8
+
+
+class DirectoryState(object):
+    """
+    What one directory held at the last scan: its (inode, mtime) key, its files as
+    {name: (inode, mtime_ns, size)} and the names of its subdirectories.
+    """
+
+    def __init__(self, key, files, subdirs, racy):
+        self.key = key
+        self.files = files
+        self.subdirs = subdirs
+        self.racy = racy
+
+
+def _file_key(st):
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _read_directory(path, known, modifications, now_ns):
+    """
+    Stats path and lists it only if it changed since known, its state from the last
+    scan. Adding, removing or renaming an entry updates a directory's mtime; editing
+    a file in place doesn't, so with modifications the files of an unchanged directory
+    are statted instead. Runs on a scan thread; returns (state, listed).
+    """
+    st = os.stat(path)
+    key = (st.st_ino, st.st_mtime_ns)
+    racy = now_ns - st.st_mtime_ns < RACY_WINDOW_NS
+    if known is not None and known.key == key and not known.racy:
+        if not modifications:
+            return DirectoryState(key, known.files, known.subdirs, racy), False
+        files = {}
+        for name in known.files:
+            try:
+                files[name] = _file_key(os.stat(os.path.join(path, name), follow_symlinks=False))
+            except FileNotFoundError:
+                continue
+        return DirectoryState(key, files, known.subdirs, racy), False
+    files = {}
+    subdirs = set()
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.add(entry.name)
+                else:
+                    files[entry.name] = _file_key(entry.stat(follow_symlinks=False))
+            except FileNotFoundError:
+                continue
+    return DirectoryState(key, files, subdirs, racy), True
+
+
+class TreeSnapshot(object):
+    """
+    Incremental picture of a directory tree, brought up to date by scan(). Each scan
+    costs one stat per directory; only directories whose mtime moved are listed again,
+    and directories are read in parallel from a thread pool.
+    """
+
+    def __init__(self, root, recursive=True, workers=SCAN_WORKERS, modifications=True):
+        self.root = os.path.abspath(root)
+        self.recursive = recursive
+        self.modifications = modifications
+        self.dirs = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="LabyrinthScan")
+        # Directories checked and listed by the last scan
+        self.checked = 0
+        self.listed = 0
+
+    def scan(self):
+        """
+        Updates the snapshot and returns watchdog events for everything that changed
+        since the previous scan; the first scan only records the tree. Raises OSError
+        if the root itself can't be read.
+        """
+        first = not self.dirs
+        events = []
+        now_ns = time.time_ns()
+        self.checked = self.listed = 0
+        running = {}
+
+        def read(path):
+            running[self.executor.submit(_read_directory, path, self.dirs.get(path), self.modifications, now_ns)] = path
+
+        read(self.root)
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                path = running.pop(future)
+                old = self.dirs.get(path)
+                try:
+                    state, listed = future.result()
+                except FileNotFoundError:
+                    if path == self.root:
+                        raise
+                    # Removed between its parent's listing and its own
+                    self._remove_tree(path, events)
+                    continue
+                except OSError as e:
+                    if path == self.root:
+                        raise
+                    logging.warning(f"Error scanning directory {path}: {str(e)}")
+                    if old is None:
+                        continue
+                    state, listed = old, False
+                self.checked += 1
+                self.listed += listed
+                self.dirs[path] = state
+                if not first and state.files is not (old.files if old else None):
+                    self._diff(path, old, state, events)
+                if not self.recursive:
+                    continue
+                for name in state.subdirs:
+                    read(os.path.join(path, name))
+                if old is not None and not first:
+                    for name in old.subdirs - state.subdirs:
+                        self._remove_tree(os.path.join(path, name), events)
+        return [] if first else events
+
+    def _diff(self, path, old, new, events):
+        old_files = old.files if old else {}
+        if old is None and path != self.root:
+            events.append(DirCreatedEvent(path))
+        deleted = {}
+        for name, key in old_files.items():
+            if name not in new.files:
+                deleted[key[0]] = name
+        created = []
+        for name, key in new.files.items():
+            before = old_files.get(name)
+            if before is None:
+                created.append(name)
+            elif before[0] != key[0]:
+                # Another file was renamed over it, as atomic writes do; native backends report
+                # only the rename, which EventRouter treats as the name being created
+                created.append(name)
+            elif before != key:
+                events.append(FileModifiedEvent(os.path.join(path, name)))
+        for name in created:
+            # A name that disappeared with the same inode was renamed within the directory
+            source = deleted.pop(new.files[name][0], None)
+            if source is not None:
+                events.append(FileMovedEvent(os.path.join(path, source), os.path.join(path, name)))
+            else:
+                events.append(FileCreatedEvent(os.path.join(path, name)))
+        for name in deleted.values():
+            events.append(FileDeletedEvent(os.path.join(path, name)))
+
+    def _remove_tree(self, path, events):
+        state = self.dirs.pop(path, None)
+        if state is None:
+            return
+        for name in state.subdirs:
+            self._remove_tree(os.path.join(path, name), events)
+        for name in state.files:
+            events.append(FileDeletedEvent(os.path.join(path, name)))
+        events.append(DirDeletedEvent(path))
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class ScandirPollingEmitter(EventEmitter):
+    """
+    Emits the events found by scanning a watch's tree with TreeSnapshot every timeout seconds.
+    """
+
+    def __init__(self, event_queue, watch, timeout=SCAN_INTERVAL, event_filter=None, workers=SCAN_WORKERS, modifications=True):
+        super().__init__(event_queue, watch, timeout=timeout, event_filter=event_filter)
+        self.snapshot = TreeSnapshot(watch.path, watch.is_recursive, workers, modifications)
+
+    def on_thread_start(self):
+        started = time.monotonic()
+        try:
+            self.snapshot.scan()
+        except OSError as e:
+            logging.error(f"Error taking the first snapshot of {self.watch.path}: {str(e)}")
+            return
+        logging.info(f"Polling {self.watch.path}: {self.snapshot.checked} directories, first scan took {time.monotonic() - started:.2f}s")
+
+    def queue_events(self, timeout):
+        # The emitter timeout is the scan interval; stopping wakes the wait early
+        if self.stopped_event.wait(timeout):
+            return
+        started = time.monotonic()
+        try:
+            events = self.snapshot.scan()
+        except OSError:
+            self.queue_event(DirDeletedEvent(self.watch.path))
+            self.stop()
+            return
+        logging.debug(f"Scanned {self.watch.path}: {self.snapshot.checked} directories checked, "
+                      f"{self.snapshot.listed} listed, {len(events)} events in {time.monotonic() - started:.3f}s")
+        for event in events:
+            self.queue_event(event)
+
+    def on_thread_stop(self):
+        self.snapshot.close()
+
+
+class ScandirPollingObserver(BaseObserver):
+    """
+    Drop-in replacement for watchdog's Observer that polls instead of using inotify and
+    the like. It needs no kernel watches, so it suits trees with millions of directories,
+    and it sees changes made by other hosts on NFS and SMB mounts. With modifications
+    off, in-place edits aren't detected but each scan only stats directories.
+    """
+
+    def __init__(self, interval=SCAN_INTERVAL, workers=SCAN_WORKERS, modifications=True):
+        super().__init__(partial(ScandirPollingEmitter, workers=workers, modifications=modifications), timeout=interval)
@@ -0,0 +1,254 @@
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from cryptography.fernet import Fernet
+from LabyrinthBulk import BulkStats, get_cipher, shard
+from LabyrinthCrawl import crawl
+from LabyrinthDurable import POLICIES, commit, temp_path, get_durability, set_durability
+from LabyrinthIndex import ENCRYPTED, new_digest
+from LabyrinthKeys import load_key_ring, add_key
+from LabyrinthStream import read_key_id
+
+# Number of files handed to a worker process in one go; each finished shard is checkpointed
+SHARD_SIZE = 64
+
+# Rotation runs next to live monitoring, so by default it takes half the cores at a lower priority
+NICE = 10
+
+# Checkpoint journals are kept with the index, outside any monitored directory
+JOURNAL_DIRECTORY = os.path.join(os.path.expanduser("~"), ".labyrinth")
+
+# Per-worker pacing, set by the pool initializer
+_throttles = ()
+
+
+class Throttle(object):
+    """
+    Paces a worker to at most rate units (bytes or files) per second on average.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.used = 0
+
+    def wait(self, amount):
+        if not self.rate:
+            return
+        self.used += amount
+        delay = self.used / self.rate - (time.monotonic() - self.started)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _init_worker(key, durability, window, bytes_rate, files_rate, nice):
+    global _throttles
+    get_cipher(key)
+    set_durability(durability, window)
+    _throttles = (Throttle(bytes_rate), Throttle(files_rate))
+    if nice and hasattr(os, "nice"):
+        os.nice(nice)
+
+
+def rotate_path(key, file_path, pending=None):
+    """
+    Re-encrypts the .encrypted file file_path under the primary key of key (a KeyRing)
+    and commits it in place. Returns the plaintext content hash, or None if the file is
+    already on the primary key. With pending (a list), the commit is queued on it.
+    """
+    ring = get_cipher(key)
+    if read_key_id(file_path) == ring.cipher().key_id:
+        return None
+    digest = new_digest()
+    staged = temp_path(file_path)
+    ring.reencrypt_file(file_path, staged, digest)
+    commit(staged, file_path, pending=pending)
+    return digest.hexdigest()
+
+
+def _rotate_shard(key, paths):
+    files = size = errors = skipped = 0
+    done = []
+    finished = []
+    staged = []
+    pending = []
+    bytes_throttle, files_throttle = _throttles or (Throttle(None), Throttle(None))
+    for file_path in paths:
+        try:
+            file_size = os.path.getsize(file_path)
+            content_hash = rotate_path(key, file_path, pending)
+            if content_hash is None:
+                skipped += 1
+                finished.append(file_path)
+                continue
+            staged.append((file_path, content_hash, file_size, pending[-1]))
+            bytes_throttle.wait(file_size)
+            files_throttle.wait(1)
+        except Exception as e:
+            errors += 1
+            logging.error(f"Error rotating file {file_path}: {str(e)}")
+    for file_path, content_hash, file_size, handle in staged:
+        try:
+            handle.wait()
+            files += 1
+            size += file_size
+            done.append((file_path, file_path, content_hash))
+            finished.append(file_path)
+        except Exception as e:
+            errors += 1
+            logging.error(f"Error committing rotated file {file_path}: {str(e)}")
+    return files, size, errors, skipped, done, finished
+
+
+def find_encrypted(directory, ignore=None):
+    """
+    Yields every .encrypted file under directory as the crawl finds it.
+    """
+    return crawl(directory, lambda file_path: file_path.endswith(".encrypted"), ignore)
+
+
+class RotationJournal(object):
+    """
+    Append-only list of files already moved onto the target key. A rerun with the
+    same target key skips them; a journal written for another key is started over.
+    """
+
+    def __init__(self, journal_file, target_id):
+        self.journal_file = journal_file
+        self.done = set()
+        header = f"# target {target_id.hex()}\n"
+        if os.path.exists(journal_file):
+            with open(journal_file, "r", encoding="utf-8", errors="surrogateescape") as f:
+                lines = f.read().split("\n")
+            if lines[0] + "\n" == header:
+                # The last line is only complete if the newline after it was written
+                self.done = {line for line in lines[1:-1] if line}
+        directory = os.path.dirname(journal_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        resumed = bool(self.done)
+        self.file = open(journal_file, "a" if resumed else "w", encoding="utf-8", errors="surrogateescape")
+        if not resumed:
+            self.file.write(header)
+            self.file.flush()
+
+    def __contains__(self, file_path):
+        return file_path in self.done
+
+    def mark(self, paths):
+        if not paths:
+            return
+        self.file.write("".join(f"{path}\n" for path in paths))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.done.update(paths)
+
+    def close(self):
+        self.file.close()
+
+
+def default_journal(target_id):
+    return os.path.join(JOURNAL_DIRECTORY, f"rotate-{target_id.hex()}.journal")
+
+
+class RotationJob(object):
+    """
+    Moves existing .encrypted files onto the primary key of a key ring across a pool
+    of worker processes. Progress is checkpointed per shard, so an interrupted job
+    resumes where it stopped, and workers can be paced and run at a lower priority.
+    """
+
+    def __init__(self, key, workers=None, shard_size=SHARD_SIZE, journal_file=None, max_bytes_per_second=None,
+                 max_files_per_second=None, nice=NICE, index=None):
+        self.key = key
+        self.workers = workers or max(1, (os.cpu_count() or 1) // 2)
+        self.shard_size = shard_size
+        self.target_id = key.cipher().key_id
+        self.journal_file = journal_file or default_journal(self.target_id)
+        # Limits are for the whole job, so each worker gets an equal share
+        self.bytes_rate = max_bytes_per_second / self.workers if max_bytes_per_second else None
+        self.files_rate = max_files_per_second / self.workers if max_files_per_second else None
+        self.nice = nice
+        self.index = index
+        self.skipped = 0
+
+    def run(self, paths):
+        """
+        Rotates every path not already checkpointed and returns the aggregate BulkStats.
+        """
+        stats = BulkStats()
+        start = time.monotonic()
+        journal = RotationJournal(self.journal_file, self.target_id)
+        resumed = len(journal.done)
+        paths = (path for path in paths if path not in journal)
+        initargs = (self.key, *get_durability(), self.bytes_rate, self.files_rate, self.nice)
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=initargs) as executor:
+                # Only a few shards are in flight, so an interrupt loses at most their progress
+                running = set()
+                for batch in shard(paths, self.shard_size):
+                    running.add(executor.submit(_rotate_shard, self.key, batch))
+                    if len(running) >= self.workers * 2:
+                        finished, running = wait(running, return_when=FIRST_COMPLETED)
+                        self._collect(finished, stats, journal)
+                self._collect(running, stats, journal)
+        finally:
+            journal.close()
+        stats.elapsed = time.monotonic() - start
+        logging.info(f"Key rotation with {self.workers} workers: {stats}, {self.skipped} already on the primary key, "
+                     f"{resumed} checkpointed by an earlier run")
+        return stats
+
+    def _collect(self, futures, stats, journal):
+        for future in futures:
+            files, size, errors, skipped, done, finished = future.result()
+            stats.add(files, size, errors)
+            self.skipped += skipped
+            if self.index:
+                self.index.moved(done, ENCRYPTED)
+            journal.mark(finished)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-encrypt .encrypted files under the newest key in a key ring")
+    parser.add_argument("directory", help="directory searched recursively for .encrypted files")
+    parser.add_argument("--key-file", required=True, help="key ring file, one key per line, newest last")
+    parser.add_argument("--new-key", action="store_true", help="generate a key and append it to the ring first; leave it off when resuming")
+    parser.add_argument("--workers", type=int, help="worker processes (default: half the CPU cores)")
+    parser.add_argument("--journal", help="checkpoint file (default: ~/.labyrinth/rotate-<key id>.journal)")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and check every file again")
+    parser.add_argument("--max-mb-per-second", type=float, help="limit on ciphertext rotated per second")
+    parser.add_argument("--max-files-per-second", type=float, help="limit on files rotated per second")
+    parser.add_argument("--nice", type=int, default=NICE, help="priority increment for worker processes")
+    parser.add_argument("--durability", choices=POLICIES, help="output durability policy")
+    parser.add_argument("--index", help="file-state index to keep up to date")
+    parser.add_argument("--ignore", action="append", help="path or glob under directory to skip; may be repeated")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    if args.durability:
+        set_durability(args.durability)
+
+    if args.new_key:
+        add_key(args.key_file, Fernet.generate_key())
+    ring = load_key_ring(args.key_file)
+    journal_file = args.journal or default_journal(ring.cipher().key_id)
+    if args.restart and os.path.exists(journal_file):
+        os.remove(journal_file)
+
+    index = None
+    if args.index:
+        from LabyrinthIndex import FileIndex
+        index = FileIndex(args.index)
+    job = RotationJob(ring, args.workers, journal_file=journal_file, nice=args.nice, index=index,
+                      max_bytes_per_second=args.max_mb_per_second * 1024 * 1024 if args.max_mb_per_second else None,
+                      max_files_per_second=args.max_files_per_second)
+    stats = job.run(find_encrypted(args.directory, args.ignore))
+    if index:
+        index.close()
+    print(f"Rotated {stats}, {job.skipped} already on the primary key")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Entry points by short name. Each is loaded as a module, not run, so GUIs don't open
+# a window and tools don't parse arguments; what's timed is everything before main()
+ENTRY_POINTS = {
+    "ends": "Labyrinth ends.py",
+    "begins": "Labyrinth begins.py",
+    "gui": "LabyrinthV5_WithPicExperiment.py",
+    "ice": "Ice Labyrinthv1.py",
+    "daemon": "LabyrinthDaemon.py",
+    "rotate": "LabyrinthRotate.py",
+}
+
+# Number of timed interpreter starts per entry point
+RUNS = 5
+
+# Modules listed per entry point in the report
+TOP_MODULES = 10
+
+# Run in the child interpreter with the script path as its argument
+LOADER = "import runpy, sys; runpy.run_path(sys.argv[1], run_name='__labyrinth_startup__')"
+
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$")
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def _start(script_path, scratch, import_time=False):
+    """
+    Starts a fresh interpreter that loads script_path and exits. Returns the wall time
+    in seconds and the -X importtime output, if requested.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_DIRECTORY, env.get("PYTHONPATH")]))
+    # Entry points create logs and indexes under the working and home directories
+    env["HOME"] = env["USERPROFILE"] = scratch
+    command = [sys.executable] + (["-X", "importtime"] if import_time else []) + ["-c", LOADER, script_path]
+    started = time.perf_counter()
+    process = subprocess.run(command, cwd=scratch, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+    elapsed = time.perf_counter() - started
+    if process.returncode != 0:
+        raise RuntimeError(f"Loading {script_path} failed:\n{process.stderr.strip()}")
+    return elapsed, process.stderr
+
+
+def top_level_imports(output):
+    """
+    Returns {module: cumulative microseconds} for the modules imported directly by
+    the loaded script (depth zero in the -X importtime tree).
+    """
+    modules = {}
+    for line in output.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match and not match.group(3):
+            modules[match.group(4)] = int(match.group(2))
+    return modules
+
+
+def measure_startup(names=None, runs=RUNS):
+    """
+    Times runs fresh interpreter starts for each named entry point and breaks one
+    of them down by module. Returns {name: result}, where p50_ms and p99_ms are wall
+    times with the bare interpreter's startup taken out.
+    """
+    names = names or list(ENTRY_POINTS)
+    scratch = tempfile.mkdtemp(prefix="labyrinth-startup-")
+    try:
+        # Loading an empty script measures the interpreter and the loader on their own;
+        # their time and the modules they import aren't charged to the entry points
+        empty = os.path.join(scratch, "empty.py")
+        open(empty, "w").close()
+        interpreter = _percentile([_start(empty, scratch)[0] for _ in range(runs)], 0.50)
+        preloaded = set(top_level_imports(_start(empty, scratch, import_time=True)[1]))
+        results = {}
+        for name in names:
+            script_path = os.path.join(REPO_DIRECTORY, ENTRY_POINTS[name])
+            times = [max(0.0, _start(script_path, scratch)[0] - interpreter) for _ in range(runs)]
+            modules = {module: micros for module, micros in top_level_imports(_start(script_path, scratch, import_time=True)[1]).items()
+                       if module not in preloaded}
+            top = sorted(modules.items(), key=lambda item: item[1], reverse=True)[:TOP_MODULES]
+            results[name] = {
+                "runs": runs,
+                "p50_ms": round(_percentile(times, 0.50) * 1000, 3),
+                "p99_ms": round(_percentile(times, 0.99) * 1000, 3),
+                "import_ms": round(sum(modules.values()) / 1000, 3),
+                "interpreter_ms": round(interpreter * 1000, 3),
+                "modules": [[module, round(micros / 1000, 3)] for module, micros in top],
+            }
+        return results
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report where Labyrinth entry points spend their startup time")
+    parser.add_argument("entry_points", nargs="*", metavar="entry_point",
+                        help=f"entry points to measure: {', '.join(ENTRY_POINTS)} (default: all)")
+    parser.add_argument("--runs", type=int, default=RUNS, help="interpreter starts timed per entry point")
+    parser.add_argument("--budget-ms", type=float, help="fail if any entry point's median startup exceeds this")
+    parser.add_argument("--output", help="file the JSON results are written to")
+    args = parser.parse_args()
+    unknown = [name for name in args.entry_points if name not in ENTRY_POINTS]
+    if unknown:
+        parser.error(f"unknown entry points: {', '.join(unknown)}")
+
+    results = measure_startup(args.entry_points, max(1, args.runs))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    over = []
+    for name, result in results.items():
+        print(f"{name} ({ENTRY_POINTS[name]}): p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms, "
+              f"imports {result['import_ms']} ms over a {result['interpreter_ms']} ms interpreter start")
+        for module, ms in result["modules"]:
+            print(f"    {ms:9.3f} ms  {module}")
+        if args.budget_ms is not None and result["p50_ms"] > args.budget_ms:
+            over.append(name)
+    if over:
+        print(f"OVER BUDGET ({args.budget_ms} ms): {', '.join(over)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
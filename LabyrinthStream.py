@@ -0,0 +1,381 @@
+import base64
+import hashlib
+import mmap
+import os
+import struct
+import time
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from LabyrinthMetrics import record_stage, record_error
+from LabyrinthCompression import NO_COMPRESSION, choose_codec, compress_chunks, decompress_chunks
+
+# Streaming container layout:
+#   header  = MAGIC | version (1) | key ID (8) | codec (1) | segment size (4) | nonce prefix (7)
+#   segment = AES-GCM(plaintext chunk) + 16 byte tag, header used as associated data
+# Each segment nonce is nonce prefix | segment counter (4) | last segment flag (1),
+# so segments can't be reordered, dropped or truncated without failing the tag check.
+# With a codec, the plaintext is compressed as one stream and the compressed stream is
+# what gets cut into segments. Version 1 headers had no key ID and version 2 headers no
+# codec; both are still read.
+MAGIC = b"LBYS"
+VERSION = 3
+SEGMENT_SIZE = 1024 * 1024
+MAX_SEGMENT_SIZE = 64 * 1024 * 1024
+TAG_SIZE = 16
+KEY_ID_SIZE = 8
+HEADERS = {1: struct.Struct(">4sBI7s"), 2: struct.Struct(">4sB8sI7s"), 3: struct.Struct(">4sB8sBI7s")}
+HEADER = HEADERS[VERSION]
+MAX_HEADER_SIZE = max(header.size for header in HEADERS.values())
+
+# With a threshold set, files at least this large are memory-mapped and fed to the cipher
+# as memoryview slices of the page cache instead of being copied out segment by segment.
+# Off by default: a mapped file that another process truncates mid-read raises SIGBUS,
+# which kills the process rather than failing the job, and watched files can still be
+# written to. Pass mmap_threshold (8 MiB works well) only for files nothing else writes
+MMAP_THRESHOLD = None
+
+
+def derive_stream_key(key):
+    """
+    Derives the AES-256-GCM segment key from a Fernet key.
+    """
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"labyrinth stream v1")
+    return hkdf.derive(base64.urlsafe_b64decode(key))
+
+
+def key_id(key):
+    """
+    Returns the short ID written into container headers for key.
+    """
+    return hashlib.sha256(b"labyrinth key id" + base64.urlsafe_b64decode(key)).digest()[:KEY_ID_SIZE]
+
+
+def header_struct(data):
+    """
+    Returns the header layout for a container starting with data (at least MAGIC and the version byte).
+    """
+    if len(data) < len(MAGIC) + 1 or data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a streaming container")
+    header = HEADERS.get(data[len(MAGIC)])
+    if header is None:
+        raise ValueError(f"Unsupported container version {data[len(MAGIC)]}")
+    return header
+
+
+def unpack_header(header):
+    """
+    Returns the key ID (None before version 2), codec, segment size and nonce prefix
+    from a complete container header of any version.
+    """
+    layout = header_struct(header)
+    if len(header) != layout.size:
+        raise ValueError("Truncated container header")
+    fields = layout.unpack(header)
+    if fields[1] == 1:
+        return None, NO_COMPRESSION, fields[2], fields[3]
+    if fields[1] == 2:
+        return fields[2], NO_COMPRESSION, fields[3], fields[4]
+    return fields[2:]
+
+
+def read_header(file_path):
+    """
+    Returns unpack_header() of the container header of file_path, or None for Fernet tokens.
+    """
+    with open(file_path, "rb") as f:
+        data = f.read(MAX_HEADER_SIZE)
+    try:
+        return unpack_header(data[:header_struct(data).size])
+    except ValueError:
+        return None
+
+
+def read_key_id(file_path):
+    """
+    Returns the key ID in the container header of file_path, or None for containers
+    and Fernet tokens written without one.
+    """
+    header = read_header(file_path)
+    return header[0] if header else None
+
+
+def read_segments(src, size):
+    """
+    Yields successive size-byte chunks read from the src file object.
+    """
+    while True:
+        chunk = src.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def mapped_segments(mapped, size, offset=0):
+    """
+    Yields successive size-byte memoryview slices of mapped from offset on. The
+    slices share the mapping's pages, so no plaintext or ciphertext is copied.
+    """
+    view = memoryview(mapped)
+    for start in range(offset, len(view), size):
+        yield view[start:start + size]
+
+
+def rechunk(chunks, size):
+    """
+    Regroups an iterator of byte chunks into size-byte chunks, the last possibly
+    shorter. Chunks that already line up are passed through without copying.
+    """
+    pending = bytearray()
+    for chunk in chunks:
+        view = memoryview(chunk)
+        if pending:
+            take = size - len(pending)
+            pending += view[:take]
+            view = view[take:]
+            if len(pending) < size:
+                continue
+            yield bytes(pending)
+            pending = bytearray()
+        while len(view) >= size:
+            yield view[:size]
+            view = view[size:]
+        pending += view
+    if pending:
+        yield bytes(pending)
+
+
+def is_stream_container(file_path):
+    """
+    Returns True if the file starts with the streaming container header.
+    """
+    with open(file_path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class StreamCipher(object):
+    def __init__(self, key, segment_size=SEGMENT_SIZE, mmap_threshold=MMAP_THRESHOLD):
+        self.key = key
+        self.segment_size = segment_size
+        self.mmap_threshold = mmap_threshold
+        self.key_id = key_id(key)
+        self.fernet = Fernet(key)
+        self.aead = AESGCM(derive_stream_key(key))
+
+    def _nonce(self, prefix, counter, last):
+        return prefix + struct.pack(">IB", counter, 1 if last else 0)
+
+    def _mapped(self, src):
+        # Returns a read-only mapping of src when it is large enough to be worth mapping
+        if self.mmap_threshold is None:
+            return None
+        size = os.fstat(src.fileno()).st_size
+        if size == 0 or size < self.mmap_threshold:
+            return None
+        return mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close_mapped(self, mapped):
+        try:
+            mapped.close()
+        except BufferError:
+            # A traceback still holds segment views; the mapping closes once they are collected
+            pass
+
+    def encrypt_stream(self, src, dst, digest=None, codec=NO_COMPRESSION):
+        """
+        Encrypts the src file object into dst, one segment at a time. If digest
+        is given (a hashlib object) it is updated with the plaintext as it is read.
+        """
+        self.encrypt_segments(read_segments(src, self.segment_size), dst, digest, codec)
+
+    def encrypt_segments(self, segments, dst, digest=None, codec=NO_COMPRESSION):
+        """
+        Encrypts an iterator of plaintext chunks, each at most segment_size bytes, into
+        dst, compressing them first with codec if one is given.
+        """
+        prefix = os.urandom(7)
+        header = HEADER.pack(MAGIC, VERSION, self.key_id, codec, self.segment_size, prefix)
+        dst.write(header)
+        if codec != NO_COMPRESSION:
+            # Read time and sizes below are then those of the compressed stream
+            segments = rechunk(compress_chunks(segments, codec, digest=digest), self.segment_size)
+            digest = None
+        counter = 0
+        # Stage times are summed per file and recorded once, not per segment
+        read_time = crypt_time = write_time = 0.0
+        size = written = 0
+        started = time.perf_counter()
+        chunk = next(segments, b"")
+        while True:
+            next_chunk = next(segments, b"")
+            read_done = time.perf_counter()
+            read_time += read_done - started
+            last = not next_chunk
+            if digest is not None:
+                digest.update(chunk)
+            segment = self.aead.encrypt(self._nonce(prefix, counter, last), chunk, header)
+            crypt_done = time.perf_counter()
+            crypt_time += crypt_done - read_done
+            dst.write(segment)
+            started = time.perf_counter()
+            write_time += started - crypt_done
+            size += len(chunk)
+            written += len(segment)
+            if last:
+                break
+            chunk = next_chunk
+            counter += 1
+        record_stage("read", read_time, size)
+        record_stage("encrypted", crypt_time, size)
+        record_stage("written", write_time, written + HEADER.size)
+
+    def _parse_header(self, header):
+        # Validates a container header and returns its segment size, nonce prefix and codec
+        kid, codec, segment_size, prefix = unpack_header(header)
+        if kid is not None and kid != self.key_id:
+            raise ValueError(f"Container was encrypted with key {kid.hex()}, not {self.key_id.hex()}")
+        if not 0 < segment_size <= MAX_SEGMENT_SIZE:
+            raise ValueError(f"Invalid segment size {segment_size}")
+        return segment_size, prefix, codec
+
+    def decrypt_stream(self, src, dst, digest=None):
+        """
+        Decrypts a streaming container from src into dst, one segment at a time.
+        If digest is given it is updated with the plaintext as it is written.
+        """
+        header = src.read(len(MAGIC) + 1)
+        header += src.read(header_struct(header).size - len(header))
+        segment_size, _, _ = self._parse_header(header)
+        self.decrypt_segments(header, read_segments(src, segment_size + TAG_SIZE), dst, digest)
+
+    def decrypted_segments(self, header, blocks, digest=None):
+        """
+        Yields the plaintext of an iterator of ciphertext blocks that followed header in a container.
+        """
+        header = bytes(header)
+        _, prefix, codec = self._parse_header(header)
+        chunks = self._open_segments(header, prefix, blocks)
+        if codec != NO_COMPRESSION:
+            chunks = decompress_chunks(chunks, codec)
+        for chunk in chunks:
+            if digest is not None:
+                digest.update(chunk)
+            yield chunk
+
+    def _open_segments(self, header, prefix, blocks):
+        # Authenticates and decrypts each block, yielding the segment contents
+        counter = 0
+        read_time = crypt_time = 0.0
+        size = written = 0
+        started = time.perf_counter()
+        block = next(blocks, b"")
+        while True:
+            next_block = next(blocks, b"")
+            read_done = time.perf_counter()
+            read_time += read_done - started
+            last = not next_block
+            chunk = self.aead.decrypt(self._nonce(prefix, counter, last), block, header)
+            crypt_time += time.perf_counter() - read_done
+            size += len(block)
+            written += len(chunk)
+            yield chunk
+            started = time.perf_counter()
+            if last:
+                break
+            block = next_block
+            counter += 1
+        record_stage("read", read_time, size + len(header))
+        record_stage("decrypted", crypt_time, written)
+
+    def decrypt_segments(self, header, blocks, dst, digest=None):
+        """
+        Decrypts an iterator of ciphertext blocks that followed header in a container into dst.
+        """
+        write_time = 0.0
+        written = 0
+        for chunk in self.decrypted_segments(header, blocks, digest):
+            started = time.perf_counter()
+            dst.write(chunk)
+            write_time += time.perf_counter() - started
+            written += len(chunk)
+        record_stage("written", write_time, written)
+
+    def plaintext_segments(self, src, digest=None):
+        """
+        Yields the plaintext of the container or legacy Fernet token in the src file
+        object, so it can be fed to another cipher without touching disk.
+        """
+        preamble = src.read(len(MAGIC) + 1)
+        if preamble[:len(MAGIC)] != MAGIC:
+            data = self.fernet.decrypt(preamble + src.read())
+            if digest is not None:
+                digest.update(data)
+            yield data
+            return
+        header = preamble + src.read(header_struct(preamble).size - len(preamble))
+        segment_size, _, _ = self._parse_header(header)
+        mapped = self._mapped(src)
+        if mapped is None:
+            yield from self.decrypted_segments(header, read_segments(src, segment_size + TAG_SIZE), digest)
+            return
+        try:
+            yield from self.decrypted_segments(header, mapped_segments(mapped, segment_size + TAG_SIZE, len(header)), digest)
+        finally:
+            self._close_mapped(mapped)
+
+    def encrypt_file(self, file_path, encrypted_path, digest=None):
+        """
+        Encrypts file_path into encrypted_path using the streaming container, compressed
+        first if compression is configured and a sample of the file compresses.
+        """
+        try:
+            with open(file_path, "rb") as src, open(encrypted_path, "wb") as dst:
+                codec = choose_codec(src, os.fstat(src.fileno()).st_size)
+                mapped = self._mapped(src)
+                if mapped is None:
+                    self.encrypt_stream(src, dst, digest, codec)
+                else:
+                    try:
+                        self.encrypt_segments(mapped_segments(mapped, self.segment_size), dst, digest, codec)
+                    finally:
+                        self._close_mapped(mapped)
+        except Exception:
+            record_error("encrypted")
+            if os.path.exists(encrypted_path):
+                os.remove(encrypted_path)
+            raise
+
+    def decrypt_file(self, encrypted_path, file_path, digest=None):
+        """
+        Decrypts encrypted_path into file_path. Whole-file Fernet tokens
+        written by earlier versions are still accepted.
+        """
+        try:
+            with open(encrypted_path, "rb") as src, open(file_path, "wb") as dst:
+                mapped = self._mapped(src)
+                if mapped is not None and mapped[:len(MAGIC)] != MAGIC:
+                    # Legacy Fernet tokens are decrypted whole, so there is nothing to map
+                    self._close_mapped(mapped)
+                    mapped = None
+                if mapped is not None:
+                    try:
+                        header = mapped[:header_struct(mapped[:len(MAGIC) + 1]).size]
+                        segment_size, _, _ = self._parse_header(header)
+                        self.decrypt_segments(header, mapped_segments(mapped, segment_size + TAG_SIZE, len(header)), dst, digest)
+                    finally:
+                        self._close_mapped(mapped)
+                elif src.read(len(MAGIC)) == MAGIC:
+                    src.seek(0)
+                    self.decrypt_stream(src, dst, digest)
+                else:
+                    src.seek(0)
+                    data = self.fernet.decrypt(src.read())
+                    if digest is not None:
+                        digest.update(data)
+                    dst.write(data)
+        except Exception:
+            record_error("decrypted")
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            raise
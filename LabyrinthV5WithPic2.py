@@ -3,7 +3,13 @@ import tkinter as tk
 import os
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
-from cryptography.fernet import Fernet
+from LabyrinthBulk import decrypt_path
+from LabyrinthDurable import is_temp_path
+from LabyrinthKeys import load_key_ring
+from LabyrinthEvents import EventCoalescer, SweepScheduler, QUIET_WINDOW
+from LabyrinthWorkers import WorkerPool, MAX_QUEUE
+from LabyrinthGroups import GroupMatcher
+from LabyrinthIndex import FileIndex, DEFAULT_INDEX_FILE, start_catch_up
 import logging
 
 # Set up logging
@@ -40,56 +46,63 @@ class CreateToolTip(object):
 
 # DecryptionHandler class definition
 class DecryptionHandler(FileSystemEventHandler):
-    def __init__(self, key, trigger, mode, directory, groups):
+    def __init__(self, key, trigger, mode, directory, groups, quiet_window=QUIET_WINDOW, workers=None, pool_kind="thread", max_queue=MAX_QUEUE):
         super().__init__()
         self.key = key
-        self.fernet = Fernet(self.key)
         self.trigger = trigger
         self.mode = mode
+        self.pool = WorkerPool(self.handle_file, workers, max_queue, pool_kind)
+        self.coalescer = EventCoalescer(self.pool.submit, quiet_window) if trigger == "Modify" else None
         self.directory = directory
         self.groups = groups
+        self.group_matcher = GroupMatcher(groups, directory)
+        # "All" mode sweeps on one thread of its own; events during a sweep merge into one more sweep
+        self.sweeps = SweepScheduler(self.decrypt_all_files, "DecryptSweep") if mode == "All" else None
+        if self.sweeps:
+            self.sweeps.request()
 
     def on_created(self, event):
         if not event.is_directory and self.trigger == "Create":
             file_path = event.src_path
-            if file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
+            if file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.pool.submit(file_path)
 
     def on_deleted(self, event):
         if not event.is_directory and self.trigger == "Delete":
             file_path = event.src_path
-            if not file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
+            if not file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.pool.submit(file_path)
 
     def on_modified(self, event):
         if not event.is_directory and self.trigger == "Modify":
             file_path = event.src_path
-            if file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
+            if file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.coalescer.submit(file_path)
+
+    def close(self):
+        if self.coalescer:
+            self.coalescer.close()
+        self.pool.close()
+        if self.sweeps:
+            self.sweeps.close()
 
     def handle_file(self, file_path):
         try:
             if self.mode == "Individual" or (self.mode == "Group" and self.is_group(file_path)):
                 self.decrypt_file(file_path)
             elif self.mode == "All":
-                self.decrypt_all_files()
+                if self.trigger == "Delete":
+                    self.sweeps.request()
+                elif not self.sweeps.follow_up():
+                    self.decrypt_file(file_path)
         except Exception as e:
             logging.error(f"Error decrypting file {file_path}: {str(e)}")
 
     def is_group(self, file_path):
-        if self.groups:
-            for group_path in self.groups:
-                if group_path.strip() in file_path:
-                    return True
-        return False
+        return self.group_matcher.match(file_path)
 
     def decrypt_file(self, file_path):
-        with open(file_path, "rb") as f:
-            data = f.read()
-        decrypted_data = self.fernet.decrypt(data)
-        with open(file_path[:-len(".encrypted")], "wb") as f:
-            f.write(decrypted_data)
-        os.remove(file_path)
+        self.pool.run(decrypt_path, self.key, file_path)
 
     def decrypt_all_files(self):
         for root, _, files in os.walk(self.directory):
@@ -176,6 +189,11 @@ class DecryptionApp:
         if self.key_file:
             self.key_button.config(text="Selected Key File: " + os.path.basename(self.key_file))
 
+    def get_index(self):
+        if not hasattr(self, 'index'):
+            self.index = FileIndex(DEFAULT_INDEX_FILE)
+        return self.index
+
     def start_monitoring(self):
         if hasattr(self, 'directory') and hasattr(self, 'key_file'):
             groups = self.group_paths_entry.get().split(',') if self.decrypt_mode.get() == "Group" else None
@@ -184,6 +202,7 @@ class DecryptionApp:
             self.decrypt_observer = Observer()
             self.decrypt_observer.schedule(self.handler, self.directory, recursive=True)
             self.decrypt_observer.start()
+            start_catch_up(self.get_index(), self.directory, self.handler, "decrypt")
 
             self.decrypt_label.config(text="Decryption Handler Status: Running")
             self.start_button.config(state=tk.DISABLED)
@@ -196,6 +215,7 @@ class DecryptionApp:
         if hasattr(self, 'decrypt_observer'):
             self.decrypt_observer.stop()
             self.decrypt_observer.join()
+            self.handler.close()
 
             self.decrypt_label.config(text="Decryption Handler Status: Stopped")
             self.start_button.config(state=tk.NORMAL)
@@ -204,8 +224,7 @@ class DecryptionApp:
 
     def load_key(self):
         try:
-            with open(self.key_file, "rb") as f:
-                return f.read()
+            return load_key_ring(self.key_file)
         except Exception as e:
             logging.error(f"Error loading key file '{self.key_file}': {str(e)}")
             messagebox.showerror("Error", f"Failed to load key file '{self.key_file}'. Please check the file.")
@@ -1,14 +1,46 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox
 import logging
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
-from cryptography.fernet import Fernet
-import os
+import queue
+import threading
+import time
+from functools import partial
+from LabyrinthIndex import FileIndex, DEFAULT_INDEX_FILE, start_catch_up
+from LabyrinthMetrics import start_metrics_server, STAGE_EVENTS, STAGE_BYTES
+from LabyrinthDurable import set_durability, GROUPED
+from LabyrinthCompression import set_compression
 
 # Set up logging
 logging.basicConfig(filename='encryption_tool.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Output durability: "none", "per-file" or "grouped" (fsyncs batched across files)
+DURABILITY = GROUPED
+
+# Compression ahead of encryption, off by default: None, "zlib", or "zstd" / "lz4" with the
+# zstandard / lz4 packages. Files whose sampled blocks don't compress (media, archives) are stored uncompressed
+COMPRESSION = None
+
+# Local Prometheus scrape endpoint (http://127.0.0.1:<port>/metrics), off by default since it
+# has no authentication; set a port such as 9464 to enable it
+METRICS_PORT = None
+
+# Seconds between polling scans of the monitored directory, or None for native file events.
+# Polling suits NFS/SMB mounts, where native events miss remote changes, and trees too big for inotify
+SCAN_INTERVAL = None
+
+# How often the window picks up results from background threads, in milliseconds
+POLL_INTERVAL = 250
+
+# Window over which the live files/s and MB/s figures are averaged, in seconds
+RATE_WINDOW = 2.0
+
+def format_eta(seconds):
+    if seconds is None:
+        return "unknown"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
 # Tooltip class
 class CreateToolTip(object):
     def __init__(self, widget, text):
@@ -38,126 +70,6 @@ class CreateToolTip(object):
         if tw:
             tw.destroy()
 
-# EncryptionHandler class definition
-class EncryptionHandler(FileSystemEventHandler):
-    def __init__(self, key, trigger, mode, directory, groups):
-        super().__init__()
-        self.key = key
-        self.fernet = Fernet(self.key)
-        self.trigger = trigger
-        self.mode = mode
-        self.directory = directory
-        self.groups = groups
-
-    def on_created(self, event):
-        if not event.is_directory and self.trigger == "Create":
-            file_path = event.src_path
-            if not file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
-
-    def on_deleted(self, event):
-        if not event.is_directory and self.trigger == "Delete":
-            file_path = event.src_path
-            if file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
-
-    def on_modified(self, event):
-        if not event.is_directory and self.trigger == "Modify":
-            file_path = event.src_path
-            if not file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
-
-    def handle_file(self, file_path):
-        try:
-            if self.mode == "Individual" or (self.mode == "Group" and self.is_group(file_path)):
-                self.encrypt_file(file_path)
-            elif self.mode == "All":
-                self.encrypt_all_files()
-        except Exception as e:
-            logging.error(f"Error encrypting file {file_path}: {str(e)}")
-
-    def is_group(self, file_path):
-        if self.groups:
-            for group_path in self.groups:
-                if group_path.strip() in file_path:
-                    return True
-        return False
-
-    def encrypt_file(self, file_path):
-        with open(file_path, "rb") as f:
-            data = f.read()
-        encrypted_data = self.fernet.encrypt(data)
-        with open(file_path + ".encrypted", "wb") as f:
-            f.write(encrypted_data)
-        os.remove(file_path)
-
-    def encrypt_all_files(self):
-        for root, _, files in os.walk(self.directory):
-            for file_name in files:
-                file_path = os.path.join(root, file_name)
-                if not file_path.endswith(".encrypted"):
-                    self.encrypt_file(file_path)
-
-# DecryptionHandler class definition
-class DecryptionHandler(FileSystemEventHandler):
-    def __init__(self, key, trigger, mode, directory, groups):
-        super().__init__()
-        self.key = key
-        self.fernet = Fernet(self.key)
-        self.trigger = trigger
-        self.mode = mode
-        self.directory = directory
-        self.groups = groups
-
-    def on_created(self, event):
-        if not event.is_directory and self.trigger == "Create":
-            file_path = event.src_path
-            if file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
-
-    def on_deleted(self, event):
-        if not event.is_directory and self.trigger == "Delete":
-            file_path = event.src_path
-            if not file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
-
-    def on_modified(self, event):
-        if not event.is_directory and self.trigger == "Modify":
-            file_path = event.src_path
-            if file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
-
-    def handle_file(self, file_path):
-        try:
-            if self.mode == "Individual" or (self.mode == "Group" and self.is_group(file_path)):
-                self.decrypt_file(file_path)
-            elif self.mode == "All":
-                self.decrypt_all_files()
-        except Exception as e:
-            logging.error(f"Error decrypting file {file_path}: {str(e)}")
-
-    def is_group(self, file_path):
-        if self.groups:
-            for group_path in self.groups:
-                if group_path.strip() in file_path:
-                    return True
-        return False
-
-    def decrypt_file(self, file_path):
-        with open(file_path, "rb") as f:
-            data = f.read()
-        decrypted_data = self.fernet.decrypt(data)
-        with open(file_path[:-len(".encrypted")], "wb") as f:
-            f.write(decrypted_data)
-        os.remove(file_path)
-
-    def decrypt_all_files(self):
-        for root, _, files in os.walk(self.directory):
-            for file_name in files:
-                file_path = os.path.join(root, file_name)
-                if file_path.endswith(".encrypted"):
-                    self.decrypt_file(file_path)
-
 # EncryptionApp class definition
 class EncryptionApp:
     def __init__(self, master):
@@ -170,6 +82,10 @@ class EncryptionApp:
         self.background_label.place(x=0, y=0, relwidth=1, relheight=1)
         self.background_label.image = self.background_image
 
+        # Live throughput, queue depth and progress of "All" sweeps, packed first so it spans the bottom
+        self.progress_label = tk.Label(master, text="", font=("Helvetica", 11), justify="left")
+        self.progress_label.pack(side="bottom", fill="x", padx=20, pady=(0, 10))
+
         self.encryption_frame = tk.Frame(master)
         self.encryption_frame.pack(side="left", padx=20, pady=(20, 10))
 
@@ -268,6 +184,16 @@ class EncryptionApp:
         self.stop_decrypt_button.pack(pady=10)
         CreateToolTip(self.stop_decrypt_button, "Stop monitoring the selected directory for decryption")
 
+        # Anything that can block (starting or draining handlers, "All" sweeps) runs on a background
+        # thread and hands its results back through ui_queue, which only the tkinter thread reads
+        self.ui_queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.draining = set()
+        self.bulk = {}
+        self.rate_sample = (time.monotonic(), *self.processed())
+        self.rates = (0.0, 0.0)
+        master.after(POLL_INTERVAL, self.poll)
+
     def toggle_group_entry(self, mode):
         if mode == "Group":
             self.group_paths_entry.config(state=tk.NORMAL)
@@ -282,67 +208,229 @@ class EncryptionApp:
     def select_key(self):
         key_file = filedialog.askopenfilename(filetypes=[("Key files", "*.key")])
         if key_file:
-            with open(key_file, "rb") as f:
-                self.key = f.read()
+            # Loaded once and shared by both handlers; every key in the ring can decrypt.
+            # cryptography is imported here rather than at startup so the window opens sooner
+            from LabyrinthKeys import load_key_ring
+            self.key = load_key_ring(key_file)
             logging.info("Key file selected")
         else:
             logging.warning("No key file selected")
 
+    def get_index(self):
+        # One file-state index shared by the encryption and decryption handlers.
+        # Handlers are started from background threads, so creation is locked
+        with self.lock:
+            if not hasattr(self, 'index'):
+                self.index = FileIndex(DEFAULT_INDEX_FILE)
+            return self.index
+
+    def get_observer(self):
+        # One observer and one watch per root, routing events to both handlers
+        with self.lock:
+            if not hasattr(self, 'observer'):
+                # watchdog is only loaded once monitoring starts
+                from LabyrinthEvents import SharedObserver
+                if SCAN_INTERVAL:
+                    from LabyrinthPolling import ScandirPollingObserver
+                    self.observer = SharedObserver(partial(ScandirPollingObserver, interval=SCAN_INTERVAL))
+                else:
+                    self.observer = SharedObserver()
+            return self.observer
+
+    def run_in_background(self, work, done, failed):
+        # Runs work() off the tkinter thread, then done(result) or failed(error) back on it
+        def run():
+            try:
+                result = work()
+            except Exception as e:
+                logging.error(f"Error in background task: {str(e)}")
+                self.ui_queue.put((failed, (e,)))
+            else:
+                self.ui_queue.put((done, (result,)))
+        threading.Thread(target=run, name="LabyrinthTask", daemon=True).start()
+
+    def bulk_progress(self, direction):
+        # Called by BulkEngine on the sweeping thread; the figures are copied there and shown by poll()
+        def progress(stats, total):
+            snapshot = (stats.files + stats.errors, total, stats.files_per_second, stats.mb_per_second, stats.eta(total))
+            self.ui_queue.put((self.bulk.__setitem__, (direction, snapshot)))
+        return progress
+
+    def processed(self):
+        # Files and bytes encrypted or decrypted by this process so far
+        files = STAGE_EVENTS.get("encrypted") + STAGE_EVENTS.get("decrypted")
+        size = STAGE_BYTES.get("encrypted") + STAGE_BYTES.get("decrypted")
+        return files, size
+
+    def poll(self):
+        while True:
+            try:
+                function, args = self.ui_queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                function(*args)
+            except Exception as e:
+                logging.error(f"Error updating the window: {str(e)}")
+        self.show_progress()
+        self.master.after(POLL_INTERVAL, self.poll)
+
+    def show_progress(self):
+        now = time.monotonic()
+        started, files, size = self.rate_sample
+        if now - started >= RATE_WINDOW:
+            current_files, current_size = self.processed()
+            self.rates = ((current_files - files) / (now - started), (current_size - size) / (1024 * 1024) / (now - started))
+            self.rate_sample = (now, current_files, current_size)
+        handlers = [getattr(self, name) for name in ('encrypt_handler', 'decrypt_handler') if hasattr(self, name)]
+        queued = sum(handler.pool.queue_depth() for handler in handlers + list(self.draining))
+        lines = [f"Live: {self.rates[0]:.1f} files/s, {self.rates[1]:.1f} MB/s, {queued} files queued"]
+        # Sweeps run in worker processes, so their rates come from BulkEngine rather than the live counters
+        for direction, (done, total, files_per_second, mb_per_second, eta) in sorted(self.bulk.items()):
+            count = f"{done}/{total}" if total is not None else str(done)
+            status = "done" if total is not None and done >= total else f"ETA {format_eta(eta)}"
+            lines.append(f"{direction.capitalize()} all: {count} files, {files_per_second:.1f} files/s, {mb_per_second:.1f} MB/s, {status}")
+        self.progress_label.config(text="\n".join(lines))
+
     def start_monitoring(self):
+        from LabyrinthHandlers import EncryptionHandler
         try:
-            self.groups = [group.strip() for group in self.group_paths_entry.get().split(",")] if self.encrypt_mode.get() == "Group" else []
-            self.encrypt_handler = EncryptionHandler(self.key, self.encrypt_trigger.get(), self.encrypt_mode.get(), self.directory, self.groups)
-            self.encrypt_observer = Observer()
-            self.encrypt_observer.schedule(self.encrypt_handler, self.directory, recursive=True)
-            self.encrypt_observer.start()
-            self.encrypt_label.config(text=f"Encryption Handler Status: Monitoring {self.directory}")
-            self.start_button.config(state=tk.DISABLED)
-            self.stop_button.config(state=tk.NORMAL)
-            logging.info(f"Started monitoring {self.directory} for encryption")
+            key, directory = self.key, self.directory
         except AttributeError:
             messagebox.showwarning("Warning", "Please select a directory and key file first")
             logging.warning("Directory or key file not selected")
+            return
+        # Tk variables are only read on the tkinter thread
+        trigger, mode = self.encrypt_trigger.get(), self.encrypt_mode.get()
+        self.groups = [group.strip() for group in self.group_paths_entry.get().split(",")] if mode == "Group" else []
+        groups = self.groups
+        progress = self.bulk_progress("encrypt")
+
+        def start():
+            handler = EncryptionHandler(key, trigger, mode, directory, groups, index=self.get_index(), progress=progress)
+            try:
+                self.get_observer().add(directory, "encrypt", handler.trigger, handler.submit)
+            except Exception:
+                handler.close()
+                raise
+            start_catch_up(self.get_index(), directory, handler, "encrypt")
+            return handler
+
+        def started(handler):
+            self.encrypt_handler = handler
+            self.encrypt_label.config(text=f"Encryption Handler Status: Monitoring {directory}")
+            self.stop_button.config(state=tk.NORMAL)
+            logging.info(f"Started monitoring {directory} for encryption")
 
-    def stop_monitoring(self):
-        if hasattr(self, 'encrypt_observer'):
-            self.encrypt_observer.stop()
-            self.encrypt_observer.join()
+        def failed(error):
             self.encrypt_label.config(text="Encryption Handler Status: Idle")
             self.start_button.config(state=tk.NORMAL)
+            messagebox.showerror("Error", f"Could not start encryption monitoring: {error}")
+
+        self.start_button.config(state=tk.DISABLED)
+        self.encrypt_label.config(text=f"Encryption Handler Status: Starting on {directory}")
+        self.run_in_background(start, started, failed)
+
+    def stop_monitoring(self):
+        if hasattr(self, 'encrypt_handler'):
+            handler = self.encrypt_handler
+            del self.encrypt_handler
+            self.draining.add(handler)
+
+            def stop():
+                # Lets queued and in-flight files finish, which can take minutes for large files
+                self.get_observer().remove(handler.directory, handler.submit)
+                handler.close()
+
+            def stopped(result):
+                self.draining.discard(handler)
+                self.encrypt_label.config(text="Encryption Handler Status: Idle")
+                self.start_button.config(state=tk.NORMAL)
+                logging.info("Encryption monitoring stopped")
+
+            def failed(error):
+                stopped(None)
+                messagebox.showerror("Error", f"Error stopping encryption monitoring: {error}")
+
             self.stop_button.config(state=tk.DISABLED)
-            logging.info("Encryption monitoring stopped")
+            self.encrypt_label.config(text="Encryption Handler Status: Stopping, finishing queued files")
+            self.run_in_background(stop, stopped, failed)
         else:
             messagebox.showwarning("Warning", "No monitoring to stop")
             logging.warning("No encryption monitoring to stop")
 
     def start_decrypt_monitoring(self):
+        from LabyrinthHandlers import DecryptionHandler
         try:
-            self.decrypt_groups = [group.strip() for group in self.decrypt_group_paths_entry.get().split(",")] if self.decrypt_mode.get() == "Group" else []
-            self.decrypt_handler = DecryptionHandler(self.key, self.decrypt_trigger.get(), self.decrypt_mode.get(), self.directory, self.decrypt_groups)
-            self.decrypt_observer = Observer()
-            self.decrypt_observer.schedule(self.decrypt_handler, self.directory, recursive=True)
-            self.decrypt_observer.start()
-            self.decrypt_label.config(text=f"Decryption Handler Status: Monitoring {self.directory}")
-            self.start_decrypt_button.config(state=tk.DISABLED)
-            self.stop_decrypt_button.config(state=tk.NORMAL)
-            logging.info(f"Started monitoring {self.directory} for decryption")
+            key, directory = self.key, self.directory
         except AttributeError:
             messagebox.showwarning("Warning", "Please select a directory and key file first")
             logging.warning("Directory or key file not selected")
+            return
+        # Tk variables are only read on the tkinter thread
+        trigger, mode = self.decrypt_trigger.get(), self.decrypt_mode.get()
+        self.decrypt_groups = [group.strip() for group in self.decrypt_group_paths_entry.get().split(",")] if mode == "Group" else []
+        groups = self.decrypt_groups
+        progress = self.bulk_progress("decrypt")
+
+        def start():
+            handler = DecryptionHandler(key, trigger, mode, directory, groups, index=self.get_index(), progress=progress)
+            try:
+                self.get_observer().add(directory, "decrypt", handler.trigger, handler.submit)
+            except Exception:
+                handler.close()
+                raise
+            start_catch_up(self.get_index(), directory, handler, "decrypt")
+            return handler
+
+        def started(handler):
+            self.decrypt_handler = handler
+            self.decrypt_label.config(text=f"Decryption Handler Status: Monitoring {directory}")
+            self.stop_decrypt_button.config(state=tk.NORMAL)
+            logging.info(f"Started monitoring {directory} for decryption")
 
-    def stop_decrypt_monitoring(self):
-        if hasattr(self, 'decrypt_observer'):
-            self.decrypt_observer.stop()
-            self.decrypt_observer.join()
+        def failed(error):
             self.decrypt_label.config(text="Decryption Handler Status: Idle")
             self.start_decrypt_button.config(state=tk.NORMAL)
+            messagebox.showerror("Error", f"Could not start decryption monitoring: {error}")
+
+        self.start_decrypt_button.config(state=tk.DISABLED)
+        self.decrypt_label.config(text=f"Decryption Handler Status: Starting on {directory}")
+        self.run_in_background(start, started, failed)
+
+    def stop_decrypt_monitoring(self):
+        if hasattr(self, 'decrypt_handler'):
+            handler = self.decrypt_handler
+            del self.decrypt_handler
+            self.draining.add(handler)
+
+            def stop():
+                # Lets queued and in-flight files finish, which can take minutes for large files
+                self.get_observer().remove(handler.directory, handler.submit)
+                handler.close()
+
+            def stopped(result):
+                self.draining.discard(handler)
+                self.decrypt_label.config(text="Decryption Handler Status: Idle")
+                self.start_decrypt_button.config(state=tk.NORMAL)
+                logging.info("Decryption monitoring stopped")
+
+            def failed(error):
+                stopped(None)
+                messagebox.showerror("Error", f"Error stopping decryption monitoring: {error}")
+
             self.stop_decrypt_button.config(state=tk.DISABLED)
-            logging.info("Decryption monitoring stopped")
+            self.decrypt_label.config(text="Decryption Handler Status: Stopping, finishing queued files")
+            self.run_in_background(stop, stopped, failed)
         else:
             messagebox.showwarning("Warning", "No monitoring to stop")
             logging.warning("No decryption monitoring to stop")
 
 if __name__ == "__main__":
+    set_durability(DURABILITY)
+    set_compression(COMPRESSION)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
     root = tk.Tk()
     app = EncryptionApp(root)
     root.mainloop()
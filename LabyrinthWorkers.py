@@ -0,0 +1,135 @@
+import logging
+import os
+import queue
+import threading
+import time
+from LabyrinthMetrics import record_stage
+
+# Default number of paths that may wait for a worker before the observer is made to wait
+MAX_QUEUE = 1024
+
+# Worker pools run jobs on threads, or hand them to worker processes
+POOL_KINDS = ("thread", "process")
+
+# Sentinel telling a worker thread to exit
+_STOP = object()
+
+
+class WorkerPool(object):
+    def __init__(self, handler, workers=None, max_queue=MAX_QUEUE, kind="thread"):
+        if kind not in POOL_KINDS:
+            raise ValueError(f"Unknown worker pool kind {kind}")
+        self.handler = handler
+        self.workers = workers or os.cpu_count() or 1
+        self.kind = kind
+        self.queue = queue.Queue(max_queue)
+        # Paths waiting in the queue, so a path queued twice (live event and catch-up) runs once
+        self.queued = set()
+        # Paths a worker is handling, and those submitted again meanwhile; a path never runs
+        # on two workers at once, it runs once more after the current job if it still exists
+        self.running = set()
+        self.deferred = set()
+        self.queued_lock = threading.Lock()
+        # Submits past the closed check that haven't queued their path yet; close() waits
+        # for them so no path lands behind the stop markers
+        self.submitting = 0
+        self.submitted = threading.Condition(self.queued_lock)
+        self.closed = False
+        self.processes = None
+        if kind == "process":
+            # Thread pools, the default, never load multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            self.processes = ProcessPoolExecutor(max_workers=self.workers)
+        self.threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"LabyrinthWorker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, file_path):
+        """
+        Queues file_path for the handler. Called from the observer thread, so it
+        does no file or crypto work; it only blocks when the queue is full. A path
+        already being handled is run again by the same worker once it finishes.
+        Returns False if the path is already waiting or the pool is closed.
+        """
+        with self.queued_lock:
+            if self.closed or file_path in self.queued or file_path in self.deferred:
+                return False
+            if file_path in self.running:
+                self.deferred.add(file_path)
+                return True
+            self.queued.add(file_path)
+            self.submitting += 1
+        try:
+            if self.queue.full():
+                logging.warning(f"Worker queue full ({self.queue.maxsize}), waiting to queue {file_path}")
+            self.queue.put((file_path, time.monotonic()))
+        finally:
+            with self.queued_lock:
+                self.submitting -= 1
+                if not self.submitting:
+                    self.submitted.notify_all()
+        return True
+
+    def run(self, function, *args):
+        """
+        Runs a crypto job from a worker thread, in a worker process when the pool
+        kind is "process". function must be a picklable module-level function then.
+        """
+        if self.processes:
+            return self.processes.submit(function, *args).result()
+        return function(*args)
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            file_path = None
+            try:
+                if item is _STOP:
+                    return
+                file_path, queued_at = item
+                with self.queued_lock:
+                    self.queued.discard(file_path)
+                    if file_path in self.running:
+                        # Submitted again while being handled; the worker handling it runs it once more
+                        self.deferred.add(file_path)
+                        continue
+                    self.running.add(file_path)
+                record_stage("queued", time.monotonic() - queued_at)
+                self._handle(file_path)
+            finally:
+                self.queue.task_done()
+
+    def _handle(self, file_path):
+        while True:
+            try:
+                self.handler(file_path)
+            except Exception as e:
+                logging.error(f"Error handling file {file_path}: {str(e)}")
+            with self.queued_lock:
+                # A rerun of a path the first job already moved away would only fail
+                rerun = file_path in self.deferred and os.path.lexists(file_path)
+                self.deferred.discard(file_path)
+                if not rerun:
+                    self.running.discard(file_path)
+                    return
+
+    def close(self):
+        """
+        Lets the workers drain every queued path, then stops them.
+        """
+        with self.queued_lock:
+            self.closed = True
+            # Workers keep draining meanwhile, so a submit waiting on a full queue gets its turn
+            while self.submitting:
+                self.submitted.wait()
+        for _ in self.threads:
+            self.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        if self.processes:
+            self.processes.shutdown()
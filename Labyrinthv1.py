@@ -1,35 +1,45 @@
-import os
 import tkinter as tk
 from tkinter import filedialog, messagebox
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
-from cryptography.fernet import Fernet
+from LabyrinthBulk import encrypt_path, decrypt_path
+from LabyrinthDurable import is_temp_path
+from LabyrinthKeys import load_key_ring
+from LabyrinthEvents import EventCoalescer, QUIET_WINDOW
+from LabyrinthWorkers import WorkerPool, MAX_QUEUE
+from LabyrinthIndex import FileIndex, DEFAULT_INDEX_FILE, start_catch_up
 
 class EncryptionHandler(FileSystemEventHandler):
-    def __init__(self, key, trigger, mode):
+    def __init__(self, key, trigger, mode, quiet_window=QUIET_WINDOW, workers=None, pool_kind="thread", max_queue=MAX_QUEUE):
         super().__init__()
         self.key = key
-        self.fernet = Fernet(self.key)
         self.trigger = trigger
         self.mode = mode
+        self.pool = WorkerPool(self.handle_file, workers, max_queue, pool_kind)
+        self.coalescer = EventCoalescer(self.pool.submit, quiet_window) if trigger == "Modify" else None
 
     def on_created(self, event):
         if not event.is_directory and self.trigger == "Create":
             file_path = event.src_path
-            if not file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
+            if not file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.pool.submit(file_path)
 
     def on_deleted(self, event):
         if not event.is_directory and self.trigger == "Delete":
             file_path = event.src_path
-            if file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
+            if file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.pool.submit(file_path)
 
     def on_modified(self, event):
         if not event.is_directory and self.trigger == "Modify":
             file_path = event.src_path
-            if not file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
+            if not file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.coalescer.submit(file_path)
+
+    def close(self):
+        if self.coalescer:
+            self.coalescer.close()
+        self.pool.close()
 
     def handle_file(self, file_path):
         if self.mode == "Individual" or (self.mode == "Group" and self.is_group(file_path)):
@@ -42,42 +52,43 @@ class EncryptionHandler(FileSystemEventHandler):
         return False
 
     def encrypt_file(self, file_path):
-        with open(file_path, "rb") as f:
-            data = f.read()
-        encrypted_data = self.fernet.encrypt(data)
-        with open(file_path + ".encrypted", "wb") as f:
-            f.write(encrypted_data)
-        os.remove(file_path)
+        self.pool.run(encrypt_path, self.key, file_path)
 
     def encrypt_all_files(self):
         # Implement logic to encrypt all files in directory
         pass
 
 class DecryptionHandler(FileSystemEventHandler):
-    def __init__(self, key, trigger, mode):
+    def __init__(self, key, trigger, mode, quiet_window=QUIET_WINDOW, workers=None, pool_kind="thread", max_queue=MAX_QUEUE):
         super().__init__()
         self.key = key
-        self.fernet = Fernet(self.key)
         self.trigger = trigger
         self.mode = mode
+        self.pool = WorkerPool(self.handle_file, workers, max_queue, pool_kind)
+        self.coalescer = EventCoalescer(self.pool.submit, quiet_window) if trigger == "Modify" else None
 
     def on_created(self, event):
         if not event.is_directory and self.trigger == "Create":
             file_path = event.src_path
-            if file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
+            if file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.pool.submit(file_path)
 
     def on_deleted(self, event):
         if not event.is_directory and self.trigger == "Delete":
             file_path = event.src_path
-            if not file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
+            if not file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.pool.submit(file_path)
 
     def on_modified(self, event):
         if not event.is_directory and self.trigger == "Modify":
             file_path = event.src_path
-            if file_path.endswith(".encrypted"):
-                self.handle_file(file_path)
+            if file_path.endswith(".encrypted") and not is_temp_path(file_path):
+                self.coalescer.submit(file_path)
+
+    def close(self):
+        if self.coalescer:
+            self.coalescer.close()
+        self.pool.close()
 
     def handle_file(self, file_path):
         if self.mode == "Individual" or (self.mode == "Group" and self.is_group(file_path)):
@@ -90,12 +101,7 @@ class DecryptionHandler(FileSystemEventHandler):
         return False
 
     def decrypt_file(self, file_path):
-        with open(file_path, "rb") as f:
-            data = f.read()
-        decrypted_data = self.fernet.decrypt(data)
-        with open(file_path[:-len(".encrypted")], "wb") as f:
-            f.write(decrypted_data)
-        os.remove(file_path)
+        self.pool.run(decrypt_path, self.key, file_path)
 
     def decrypt_all_files(self):
         # Implement logic to decrypt all files in directory
@@ -151,6 +157,11 @@ class EncryptionApp:
         self.key_file = filedialog.askopenfilename()
         self.key_button.config(text="Selected Key File: " + self.key_file)
 
+    def get_index(self):
+        if not hasattr(self, 'index'):
+            self.index = FileIndex(DEFAULT_INDEX_FILE)
+        return self.index
+
     def start_monitoring(self):
         if hasattr(self, 'directory') and hasattr(self, 'key_file'):
             self.handler = EncryptionHandler(self.load_key(), self.encrypt_trigger.get(), self.encrypt_mode.get())
@@ -158,6 +169,7 @@ class EncryptionApp:
             self.encrypt_observer = Observer()
             self.encrypt_observer.schedule(self.handler, self.directory, recursive=True)
             self.encrypt_observer.start()
+            start_catch_up(self.get_index(), self.directory, self.handler, "encrypt")
 
             self.encrypt_label.config(text="Handler Status: Running")
             self.start_button.config(state=tk.DISABLED)
@@ -169,14 +181,14 @@ class EncryptionApp:
         if hasattr(self, 'encrypt_observer'):
             self.encrypt_observer.stop()
             self.encrypt_observer.join()
+            self.handler.close()
 
             self.encrypt_label.config(text="Handler Status: Stopped")
             self.start_button.config(state=tk.NORMAL)
             self.stop_button.config(state=tk.DISABLED)
 
     def load_key(self):
-        with open(self.key_file, "rb") as f:
-            return f.read()
+        return load_key_ring(self.key_file)
 
 class DecryptionApp:
     def __init__(self, master):
@@ -1,9 +1,12 @@
 import os
 import tkinter as tk
 from tkinter import filedialog, messagebox
-from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from cryptography.fernet import Fernet
+from LabyrinthEvents import SharedObserver
+
+# Both apps watch through one observer, so a directory is watched once and each event routed once
+shared_observer = SharedObserver()
 
 class EncryptionHandler(FileSystemEventHandler):
     def __init__(self, key, trigger, mode):
@@ -155,9 +158,8 @@ class EncryptionApp:
         if hasattr(self, 'directory') and hasattr(self, 'key_file'):
             self.handler = EncryptionHandler(self.load_key(), self.encrypt_trigger.get(), self.encrypt_mode.get())
 
-            self.encrypt_observer = Observer()
-            self.encrypt_observer.schedule(self.handler, self.directory, recursive=True)
-            self.encrypt_observer.start()
+            self.watched = self.directory
+            shared_observer.add(self.watched, "encrypt", self.handler.trigger, self.handler.handle_file)
 
             self.encrypt_label.config(text="Handler Status: Running")
             self.start_button.config(state=tk.DISABLED)
@@ -166,9 +168,9 @@ class EncryptionApp:
             messagebox.showerror("Error", "Please select a directory and a key file.")
 
     def stop_monitoring(self):
-        if hasattr(self, 'encrypt_observer'):
-            self.encrypt_observer.stop()
-            self.encrypt_observer.join()
+        if hasattr(self, 'watched'):
+            shared_observer.remove(self.watched, self.handler.handle_file)
+            del self.watched
 
             self.encrypt_label.config(text="Handler Status: Stopped")
             self.start_button.config(state=tk.NORMAL)
@@ -187,8 +189,7 @@ class DecryptionApp:
         self.label1.pack()
 
         self.directory_button = tk.Button(master, text="Select Directory", command=self.select_directory)
-        self.directory
-self.directory_button.pack()
+        self.directory_button.pack()
 
         self.label2 = tk.Label(master, text="Select a key file:")
         self.label2.pack()
@@ -233,9 +234,8 @@ self.directory_button.pack()
         if hasattr(self, 'directory') and hasattr(self, 'key_file'):
             self.handler = DecryptionHandler(self.load_key(), self.decrypt_trigger.get(), self.decrypt_mode.get())
 
-            self.decrypt_observer = Observer()
-            self.decrypt_observer.schedule(self.handler, self.directory, recursive=True)
-            self.decrypt_observer.start()
+            self.watched = self.directory
+            shared_observer.add(self.watched, "decrypt", self.handler.trigger, self.handler.handle_file)
 
             self.decrypt_label.config(text="Handler Status: Running")
             self.start_button.config(state=tk.DISABLED)
@@ -244,9 +244,9 @@ self.directory_button.pack()
             messagebox.showerror("Error", "Please select a directory and a key file.")
 
     def stop_monitoring(self):
-        if hasattr(self, 'decrypt_observer'):
-            self.decrypt_observer.stop()
-            self.decrypt_observer.join()
+        if hasattr(self, 'watched'):
+            shared_observer.remove(self.watched, self.handler.handle_file)
+            del self.watched
 
             self.decrypt_label.config(text="Handler Status: Stopped")
             self.start_button.config(state=tk.NORMAL)
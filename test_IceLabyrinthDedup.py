@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+import unittest
+from cryptography.fernet import Fernet
+import IceLabyrinthDedup
+from IceLabyrinthDedup import DedupBackup, LocalStage, ChunkIndex, CHUNKS, MANIFESTS, chunk_stream
+from LabyrinthDurable import NONE, get_durability, set_durability
+from LabyrinthKeys import KeyRing, add_key
+from LabyrinthStream import key_id
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class DedupBackupTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="labyrinth-test-")
+        # Stage objects are written with atomic_write; fsyncing each one only slows the tests
+        self.durability = get_durability()
+        set_durability(NONE)
+        self.key_file = os.path.join(self.directory, "ring.key")
+        add_key(self.key_file, Fernet.generate_key())
+        self.ring = self.load_ring()
+        self.stage = LocalStage(os.path.join(self.directory, "stage"))
+        self.index = ChunkIndex(os.path.join(self.directory, "chunks.sqlite"))
+        self.backup = DedupBackup(self.ring, self.stage, self.index)
+        self.file_path = os.path.join(self.directory, "data.bin")
+        self.data = os.urandom(2 * 1024 * 1024)
+        self.write(self.data)
+
+    def tearDown(self):
+        self.index.close()
+        set_durability(self.durability[0])
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def load_ring(self):
+        with open(self.key_file, "rb") as f:
+            ring = KeyRing(f.read().splitlines(), self.key_file)
+        ring.mtime_ns = os.stat(self.key_file).st_mtime_ns
+        return ring
+
+    def write(self, data):
+        with open(self.file_path, "wb") as f:
+            f.write(data)
+
+    def restored(self, version=None):
+        restore_path = os.path.join(self.directory, "restored.bin")
+        self.backup.restore("data", restore_path, version)
+        with open(restore_path, "rb") as f:
+            return f.read()
+
+    def test_edit_uploads_few_new_chunks(self):
+        first = self.backup.backup_file(self.file_path, "data")
+        chunks = len(self.stage.list(CHUNKS))
+        self.assertGreater(chunks, 10)
+        edited = self.data[:1000000] + b"edited" + self.data[1000000:]
+        self.write(edited)
+        second = self.backup.backup_file(self.file_path, "data")
+        # Only the chunks around the edit are new
+        self.assertLessEqual(len(self.stage.list(CHUNKS)) - chunks, 3)
+        self.assertEqual(self.backup.versions("data"), [first, second])
+        self.assertEqual(self.restored(first), self.data)
+        self.assertEqual(self.restored(), edited)
+
+    def test_unchanged_file_uploads_no_chunks(self):
+        self.backup.backup_file(self.file_path, "data")
+        chunks = self.stage.list(CHUNKS)
+        self.backup.backup_file(self.file_path, "data")
+        self.assertEqual(self.stage.list(CHUNKS), chunks)
+
+    def test_restore_after_key_rotation(self):
+        first = self.backup.backup_file(self.file_path, "data")
+        old_kid = key_id(self.ring.primary)
+        add_key(self.key_file, Fernet.generate_key())
+        # Timestamps can be coarser than two writes, so make sure the ring sees the change
+        stat = os.stat(self.key_file)
+        os.utime(self.key_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+        edited = self.data[::-1]
+        self.write(edited)
+        second = self.backup.backup_file(self.file_path, "data")
+        new_kid = key_id(self.ring.primary)
+        self.assertNotEqual(old_kid, new_kid)
+        self.assertEqual(sorted(self.stage.list(MANIFESTS)), sorted([old_kid.hex(), new_kid.hex()]))
+        # A process that only loads the rotated ring still finds and restores both versions
+        self.backup = DedupBackup(self.load_ring(), self.stage, self.index)
+        self.assertEqual(self.backup.versions("data"), [first, second])
+        self.assertEqual(self.restored(first), self.data)
+        self.assertEqual(self.restored(second), edited)
+
+    def test_missing_version(self):
+        with self.assertRaises(FileNotFoundError):
+            self.restored()
+
+
+class ChunkCutTest(unittest.TestCase):
+    def tearDown(self):
+        IceLabyrinthDedup.USE_NUMPY = True
+
+    def cuts(self, segments, use_numpy):
+        IceLabyrinthDedup.USE_NUMPY = use_numpy
+        return [len(chunk) for chunk in chunk_stream(segments)]
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_cuts_match_with_and_without_numpy(self):
+        data = os.urandom(3 * 1024 * 1024)
+        for segments in ([data], [data[i:i + 100000] for i in range(0, len(data), 100000)]):
+            self.assertEqual(self.cuts(segments, True), self.cuts(segments, False))
+
+    def test_chunks_cover_the_data(self):
+        data = os.urandom(1024 * 1024)
+        chunks = list(chunk_stream([data[:300000], data[300000:]]))
+        self.assertEqual(b"".join(chunks), data)
+        self.assertTrue(all(len(chunk) <= IceLabyrinthDedup.MAX_CHUNK for chunk in chunks))
+        self.assertTrue(all(len(chunk) >= IceLabyrinthDedup.MIN_CHUNK for chunk in chunks[:-1]))
+        self.assertEqual(list(chunk_stream([])), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,204 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from IceLabyrinthSnowflake import ConnectionPool, BatchUploader, UploadPipeline, is_connection_error, quote
+
+
+# Local stand-in for snowflake.connector: DB-API style connections that record every
+# statement and fail on demand, so the pool and uploader run without a Snowflake account
+class OperationalError(Exception):
+    pass
+
+
+class ProgrammingError(Exception):
+    pass
+
+
+class FakeCursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+
+    def execute(self, sql):
+        connector = self.connection.connector
+        with connector.lock:
+            connector.statements.append(sql)
+            if self.connection.closed or self.connection.dropped:
+                raise OperationalError("Connection reset by peer")
+            if connector.fail_connection:
+                connector.fail_connection -= 1
+                self.connection.dropped = True
+                raise OperationalError("Connection reset by peer")
+            if connector.fail_sql:
+                connector.fail_sql -= 1
+                raise ProgrammingError("SQL compilation error")
+            if sql.startswith("PUT 'file://"):
+                # Record what the PUT would send, since the staging directory is gone afterwards
+                staging_dir = sql[len("PUT 'file://"):sql.index("/*'")]
+                connector.staged.extend(sorted(os.listdir(staging_dir)))
+        self.description = [("result",)] if sql.startswith(("SELECT", "LIST")) else None
+
+    def fetchall(self):
+        return [(1,)]
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self, connector):
+        self.connector = connector
+        self.closed = False
+        self.dropped = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def is_closed(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnector(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statements = []
+        self.staged = []
+        self.connections = []
+        self.fail_connection = 0
+        self.fail_sql = 0
+
+    def connect(self):
+        connection = FakeConnection(self)
+        with self.lock:
+            self.connections.append(connection)
+        return connection
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.connector = FakeConnector()
+        self.pool = ConnectionPool(self.connector.connect, min_size=2, max_size=3)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_fill_opens_min_size_connections(self):
+        self.assertEqual(self.pool.fill(), 2)
+        self.assertEqual(len(self.connector.connections), 2)
+        self.assertEqual(len(self.pool.idle), 2)
+        self.assertEqual(self.pool.fill(), 0)
+
+    def test_connections_are_reused(self):
+        for _ in range(5):
+            self.pool.execute("SELECT 1")
+        self.assertEqual(len(self.connector.connections), 1)
+
+    def test_connection_error_is_retried_on_a_fresh_connection(self):
+        self.pool.fill()
+        self.connector.fail_connection = 1
+        self.assertEqual(self.pool.execute("SELECT 1"), [(1,)])
+        self.assertEqual(self.connector.statements.count("SELECT 1"), 2)
+        self.assertEqual(sum(connection.closed for connection in self.connector.connections), 1)
+
+    def test_sql_error_is_not_retried(self):
+        self.pool.fill()
+        self.connector.fail_sql = 1
+        with self.assertRaises(ProgrammingError):
+            self.pool.execute("COPY INTO T")
+        self.assertEqual(self.connector.statements.count("COPY INTO T"), 1)
+        # The connection was fine, so it went back to the pool
+        self.assertFalse(any(connection.closed for connection in self.connector.connections))
+        self.assertEqual(len(self.pool.idle), 2)
+
+    def test_connection_error_gives_up_after_retries(self):
+        self.connector.fail_connection = 2
+        with self.assertRaises(OperationalError):
+            self.pool.execute("SELECT 1", retries=1)
+        self.assertEqual(self.pool.size, 0)
+
+    def test_acquire_waits_at_max_size(self):
+        held = [self.pool.acquire() for _ in range(3)]
+        with self.assertRaises(TimeoutError):
+            self.pool.acquire(timeout=0.05)
+        self.pool.release(held.pop())
+        self.assertIsNotNone(self.pool.acquire(timeout=0.05))
+
+    def test_is_connection_error(self):
+        self.assertTrue(is_connection_error(OperationalError()))
+        self.assertTrue(is_connection_error(ConnectionResetError()))
+        self.assertFalse(is_connection_error(ProgrammingError()))
+
+
+class BatchUploaderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="labyrinth-test-")
+        self.paths = []
+        for i in range(10):
+            file_path = os.path.join(self.directory, f"file{i}.encrypted")
+            with open(file_path, "wb") as f:
+                f.write(os.urandom(64))
+            self.paths.append(file_path)
+        self.connector = FakeConnector()
+        self.pool = ConnectionPool(self.connector.connect)
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def upload(self, **options):
+        uploader = BatchUploader(self.pool, "@stage", "T", max_files=5, flush_interval=0.05, retry_delay=0, **options)
+        pipeline = UploadPipeline(uploader.add, workers=2, asynchronous=True)
+        for file_path in self.paths:
+            pipeline.submit(file_path)
+        # Same order as Ice Labyrinthv1.py: the pipeline waits for the last batch, flushed by the timer
+        pipeline.close(timeout=10)
+        uploader.close()
+        return uploader, pipeline.metrics()
+
+    def test_one_put_and_copy_per_batch(self):
+        uploader, metrics = self.upload()
+        puts = [sql for sql in self.connector.statements if sql.startswith("PUT")]
+        copies = [sql for sql in self.connector.statements if sql.startswith("COPY")]
+        self.assertEqual((len(puts), len(copies)), (2, 2))
+        self.assertEqual((metrics["uploaded"], metrics["failed"], metrics["in_flight"]), (10, 0, 0))
+
+    def test_failed_batch_is_retried(self):
+        self.connector.fail_sql = 1
+        uploader, metrics = self.upload(retries=1)
+        self.assertEqual(uploader.files_uploaded, 10)
+        self.assertEqual(metrics["uploaded"], 10)
+
+    def test_batch_failing_every_retry_is_reported(self):
+        self.connector.fail_sql = 100
+        uploader, metrics = self.upload(retries=1)
+        self.assertEqual((uploader.batches_failed, uploader.files_failed), (2, 10))
+        self.assertEqual((metrics["uploaded"], metrics["failed"]), (0, 10))
+
+    def test_names_are_quoted_and_unique(self):
+        other = os.path.join(self.directory, "other")
+        os.mkdir(other)
+        self.paths = []
+        for directory in (self.directory, other):
+            file_path = os.path.join(directory, "it's.encrypted")
+            with open(file_path, "wb") as f:
+                f.write(os.urandom(64))
+            self.paths.append(file_path)
+        uploader, metrics = self.upload()
+        self.assertEqual(uploader.files_uploaded, 2)
+        # Both files went out in one batch, each under its own name
+        self.assertEqual(len(set(self.connector.staged)), 2)
+        self.assertTrue(all(name.endswith("-it's.encrypted") for name in self.connector.staged))
+        copy = next(sql for sql in self.connector.statements if sql.startswith("COPY"))
+        for name in self.connector.staged:
+            self.assertIn(quote(name), copy)
+        self.assertIn("it''s.encrypted'", copy)
+        self.assertNotIn("'it's", copy)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet
+from LabyrinthBulk import encrypt_path, decrypt_path
+from LabyrinthDurable import POLICIES, GROUPED, atomic_write, commit, temp_path, is_temp_path, get_durability, set_durability
+
+
+class DurableWriteTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="labyrinth-test-")
+        self.durability = get_durability()
+
+    def tearDown(self):
+        set_durability(*self.durability)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read(self, name):
+        with open(self.path(name), "rb") as f:
+            return f.read()
+
+    def write(self, name, data):
+        with open(self.path(name), "wb") as f:
+            f.write(data)
+
+    def test_atomic_write_under_every_policy(self):
+        for policy in POLICIES:
+            with self.subTest(policy=policy):
+                self.write("source", b"plain")
+                atomic_write(self.path("out"), policy.encode(), source=self.path("source"), policy=policy)
+                self.assertEqual(self.read("out"), policy.encode())
+                # The source is removed once the output is in place, and no temp file is left
+                self.assertEqual(os.listdir(self.directory), ["out"])
+
+    def test_temp_paths_are_hidden_and_unique(self):
+        first, second = temp_path(self.path("out")), temp_path(self.path("out"))
+        self.assertNotEqual(first, second)
+        self.assertTrue(is_temp_path(first))
+        self.assertTrue(os.path.basename(first).startswith("."))
+        self.assertEqual(os.path.dirname(first), self.directory)
+
+    def test_failed_commit_discards_the_temp_file_and_keeps_the_source(self):
+        for policy in POLICIES:
+            with self.subTest(policy=policy):
+                self.write("source", b"plain")
+                staged = temp_path(self.path("out"))
+                self.write(os.path.basename(staged), b"data")
+                with self.assertRaises(OSError):
+                    commit(staged, self.path("missing/out"), self.path("source"), policy=policy)
+                self.assertEqual(os.listdir(self.directory), ["source"])
+
+    def test_grouped_commits_can_be_waited_on_later(self):
+        pending = []
+        for i in range(5):
+            staged = temp_path(self.path(f"out{i}"))
+            self.write(os.path.basename(staged), str(i).encode())
+            commit(staged, self.path(f"out{i}"), pending=pending, policy=GROUPED)
+        for handle in pending:
+            handle.wait(10)
+        self.assertEqual(sorted(os.listdir(self.directory)), [f"out{i}" for i in range(5)])
+
+    def test_encrypt_and_decrypt_paths_replace_their_source(self):
+        key = Fernet.generate_key()
+        self.write("file", b"contents")
+        encrypted_path, content_hash = encrypt_path(key, self.path("file"))
+        self.assertEqual(os.listdir(self.directory), ["file.encrypted"])
+        decrypted_path, restored_hash = decrypt_path(key, encrypted_path)
+        self.assertEqual(os.listdir(self.directory), ["file"])
+        self.assertEqual((decrypted_path, restored_hash), (self.path("file"), content_hash))
+        self.assertEqual(self.read("file"), b"contents")
+
+    def test_failed_decrypt_leaves_only_the_ciphertext(self):
+        key = Fernet.generate_key()
+        self.write("file", os.urandom(3 * 1024 * 1024))
+        encrypted_path, _ = encrypt_path(key, self.path("file"))
+        with open(encrypted_path, "r+b") as f:
+            f.truncate(os.path.getsize(encrypted_path) - 100)
+        truncated = self.read("file.encrypted")
+        with self.assertRaises(InvalidTag):
+            decrypt_path(key, encrypted_path)
+        self.assertEqual(os.listdir(self.directory), ["file.encrypted"])
+        self.assertEqual(self.read("file.encrypted"), truncated)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import unittest
+from cryptography.fernet import Fernet, InvalidToken
+from LabyrinthKeys import KeyRing, add_key
+from LabyrinthStream import key_id, read_key_id
+
+
+class KeyRingTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="labyrinth-test-")
+        self.key_file = os.path.join(self.directory, "ring.key")
+        self.old_key = Fernet.generate_key()
+        add_key(self.key_file, self.old_key)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def load_ring(self):
+        with open(self.key_file, "rb") as f:
+            ring = KeyRing(f.read().splitlines(), self.key_file)
+        ring.mtime_ns = os.stat(self.key_file).st_mtime_ns
+        return ring
+
+    def rotate(self):
+        key = Fernet.generate_key()
+        add_key(self.key_file, key)
+        # Timestamps can be coarser than two writes, so make sure loaded rings see the change
+        stat = os.stat(self.key_file)
+        os.utime(self.key_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+        return key
+
+    def encrypt(self, ring, name, data):
+        with open(self.path(name), "wb") as f:
+            f.write(data)
+        ring.encrypt_file(self.path(name), self.path(name + ".encrypted"))
+        os.remove(self.path(name))
+        return self.path(name + ".encrypted")
+
+    def decrypt(self, ring, encrypted_path):
+        restored = self.path("restored")
+        ring.decrypt_file(encrypted_path, restored)
+        with open(restored, "rb") as f:
+            return f.read()
+
+    def test_add_key_makes_it_primary(self):
+        ring = self.load_ring()
+        new_key = self.rotate()
+        self.assertTrue(ring.refresh())
+        self.assertEqual(ring.primary, new_key)
+        self.assertEqual(ring.keys, (self.old_key, new_key))
+        self.assertFalse(ring.refresh())
+
+    def test_files_are_decrypted_by_key_id_after_add_key(self):
+        ring = self.load_ring()
+        old_file = self.encrypt(ring, "old", b"old contents")
+        self.assertEqual(read_key_id(old_file), key_id(self.old_key))
+        new_key = self.rotate()
+        new_file = self.encrypt(ring, "new", b"new contents")
+        self.assertEqual(read_key_id(new_file), key_id(new_key))
+        self.assertEqual(self.decrypt(ring, old_file), b"old contents")
+        self.assertEqual(self.decrypt(ring, new_file), b"new contents")
+        self.assertEqual(ring.source_cipher(old_file).key_id, key_id(self.old_key))
+
+    def test_ring_loaded_before_add_key_finds_the_new_key(self):
+        stale = self.load_ring()
+        self.rotate()
+        new_file = self.encrypt(self.load_ring(), "new", b"new contents")
+        # The key ID isn't in the stale ring, so it reloads the key file to find it
+        self.assertEqual(self.decrypt(stale, new_file), b"new contents")
+
+    def test_unknown_key_id(self):
+        other = KeyRing([Fernet.generate_key()])
+        encrypted_path = self.encrypt(other, "file", b"contents")
+        with self.assertRaises(KeyError):
+            self.decrypt(self.load_ring(), encrypted_path)
+        self.assertFalse(os.path.exists(self.path("restored")))
+
+    def test_legacy_fernet_tokens_under_any_ring_key(self):
+        data = b"written before the container format"
+        with open(self.path("legacy.encrypted"), "wb") as f:
+            f.write(Fernet(self.old_key).encrypt(data))
+        self.rotate()
+        ring = self.load_ring()
+        # No key ID in a Fernet token, so each key is tried, newest first
+        self.assertIsNone(read_key_id(self.path("legacy.encrypted")))
+        self.assertEqual(self.decrypt(ring, self.path("legacy.encrypted")), data)
+        self.assertEqual(ring.source_cipher(self.path("legacy.encrypted")).key_id, key_id(self.old_key))
+        with self.assertRaises(InvalidToken):
+            self.decrypt(KeyRing([Fernet.generate_key()]), self.path("legacy.encrypted"))
+
+    def test_rings_with_the_same_keys_are_equal(self):
+        self.assertEqual(self.load_ring(), KeyRing([self.old_key]))
+        self.assertEqual(len(self.load_ring()), 1)
+        with self.assertRaises(ValueError):
+            KeyRing([b"", b"  "])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+from cryptography.fernet import Fernet
+from LabyrinthBulk import encrypt_path
+from LabyrinthDurable import NONE, get_durability, set_durability
+from LabyrinthKeys import KeyRing
+from LabyrinthRotate import RotationJob, find_encrypted
+from LabyrinthStream import key_id, read_key_id
+
+
+class RotationJobTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="labyrinth-test-")
+        self.durability = get_durability()
+        set_durability(NONE)
+        self.old_key = Fernet.generate_key()
+        self.new_key = Fernet.generate_key()
+        self.tree = os.path.join(self.directory, "tree")
+        self.contents = {}
+        for i in range(20):
+            directory = os.path.join(self.tree, f"d{i % 3}")
+            os.makedirs(directory, exist_ok=True)
+            file_path = os.path.join(directory, f"file{i}")
+            data = os.urandom(i * 1000)
+            with open(file_path, "wb") as f:
+                f.write(data)
+            encrypted_path, _ = encrypt_path(self.old_key, file_path)
+            self.contents[encrypted_path] = data
+        # A legacy Fernet token has no key ID and is rotated too
+        legacy = os.path.join(self.tree, "legacy.encrypted")
+        with open(legacy, "wb") as f:
+            f.write(Fernet(self.old_key).encrypt(b"legacy"))
+        self.contents[legacy] = b"legacy"
+        self.ring = KeyRing([self.old_key, self.new_key])
+        self.journal_file = os.path.join(self.directory, "rotate.journal")
+
+    def tearDown(self):
+        set_durability(*self.durability)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def rotate(self, journal_file=None):
+        job = RotationJob(self.ring, workers=2, shard_size=4, journal_file=journal_file or self.journal_file, nice=0)
+        return job, job.run(find_encrypted(self.tree))
+
+    def snapshot(self):
+        snapshot = {}
+        for file_path in self.contents:
+            stat = os.stat(file_path)
+            snapshot[file_path] = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def test_rotation_moves_every_file_to_the_primary_key(self):
+        job, stats = self.rotate()
+        self.assertEqual((stats.files, stats.errors, job.skipped), (len(self.contents), 0, 0))
+        new_ring = KeyRing([self.new_key])
+        for encrypted_path, data in self.contents.items():
+            self.assertEqual(read_key_id(encrypted_path), key_id(self.new_key))
+            with open(encrypted_path, "rb") as f:
+                self.assertEqual(b"".join(new_ring.cipher().plaintext_segments(f)), data)
+        self.assertEqual(sorted(find_encrypted(self.tree)), sorted(self.contents))
+
+    def test_second_run_changes_nothing(self):
+        self.rotate()
+        snapshot = self.snapshot()
+        # Resumed from the journal: every file is checkpointed and none is opened
+        job, stats = self.rotate()
+        self.assertEqual((stats.files, stats.errors, job.skipped), (0, 0, 0))
+        self.assertEqual(self.snapshot(), snapshot)
+        # Started over without the journal: every file is already on the primary key
+        job, stats = self.rotate(os.path.join(self.directory, "fresh.journal"))
+        self.assertEqual((stats.files, stats.errors, job.skipped), (0, 0, len(self.contents)))
+        self.assertEqual(self.snapshot(), snapshot)
+
+
+if __name__ == "__main__":
+    unittest.main()
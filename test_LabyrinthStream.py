@@ -0,0 +1,117 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet
+from LabyrinthStream import StreamCipher, HEADER, TAG_SIZE, MAGIC, read_header, read_key_id, key_id
+
+# Small segments, so multi-segment containers stay small
+SEG = 1024
+
+
+class StreamCipherTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="labyrinth-test-")
+        self.key = Fernet.generate_key()
+        self.cipher = StreamCipher(self.key, segment_size=SEG)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def encrypt(self, data, cipher=None):
+        with open(self.path("plain"), "wb") as f:
+            f.write(data)
+        (cipher or self.cipher).encrypt_file(self.path("plain"), self.path("plain.encrypted"))
+        with open(self.path("plain.encrypted"), "rb") as f:
+            return f.read()
+
+    def decrypt(self, container, cipher=None):
+        with open(self.path("plain.encrypted"), "wb") as f:
+            f.write(container)
+        (cipher or self.cipher).decrypt_file(self.path("plain.encrypted"), self.path("restored"))
+        with open(self.path("restored"), "rb") as f:
+            return f.read()
+
+    def segments(self, container):
+        # Splits a container into its header and ciphertext blocks
+        body = container[HEADER.size:]
+        return container[:HEADER.size], [body[i:i + SEG + TAG_SIZE] for i in range(0, len(body), SEG + TAG_SIZE)]
+
+    def test_round_trip_at_segment_boundaries(self):
+        for size in (0, 1, SEG - 1, SEG, SEG + 1, 3 * SEG):
+            with self.subTest(size=size):
+                data = os.urandom(size)
+                container = self.encrypt(data)
+                # Every container has at least one segment, so an empty file still carries a tag
+                self.assertEqual(len(container), HEADER.size + max(1, -(-size // SEG)) * TAG_SIZE + size)
+                self.assertEqual(self.decrypt(container), data)
+                with open(self.path("plain.encrypted"), "rb") as f:
+                    self.assertEqual(b"".join(self.cipher.plaintext_segments(f)), data)
+
+    def test_round_trip_through_mmap(self):
+        cipher = StreamCipher(self.key, segment_size=SEG, mmap_threshold=1)
+        for size in (1, SEG, 3 * SEG + 1):
+            with self.subTest(size=size):
+                data = os.urandom(size)
+                self.assertEqual(self.decrypt(self.encrypt(data, cipher), cipher), data)
+
+    def test_stream_round_trip(self):
+        data = os.urandom(2 * SEG + 7)
+        encrypted = io.BytesIO()
+        self.cipher.encrypt_stream(io.BytesIO(data), encrypted)
+        encrypted.seek(0)
+        restored = io.BytesIO()
+        self.cipher.decrypt_stream(encrypted, restored)
+        self.assertEqual(restored.getvalue(), data)
+
+    def test_header_names_the_key(self):
+        self.encrypt(b"data")
+        self.assertEqual(read_key_id(self.path("plain.encrypted")), key_id(self.key))
+        self.assertEqual(read_header(self.path("plain.encrypted"))[0], key_id(self.key))
+
+    def assert_rejected(self, container):
+        if os.path.exists(self.path("restored")):
+            os.remove(self.path("restored"))
+        with self.assertRaises(InvalidTag):
+            self.decrypt(container)
+        # The partial plaintext is removed
+        self.assertFalse(os.path.exists(self.path("restored")))
+
+    def test_truncated_container_is_rejected(self):
+        header, blocks = self.segments(self.encrypt(os.urandom(3 * SEG)))
+        # Dropping whole trailing segments leaves a valid-looking last segment without the last flag
+        self.assert_rejected(header + b"".join(blocks[:2]))
+        self.assert_rejected(header + b"".join(blocks)[:-1])
+
+    def test_reordered_segments_are_rejected(self):
+        header, blocks = self.segments(self.encrypt(os.urandom(3 * SEG)))
+        self.assert_rejected(header + blocks[1] + blocks[0] + blocks[2])
+
+    def test_tampered_segment_is_rejected(self):
+        container = bytearray(self.encrypt(os.urandom(SEG)))
+        container[-TAG_SIZE - 1] ^= 1
+        self.assert_rejected(bytes(container))
+
+    def test_legacy_fernet_token(self):
+        data = os.urandom(3 * SEG)
+        token = Fernet(self.key).encrypt(data)
+        self.assertFalse(token.startswith(MAGIC))
+        self.assertEqual(self.decrypt(token), data)
+        with open(self.path("plain.encrypted"), "rb") as f:
+            self.assertEqual(b"".join(self.cipher.plaintext_segments(f)), data)
+        self.assertIsNone(read_key_id(self.path("plain.encrypted")))
+
+    def test_wrong_key_leaves_no_output(self):
+        container = self.encrypt(b"data")
+        with self.assertRaises(ValueError):
+            self.decrypt(container, StreamCipher(Fernet.generate_key(), segment_size=SEG))
+        self.assertFalse(os.path.exists(self.path("restored")))
+
+
+if __name__ == "__main__":
+    unittest.main()